@@ -0,0 +1,238 @@
+"""Asyncio runtime for Trollflow based Trollduction.
+
+As an alternative to the daemon threads polling their queues, the
+stages can be run as coroutines on one event loop.  The stages are
+connected with bounded asyncio queues, so a stage producing faster
+than the next one can consume waits for room in the queue.  CPU heavy
+work, like reading, resampling and writing the data, is run in an
+executor.
+
+The SceneLoader passes the same global scene to the Resampler for each
+area, so the lock handoffs of the workflow components are kept: each
+component stage gets its own lock and the lock of the previous stage,
+as in the Trollflow configuration, and uses them if "use_lock" is set
+in its configuration.  A stage holding its lock doesn't let the next
+one start before all its output for the item is queued, so the queues
+after such stages have to be unbounded.
+
+Requires Python 3.
+
+Example::
+
+    pipeline = Pipeline()
+    files, datasets = pipeline.queue(), pipeline.queue()
+    scenes, resampled = pipeline.queue(0), pipeline.queue(0)
+    loader_lock, resampler_lock = Lock(), Lock()
+    pipeline.add(queue_source(listener.output_queue, files))
+    pipeline.add(segment_gatherer_stage(gatherer, files, datasets))
+    pipeline.add(component_stage(SceneLoader(), loader_config,
+                                 datasets, scenes, lock=loader_lock))
+    pipeline.add(component_stage(Resampler(), resampler_config,
+                                 scenes, resampled, lock=resampler_lock,
+                                 prev_lock=loader_lock))
+    pipeline.add(writer_stage(writer, resampled, prev_lock=resampler_lock))
+    asyncio.get_event_loop().run_until_complete(pipeline.run())
+"""
+
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+
+import six.moves.queue as queue
+
+from trollflow_sat import utils
+
+LOGGER = logging.getLogger(__name__)
+
+# Maximum number of items waiting between two stages
+DEFAULT_QUEUE_SIZE = 10
+
+
+class Pipeline(object):
+
+    """Stages running as coroutines on one event loop."""
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._stages = []
+        self._tasks = []
+        self._loop = None
+        self._stopped = False
+
+    def queue(self, maxsize=None):
+        """Create a queue for connecting two stages."""
+        if maxsize is None:
+            maxsize = self.queue_size
+        return asyncio.Queue(maxsize=maxsize)
+
+    def add(self, stage):
+        """Add the *stage* coroutine to the pipeline."""
+        self._stages.append(stage)
+
+    async def run(self):
+        """Run the stages until one of them fails or the pipeline is
+        stopped."""
+        self._loop = asyncio.get_event_loop()
+        self._stopped = False
+        self._tasks = [asyncio.ensure_future(stage) for stage in
+                       self._stages]
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            if not self._stopped:
+                raise
+            LOGGER.info("Pipeline stopped.")
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stop(self):
+        """Stop the pipeline.  Can be called from any thread."""
+        if self._loop is None:
+            return
+        self._stopped = True
+        for task in self._tasks:
+            self._loop.call_soon_threadsafe(task.cancel)
+
+
+class _Buffer(object):
+
+    """Collect the items put by synchronous code for sending them to an
+    asyncio queue."""
+
+    def __init__(self):
+        self._items = deque()
+
+    def put(self, item):
+        """Add *item* to the buffer."""
+        self._items.append(item)
+
+    async def flush(self, out_queue):
+        """Move the collected items to *out_queue*, waiting for room."""
+        while self._items:
+            await out_queue.put(self._items.popleft())
+
+
+class _ThreadSafeOutput(object):
+
+    """Output queue for code running in an executor.  Putting waits
+    until there's room in the asyncio queue."""
+
+    def __init__(self, out_queue, loop):
+        self._queue = out_queue
+        self._loop = loop
+
+    def put(self, item):
+        """Put *item* to the queue."""
+        asyncio.run_coroutine_threadsafe(self._queue.put(item),
+                                         self._loop).result()
+
+
+async def queue_source(sync_queue, out_queue, executor=None, timeout=1.):
+    """Move the items from the thread-safe *sync_queue*, eg. the output
+    queue of a posttroll listener, to *out_queue*.  The queue is read
+    in the *executor*, *timeout* is the longest time stopping of the
+    pipeline may have to wait for the reading."""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            item = await loop.run_in_executor(
+                executor, partial(sync_queue.get, True, timeout))
+        except queue.Empty:
+            continue
+        await out_queue.put(item)
+
+
+async def segment_gatherer_stage(gatherer, in_queue, out_queue):
+    """Run *gatherer*, a SegmentGatherer, on file messages from
+    *in_queue* and put the published messages to *out_queue*.  The
+    gatherer wakes up only for new messages and slot timeouts."""
+    output = _Buffer()
+    gatherer.output_queue = output
+    gatherer.restore()
+    await output.flush(out_queue)
+    while True:
+        gatherer.check_deadlines()
+        await output.flush(out_queue)
+        try:
+            msg = await asyncio.wait_for(
+                in_queue.get(), gatherer.get_wait_time(max_wait=None))
+        except asyncio.TimeoutError:
+            continue
+        gatherer.handle_message(msg)
+        await output.flush(out_queue)
+
+
+async def fetcher_stage(in_queue, out_queue, destination, executor=None,
+                        **kwargs):
+    """Fetch the files of the messages in *in_queue* to *destination*
+    in the *executor*.  The keyword arguments are passed to
+    `trollflow_sat.fetch.fetch_files`."""
+    from trollflow_sat.fetch import fetch_files
+    loop = asyncio.get_event_loop()
+    while True:
+        msg = await in_queue.get()
+        if msg is not None:
+            try:
+                msg = await loop.run_in_executor(
+                    executor, partial(fetch_files, msg, destination,
+                                      **kwargs))
+            except Exception:
+                LOGGER.exception("Fetching failed for %s", str(msg))
+                continue
+        await out_queue.put(msg)
+
+
+async def component_stage(component, context, in_queue, out_queue,
+                          executor=None, lock=None, prev_lock=None):
+    """Invoke the workflow *component*, eg. SceneLoader or Resampler,
+    in the *executor* for each item in *in_queue*.  The component gets
+    the configuration in *context*, its own *lock* and the *prev_lock*
+    of the previous stage, and its output goes to *out_queue*."""
+    loop = asyncio.get_event_loop()
+    output = _ThreadSafeOutput(out_queue, loop)
+    while True:
+        item = await in_queue.get()
+        item_context = dict(context, content=item, output_queue=output,
+                            lock=lock, prev_lock=prev_lock)
+        try:
+            await loop.run_in_executor(executor, component.invoke,
+                                       item_context)
+        except Exception:
+            LOGGER.exception("%s failed", component.__class__.__name__)
+
+
+async def writer_stage(writer, in_queue, executor=None, prev_lock=None):
+    """Save the data from *in_queue* with *writer*, a DataWriter that
+    hasn't been started.  The data is computed, and the messages
+    published, in the *executor* when a terminator (None) is
+    received.  The *prev_lock* of the previous stage is held while
+    handling each item."""
+    loop = asyncio.get_event_loop()
+    with writer.create_publisher() as writer.pub:
+        while True:
+            data = await in_queue.get()
+            try:
+                await loop.run_in_executor(
+                    executor, partial(_write, writer, data, prev_lock))
+            except Exception:
+                writer.logger.exception("Something went wrong when writing.")
+
+
+def _write(writer, data, prev_lock):
+    """Write *data* with *writer* holding *prev_lock*."""
+    utils.acquire_lock(prev_lock)
+    try:
+        writer.write(data)
+    finally:
+        utils.release_locks([prev_lock])
+
+
+async def publisher_stage(in_queue, publisher):
+    """Send the messages from *in_queue* with the posttroll
+    *publisher*."""
+    while True:
+        msg = await in_queue.get()
+        publisher.send(str(msg))
@@ -1,14 +1,32 @@
 """Classes for handling area gathering for Trollflow based Trollduction"""
 
+import heapq
+import itertools
 import logging
-import Queue
+import six.moves.queue as queue
 from threading import Thread
 import time
 import datetime as dt
 
+import numpy as np
 from posttroll import message
 
-from trollduction.collectors import region_collector
+from trollflow_sat import footprints, utils
+from trollflow_sat.footprints import get_area_bbox, get_lonlat_bbox
+
+_lazy = utils.lazy_attributes(
+    globals(),
+    {"region_collector": ("trollduction.collectors.region_collector", None)})
+__getattr__ = _lazy
+
+# Size of the region index grid cells in degrees
+DEFAULT_CELL_SIZE = 10.
+
+# Maximum number of queued messages handled in one batch
+DEFAULT_BATCH_SIZE = 100
+
+# Bounding box of the whole globe
+GLOBE_BBOX = (-180., -90., 180., 90.)
 
 
 class AreaGathererContainer(object):
@@ -20,7 +38,7 @@ class AreaGathererContainer(object):
     def __init__(self, config):
         self.gatherer = None
         self._input_queue = None
-        self.output_queue = Queue.Queue()
+        self.output_queue = queue.Queue()
         self.thread = None
 
         # Create a AreaGatherer instance
@@ -100,20 +118,109 @@ class AreaGatherer(Thread):
         else:
             self._metadata = {}
 
+        self._tle_file = config.get("tle_file", None)
+        self._batch_size = config.get("batch_size", DEFAULT_BATCH_SIZE)
+
         self._platform_names = config["platform_names"]
-        self._regions = config["regions"]
+        self._regions = [utils.get_area_definition(region) for region in config["regions"]]
 
         self.collectors = {}
         self.create_collectors()
 
+        # Index of the region bounding boxes, the indexed items are the
+        # positions of the regions in the collector lists
+        self._index = RegionIndex(config.get("index_cell_size",
+                                             DEFAULT_CELL_SIZE))
+        for i, region in enumerate(self._regions):
+            self._index.insert(i, get_area_bbox(region))
+
+        # Heap of (timeout, counter, collector) tuples.  The counter
+        # keeps the ordering defined for equal timeouts
+        self._timeouts = []
+        self._counter = itertools.count()
+
     def create_collectors(self):
         """Create area collectors for each platform."""
         for platform in self._platform_names:
             self.collectors[platform] = \
-                [region_collector.RegionCollector(region,
-                                                  self._timeliness,
-                                                  self._duration) for
-                 region in self._regions]
+                [_lazy("region_collector").RegionCollector(
+                    region, self.timeliness, self._duration)
+                 for region in self._regions]
+
+    def get_collectors(self, metadata):
+        """Get the collectors of the platform the granule in *metadata*
+        might intersect with.  The granule footprint is computed only
+        once and matched against the region bounding boxes.  If the
+        footprint can't be computed, all the collectors of the platform
+        are returned."""
+        collectors = self.collectors.get(metadata.get("platform_name"), [])
+        if not collectors:
+            self.logger.debug("No collectors for platform %s",
+                              str(metadata.get("platform_name")))
+            return []
+        bbox = self._get_granule_bbox(metadata)
+        if bbox is None:
+            return collectors
+        selected = [collectors[i] for i in self._index.query(bbox)]
+        self.logger.debug("Granule offered to %d/%d regions",
+                          len(selected), len(collectors))
+        return selected
+
+    def _get_granule_bbox(self, metadata):
+        """Get the bounding box of the granule footprint."""
+        try:
+            lons, lats = footprints.get_footprint(
+                metadata["platform_name"], metadata["start_time"],
+                metadata["end_time"], instrument=metadata.get("sensor"),
+                tle_file=self._tle_file)
+        except Exception as err:
+            self.logger.debug("Can't compute granule footprint: %s",
+                              str(err))
+            return None
+        return get_lonlat_bbox(lons, lats)
+
+    def _compute_footprints(self, metadatas):
+        """Compute the footprints of the granules in *metadatas* in one
+        go for each platform and instrument.  The cached footprints are
+        also used for the coverage checks of the resampler."""
+        granules = {}
+        for metadata in metadatas:
+            try:
+                key = (metadata["platform_name"],
+                       str(metadata.get("sensor")))
+                granules.setdefault(key, [metadata["sensor"], []])[1].append(
+                    (metadata["start_time"], metadata["end_time"]))
+            except KeyError:
+                continue
+        for (platform_name, _), (instrument, times) in granules.items():
+            try:
+                footprints.get_footprints(platform_name, times,
+                                          instrument=instrument,
+                                          tle_file=self._tle_file)
+            except Exception as err:
+                self.logger.debug("Can't compute granule footprints: %s",
+                                  str(err))
+
+    def _get_messages(self):
+        """Get the next message from the queue, waiting until the next
+        timeout, and the messages already queued after it."""
+        messages = [self.input_queue.get(True, self._get_wait_time())]
+        while len(messages) < self._batch_size:
+            try:
+                messages.append(self.input_queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def _process(self, metadata):
+        """Offer the granule in *metadata* to the collectors."""
+        for collector in self.get_collectors(metadata):
+            timeout = collector.timeout
+            res = collector(metadata)
+            if res:
+                self.terminator(res)
+            else:
+                self._schedule_timeout(collector, timeout)
 
     @property
     def loop(self):
@@ -122,24 +229,34 @@ class AreaGatherer(Thread):
 
     def _check_timeouts(self):
         """Check if timeouts have happened."""
-        for platform in self._platforms:
-            timeouts = [(collector, collector.timeout)
-                        for collector in self.collectors[platform]
-                        if collector.timeout is not None]
-            if timeouts:
-                next_timeout = min(timeouts, key=(lambda x: x[1]))
-                if (next_timeout[1] and
-                        (next_timeout[1] < dt.datetime.utcnow())):
-                    self.logger.warning("Timeout detected, terminating "
-                                        "collector")
-                    self.logger.debug("Area: %s, timeout: %s",
-                                      next_timeout[0].region,
-                                      str(next_timeout[1]))
-                    self.terminator(next_timeout[0].finish())
-                else:
-                    self.logger.debug("Waiting %s seconds until timeout",
-                                      str(total_seconds(next_timeout[1] -
-                                                        dt.datetime.utcnow())))
+        now = dt.datetime.utcnow()
+        while self._timeouts and self._timeouts[0][0] < now:
+            timeout, _, collector = heapq.heappop(self._timeouts)
+            # Skip collectors that have finished or been rescheduled
+            if collector.timeout != timeout:
+                continue
+            self.logger.warning("Timeout detected, terminating "
+                                "collector")
+            self.logger.debug("Area: %s, timeout: %s",
+                              collector.region, str(timeout))
+            self.terminator(collector.finish())
+
+    def _schedule_timeout(self, collector, timeout):
+        """Schedule checking the timeout of *collector* if it has
+        changed from *timeout*."""
+        if collector.timeout is not None and collector.timeout != timeout:
+            heapq.heappush(self._timeouts,
+                           (collector.timeout, next(self._counter),
+                            collector))
+
+    def _get_wait_time(self):
+        """Get the time to wait for new messages before the next
+        timeout.  Wait at most one second to notice stopping."""
+        if not self._timeouts:
+            return 1.
+        wait = total_seconds(self._timeouts[0][0] - dt.datetime.utcnow())
+        self.logger.debug("Waiting %s seconds until timeout", str(wait))
+        return min(max(wait, 0.), 1.)
 
     def terminator(self, metadata):
         """Dummy terminator function.
@@ -186,23 +303,24 @@ class AreaGatherer(Thread):
                 self._check_timeouts()
 
                 try:
-                    # Get new message from the queue
-                    msg = self.input_queue.get(True, 1)
-                    metadata = msg.data
-                    # Replace aliases
-                    for key, aliases in self._aliases.items():
-                        if key in metadata:
-                            metadata[key] = aliases.get(metadata[key],
-                                                        metadata[key])
-                    for collector in self.collectors["platform_name"]:
-                        res = collector(metadata)
-                        if res:
-                            msg = self.terminator(res)
-                            self.output_queue.put(msg)
+                    # Get new messages from the queue, waiting until
+                    # the next timeout
+                    messages = self._get_messages()
+                    for msg in messages:
+                        metadata = msg.data
+                        # Replace aliases
+                        for key, aliases in self._aliases.items():
+                            if key in metadata:
+                                metadata[key] = aliases.get(metadata[key],
+                                                            metadata[key])
+                    # Footprints of all the queued granules at once
+                    self._compute_footprints([msg.data for msg in messages])
+                    for msg in messages:
+                        self._process(msg.data)
                 except KeyboardInterrupt:
                     self.stop()
                     continue
-                except Queue.Empty:
+                except queue.Empty:
                     continue
             else:
                 time.sleep(1)
@@ -219,3 +337,74 @@ def total_seconds(tdef):
     """
     return ((tdef.microseconds +
              (tdef.seconds + tdef.days * 24 * 3600) * 10 ** 6) / 10.0 ** 6)
+
+
+class RegionIndex(object):
+
+    """Grid index of longitude/latitude bounding boxes.  Each box is
+    stored in the grid cells it overlaps, so finding the boxes
+    intersecting a given box requires only looking at the cells
+    covered by it.  Bounding boxes are (lon_min, lat_min, lon_max,
+    lat_max) tuples, and lon_min > lon_max for boxes crossing the
+    antimeridian.  Items inserted without a bounding box (None) are
+    taken to cover the whole globe."""
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self._cells = {}
+        self._boxes = {}
+        self._order = {}
+
+    def insert(self, item, bbox):
+        """Add *item* having bounding box *bbox* to the index."""
+        if bbox is None:
+            bbox = GLOBE_BBOX
+        self._order[item] = len(self._order)
+        self._boxes[item] = _split_bbox(bbox)
+        for cell in self._get_cells(bbox):
+            self._cells.setdefault(cell, set()).add(item)
+
+    def query(self, bbox):
+        """Get the items intersecting with *bbox* in insertion order."""
+        candidates = set()
+        for cell in self._get_cells(bbox):
+            candidates.update(self._cells.get(cell, ()))
+        boxes = _split_bbox(bbox)
+        items = [item for item in candidates if
+                 _intersects(self._boxes[item], boxes)]
+        return sorted(items, key=self._order.get)
+
+    def _get_cells(self, bbox):
+        """Get the grid cells covered by *bbox*."""
+        cells = []
+        for lon_min, lat_min, lon_max, lat_max in _split_bbox(bbox):
+            for i in range(self._cell(lon_min), self._cell(lon_max) + 1):
+                for j in range(self._cell(lat_min), self._cell(lat_max) + 1):
+                    cells.append((i, j))
+        return cells
+
+    def _cell(self, val):
+        """Get the cell number of *val*."""
+        return int(np.floor(val / self.cell_size))
+
+
+def _split_bbox(bbox):
+    """Split *bbox* crossing the antimeridian into two."""
+    lon_min, lat_min, lon_max, lat_max = bbox
+    if lon_min > lon_max:
+        return [(lon_min, lat_min, 180., lat_max),
+                (-180., lat_min, lon_max, lat_max)]
+    return [bbox]
+
+
+def _intersects(boxes1, boxes2):
+    """Check if any of the boxes in *boxes1* intersect any of the boxes
+    in *boxes2*."""
+    for lon_min1, lat_min1, lon_max1, lat_max1 in boxes1:
+        for lon_min2, lat_min2, lon_max2, lat_max2 in boxes2:
+            if (lon_min1 <= lon_max2 and lon_min2 <= lon_max1 and
+                    lat_min1 <= lat_max2 and lat_min2 <= lat_max1):
+                return True
+    return False
+
+
@@ -1,13 +1,36 @@
 """Classes for handling file fetching for Trollflow based Trollduction"""
 
+import bz2
+import ftplib
+import gzip
+import hashlib
 import logging
 import os
+import shutil
 import socket
 import time
-from tempfile import gettempdir
-from urlparse import urlparse, urlsplit
+import uuid
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from tempfile import gettempdir, mkstemp
+from threading import BoundedSemaphore, Lock
 
 import netifaces
+from six.moves import http_client
+from six.moves.urllib.parse import unquote, urlparse, urlsplit
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 from posttroll.message import Message
 from trollflow.utils import acquire_lock, release_lock
@@ -15,6 +38,43 @@ from trollflow.workflow_component import AbstractWorkflowComponent
 
 logger = logging.getLogger(__name__)
 
+# Seconds to keep the resolved host addresses
+DNS_TTL = 300
+# Seconds to keep the local IP addresses, and the minimum interval
+# between refreshes due to unknown addresses
+LOCAL_IPS_TTL = 300
+LOCAL_IPS_MIN_REFRESH = 10
+
+# Maximum number of simultaneous connections to one host
+DEFAULT_MAX_CONNECTIONS = 4
+# Number of files fetched concurrently
+DEFAULT_FETCH_WORKERS = 8
+# Seconds to wait for remote hosts
+DEFAULT_TIMEOUT = 60
+
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds between the scans of the fetch cache size, to see the files
+# added by the other processes sharing the cache
+CACHE_SCAN_INTERVAL = 60
+
+# Schemes that are always downloaded
+DOWNLOAD_SCHEMES = ("http", "https", "ftp")
+
+# Errors of connections closed by the remote host, for example idle
+# keep-alive connections
+try:
+    CONNECTION_ERRORS = (ConnectionError, )
+except NameError:
+    CONNECTION_ERRORS = (socket.error, )
+CONNECTION_ERRORS += (http_client.HTTPException, ftplib.error_temp, EOFError)
+
+# File openers for the supported compressions
+DECOMPRESSORS = {".bz2": bz2.BZ2File,
+                 ".gz": gzip.GzipFile}
+if lzma is not None:
+    DECOMPRESSORS[".xz"] = lzma.LZMAFile
+
 
 def get_local_ips():
     inet_addrs = [netifaces.ifaddresses(iface).get(netifaces.AF_INET)
@@ -27,6 +87,78 @@ def get_local_ips():
     return ips
 
 
+class Resolver(object):
+
+    """Resolve hostnames to IP addresses, caching the results (also
+    failed ones) for *ttl* seconds."""
+
+    def __init__(self, ttl=DNS_TTL):
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = Lock()
+
+    def gethostbyname(self, hostname):
+        """Get the IP address of *hostname*.  Raises socket.gaierror
+        for unknown hosts like socket.gethostbyname()."""
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(hostname)
+        if cached is None or cached[0] < now:
+            try:
+                cached = (now + self.ttl, socket.gethostbyname(hostname),
+                          None)
+            except socket.gaierror as err:
+                cached = (now + self.ttl, None, err)
+            with self._lock:
+                self._cache[hostname] = cached
+        if cached[2] is not None:
+            raise cached[2]
+        return cached[1]
+
+    def clear(self):
+        """Forget the resolved addresses."""
+        with self._lock:
+            self._cache.clear()
+
+
+class LocalAddresses(object):
+
+    """Cached set of the IP addresses of the local interfaces.  The set
+    is refreshed after *ttl* seconds, or when an address not in the set
+    is checked, but not more often than every *min_refresh* seconds."""
+
+    def __init__(self, ttl=LOCAL_IPS_TTL, min_refresh=LOCAL_IPS_MIN_REFRESH):
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self._ips = frozenset()
+        self._updated = None
+        self._lock = Lock()
+
+    def __contains__(self, ip_addr):
+        now = time.time()
+        with self._lock:
+            if self._updated is None or self._updated + self.ttl < now or \
+                    (ip_addr not in self._ips and
+                     self._updated + self.min_refresh < now):
+                self._ips = frozenset(get_local_ips())
+                self._updated = now
+            return ip_addr in self._ips
+
+    def clear(self):
+        """Force refreshing the addresses on next check."""
+        with self._lock:
+            self._updated = None
+
+
+RESOLVER = Resolver()
+LOCAL_IPS = LocalAddresses()
+
+
+def is_local_ip(ip_addr):
+    """Check if *ip_addr* belongs to this host."""
+    return ip_addr in LOCAL_IPS
+
+
 def is_uri_on_server(uri, strict=False):
     """Check if the *uri* is designating a place on the server.
 
@@ -35,7 +167,7 @@ def is_uri_on_server(uri, strict=False):
     """
     url = urlparse(uri)
     try:
-        url_ip = socket.gethostbyname(url.hostname)
+        url_ip = RESOLVER.gethostbyname(url.hostname)
     except (socket.gaierror, TypeError):
         if strict:
             return False
@@ -51,7 +183,7 @@ def is_uri_on_server(uri, strict=False):
                 os.stat(url.path)
             except OSError:
                 return False
-        elif url_ip not in get_local_ips():
+        elif not is_local_ip(url_ip):
             return False
         else:
             try:
@@ -71,9 +203,9 @@ def check_uri(uri):
     url = urlparse(uri)
     try:
         if url.hostname:
-            url_ip = socket.gethostbyname(url.hostname)
+            url_ip = RESOLVER.gethostbyname(url.hostname)
 
-            if url_ip not in get_local_ips():
+            if not is_local_ip(url_ip):
                 try:
                     os.stat(url.path)
                 except OSError:
@@ -92,6 +224,8 @@ class Fetcher(AbstractWorkflowComponent):
 
     def __init__(self):
         super(Fetcher, self).__init__()
+        self.pool = None
+        self.cache = None
 
     def pre_invoke(self):
         """Pre-invoke."""
@@ -108,9 +242,34 @@ class Fetcher(AbstractWorkflowComponent):
                          "worker: %s", str(context["prev_lock"]))
             acquire_lock(context["prev_lock"])
 
+        try:
+            self._process(context)
+        finally:
+            # After all the items have been processed, or fetching has
+            # failed, release the lock for the previous step
+            logger.debug("Fetcher releases lock of previous worker")
+            release_lock(context["prev_lock"])
+
+    def _process(self, context):
+        """Fetch the files of the message in *context*."""
+        if self.pool is None:
+            self.pool = ConnectionPool(
+                max_connections=context.get("max_connections",
+                                            DEFAULT_MAX_CONNECTIONS),
+                timeout=context.get("timeout", DEFAULT_TIMEOUT))
+
+        if self.cache is None and context.get("cache_dir") is not None:
+            self.cache = FetchCache(context["cache_dir"],
+                                    max_size=context.get("cache_max_size"))
+
         logger.info("Fetching files.")
-        message = fetch_files(context["content"], context.get("destination",
-                                                              gettempdir()))
+        message = fetch_files(context["content"],
+                              context.get("destination", gettempdir()),
+                              pool=self.pool,
+                              workers=context.get("fetch_workers",
+                                                  DEFAULT_FETCH_WORKERS),
+                              cache=self.cache,
+                              decompress=context.get("decompress", False))
         context["output_queue"].put(message)
 
         if self.use_lock:
@@ -126,39 +285,551 @@ class Fetcher(AbstractWorkflowComponent):
             acquire_lock(context["lock"])
             release_lock(context["lock"])
 
-        # After all the items have been processed, release the lock for
-        # the previous step
-        logger.debug("Fetcher releases lock of previous worker")
-        release_lock(context["prev_lock"])
-
     def post_invoke(self):
         """Post-invoke"""
         pass
 
 
-def fetch_files(message, destination):
-    """Fetch files from the network"""
+def fetch_files(message, destination, pool=None,
+                workers=DEFAULT_FETCH_WORKERS, cache=None,
+                decompress=False):
+    """Fetch files from the network.  Remote files are fetched
+    concurrently with *workers* threads, through the *cache* if
+    given.  If *decompress* is True, compressed files are
+    decompressed to *destination* in the same threads."""
     new_message = Message(rawstr=str(message))
-    if new_message.type == "dataset":
-        for dset in new_message.data["dataset"]:
-            dset["uri"] = fetch_file(dset["uri"], destination)
-    elif new_message.type == "collection":
-        for col in new_message.data['collection']:
+    items = get_message_items(new_message)
+
+    if pool is None:
+        pool = POOL
+    if workers > 1 and len(items) > 1:
+        threads = ThreadPool(min(workers, len(items)))
+        try:
+            paths = threads.map(
+                lambda item: _fetch_item(item, destination, pool, cache,
+                                         decompress),
+                items)
+        finally:
+            threads.close()
+            threads.join()
+    else:
+        paths = [_fetch_item(item, destination, pool, cache, decompress)
+                 for item in items]
+    for item, path in zip(items, paths):
+        if "uid" in item and \
+                os.path.basename(path) != os.path.basename(item["uri"]):
+            item["uid"] = os.path.basename(path)
+        item["uri"] = path
+
+    return new_message
+
+
+def get_message_items(message):
+    """Get the data items describing the files in *message*."""
+    if message.type == "dataset":
+        return message.data["dataset"]
+    if message.type == "collection":
+        items = []
+        for col in message.data['collection']:
             if 'dataset' in col:
-                for dset in col['dataset']:
-                    dset["uri"] = fetch_file(dset["uri"], destination)
+                items += col['dataset']
             else:
-                col["uri"] = fetch_file(col["uri"], destination)
+                items.append(col)
+        return items
+    return [message.data]
+
+
+def _fetch_item(item, destination, pool, cache, decompress=False):
+    """Fetch, and optionally decompress, the file described by message
+    data *item*."""
+    key = get_cache_key(item)
+    path = fetch_file(item["uri"], destination, pool=pool, cache=cache,
+                      key=key)
+    if decompress and is_compressed(path):
+        path = decompress_file(path, destination, cache=cache, key=key)
+    return path
+
+
+def is_compressed(path):
+    """Check if *path* is a file compressed in a supported format."""
+    return os.path.splitext(path)[1] in DECOMPRESSORS
+
+
+def decompress_file(path, destination, cache=None, key=None):
+    """Decompress *path* to *destination* directory and return the
+    pathname of the decompressed file.  The data is streamed in chunks,
+    and written to the final file name atomically.  If a *cache* is
+    given, the decompressed file is stored there with *key*, and if
+    *destination* is None, the path in the cache is returned."""
+    base, ext = os.path.splitext(os.path.basename(path))
+    out_path = None
+    if destination is not None:
+        out_path = os.path.join(destination, base)
+
+    def _decompress(directory, dst):
+        fid, tmp_path = mkstemp(dir=directory, prefix="." + base,
+                                suffix=".part")
+        try:
+            with os.fdopen(fid, "wb") as out_file:
+                with DECOMPRESSORS[ext](path, "rb") as in_file:
+                    shutil.copyfileobj(in_file, out_file, CHUNK_SIZE)
+            os.rename(tmp_path, dst)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        logger.debug("Decompressed %s to %s", path, dst)
+
+    if cache is None:
+        _decompress(destination, out_path)
+        return out_path
+    if key is None:
+        key = path
+    return cache.get_or_create("decompressed:" + key, _decompress,
+                               dst=out_path)
+
+
+def fetch_file(uri, destination, pool=None, cache=None, key=None):
+    """Fetch a single file into `destination` and return its pathname.
+    Files on this host are not copied, except when the *uri* is served
+    over HTTP or FTP and the path doesn't refer to the file system.
+    If a *cache* is given, downloaded files are taken from there and
+    identified by *key*."""
+    if urlparse(uri).scheme not in DOWNLOAD_SCHEMES:
+        try:
+            return check_uri(uri)
+        except IOError:
+            pass
+    if cache is not None:
+        return cache.fetch(uri, destination, key=key, pool=pool)
+    return download(uri, destination, pool=pool)
+
+
+def get_cache_key(item):
+    """Get the key identifying the file described by message data
+    *item* in the fetch cache."""
+    return item.get("checksum") or item.get("uid") or item["uri"]
+
+
+class FetchCache(object):
+
+    """Content-addressed cache of fetched files shared between
+    processes.  Files are stored by the hash of their key, and linked
+    to the destination directories of the users.  Files are written
+    atomically, so reading needs no locking.  When the total size of
+    the cache exceeds *max_size* bytes, the least recently used files
+    are removed."""
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Size of the cache at the last scan, plus the files added since
+        # by this process
+        self._size = None
+        self._scanned = None
+        self._lock = Lock()
+
+    def get_path(self, key):
+        """Get the path of the file identified by *key* in the cache."""
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def get(self, key):
+        """Get the cached file identified by *key*, or None if it isn't
+        in the cache.  The access time used for eviction is updated."""
+        path = self.get_path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def fetch(self, uri, destination, key=None, pool=None):
+        """Get the file *uri* to *destination* through the cache, and
+        return its pathname.  If *destination* is None, the file is
+        only cached and the path in the cache is returned."""
+        if key is None:
+            key = uri
+        if destination is not None:
+            destination = os.path.join(
+                destination, os.path.basename(unquote(urlparse(uri).path)))
+        return self.get_or_create(
+            key, lambda directory, path: download(uri, directory, pool=pool,
+                                                  path=path),
+            dst=destination)
+
+    def get_or_create(self, key, create, dst=None):
+        """Get the cached file identified by *key*.  If the file isn't
+        cached, it is created by calling *create(directory, path)*,
+        which has to write the file atomically to *path* using
+        *directory* for temporary files.  If *dst* is given, the file
+        is linked there and *dst* is returned.  A file removed by
+        another process before it is linked is created again."""
+        cached = self.get(key)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+            logger.debug("Using cached %s", key)
+        else:
+            cached = self._create(key, create)
+
+        if dst is not None:
+            try:
+                link(cached, dst)
+            except (IOError, OSError):
+                if os.path.exists(cached):
+                    raise
+                logger.debug("%s was evicted before use, creating again",
+                             key)
+                cached = self._create(key, create)
+                link(cached, dst)
+        # The file just used is kept even if it exceeds the limit alone
+        self.evict(keep=cached)
+        return cached if dst is None else dst
+
+    def _create(self, key, create):
+        """Create the file identified by *key* with *create*."""
+        with self._lock:
+            self.misses += 1
+        path = self.get_path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        create(directory, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += os.stat(path).st_size
+        return path
+
+    def evict(self, keep=None):
+        """Remove the least recently used files, other than *keep*,
+        until the cache size is below the limit.  The cache directory
+        is scanned when the size of the last scan and the files added
+        since exceeds the limit, or when the last scan is older than
+        CACHE_SCAN_INTERVAL seconds, as the other processes sharing the
+        cache add files too."""
+        if self.max_size is None:
+            return
+        with self._lock:
+            now = time.time()
+            if self._size is not None and self._size <= self.max_size and \
+                    now - self._scanned < CACHE_SCAN_INTERVAL:
+                return
+            self._scanned = now
+            files = []
+            total_size = 0
+            for root, _, fnames in os.walk(self.cache_dir):
+                for fname in fnames:
+                    if fname.endswith(".part"):
+                        continue
+                    path = os.path.join(root, fname)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+                    total_size += stat.st_size
+            files.sort()
+            for _, size, path in files:
+                if total_size <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+                logger.debug("Evicted %s from the fetch cache", path)
+            self._size = total_size
+
+
+class Prefetcher(object):
+
+    """Fetch files in the background as soon as their messages arrive.
+    Files on this host are read to the page cache.  Remote files are
+    downloaded to the fetch cache in *cache_dir*, where the Fetcher
+    using the same cache finds them later.  Without a cache, or with
+    *mode* "page_cache", only local files are handled.  If *decompress*
+    is True, compressed files are also decompressed to the cache, so
+    the decompression overlaps with the gathering and the Fetcher
+    decompressing the same files finds the results there."""
+
+    def __init__(self, mode="fetch", cache_dir=None, cache_max_size=None,
+                 workers=DEFAULT_FETCH_WORKERS,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 timeout=DEFAULT_TIMEOUT, decompress=False):
+        self.mode = mode
+        self.decompress = decompress
+        self.cache = None
+        if mode == "fetch" and cache_dir is not None:
+            self.cache = FetchCache(cache_dir, max_size=cache_max_size)
+        self.pool = ConnectionPool(max_connections=max_connections,
+                                   timeout=timeout)
+        self._threads = ThreadPool(workers)
+        self._pending = []
+
+    def submit(self, message):
+        """Start prefetching the file(s) in *message*."""
+        self._pending = [res for res in self._pending if not res.ready()]
+        for item in get_message_items(message):
+            self._pending.append(
+                self._threads.apply_async(self._prefetch, (item, )))
+
+    def wait(self):
+        """Wait until the submitted files have been prefetched."""
+        for res in self._pending:
+            res.wait()
+        self._pending = []
+
+    def _prefetch(self, item):
+        """Prefetch the file described by message data *item*."""
+        uri = item["uri"]
+        key = get_cache_key(item)
+        try:
+            path = None
+            if urlparse(uri).scheme not in DOWNLOAD_SCHEMES:
+                try:
+                    path = check_uri(uri)
+                    warm_page_cache(path)
+                except IOError:
+                    pass
+            if self.cache is None:
+                return
+            if path is None:
+                path = self.cache.fetch(uri, None, key=key, pool=self.pool)
+            if self.decompress and is_compressed(path):
+                decompress_file(path, None, cache=self.cache, key=key)
+        except Exception as err:
+            logger.warning("Prefetching %s failed: %s", uri, str(err))
+
+    def close(self):
+        """Stop prefetching and close the connections."""
+        self._threads.terminate()
+        self._threads.join()
+        self.pool.close()
+
+
+def warm_page_cache(path):
+    """Get the contents of *path* to the page cache of the OS."""
+    if hasattr(os, "posix_fadvise"):
+        fid = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fid, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fid)
     else:
-        new_message.data["uri"] = fetch_file(new_message.data["uri"],
-                                             destination)
-    return new_message
+        with open(path, "rb") as fid:
+            while fid.read(CHUNK_SIZE):
+                pass
+
+
+def link(src, dst):
+    """Hardlink *src* to *dst*, replacing *dst* atomically.  Copy the
+    file if linking isn't possible, eg. across file systems."""
+    tmp_path = "%s.%s.part" % (dst, uuid.uuid4().hex)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.rename(tmp_path, dst)
+    return dst
 
 
-def fetch_file(uri, destination):
-    """Fetch a single file into `destination` and return its pathname."""
+def download(uri, destination, pool=None, path=None):
+    """Download *uri* to *destination* directory and return the local
+    pathname.  The file is named as in the *uri*, unless *path* is
+    given.  The file is first written to a temporary file in
+    *destination* and renamed when complete, so no partial files are
+    ever visible."""
+    if pool is None:
+        pool = POOL
+    url = urlparse(uri)
+    if path is None:
+        path = os.path.join(destination,
+                            os.path.basename(unquote(url.path)))
+    fid, tmp_path = mkstemp(dir=destination,
+                            prefix="." + os.path.basename(path),
+                            suffix=".part")
     try:
-        return check_uri(uri)
-    except IOError:
-        del destination
-        raise NotImplementedError("Don't know how to fetch non local files")
+        with os.fdopen(fid, "wb") as fileobj:
+            pool.fetch(url, fileobj)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    logger.debug("Fetched %s to %s", uri, path)
+
+    return path
+
+
+class ConnectionPool(object):
+
+    """Pool of reusable connections to remote hosts.  At most
+    *max_connections* connections per host are used at the same time,
+    others wait for a free one."""
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 timeout=DEFAULT_TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._semaphores = {}
+        self._idle = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def connection(self, url, new=False):
+        """Get a connection for *url*, returned to the pool after use.
+        Connections that failed are closed.  If *new* is True, an idle
+        connection isn't reused."""
+        key = (url.scheme, url.netloc)
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                key, BoundedSemaphore(self.max_connections))
+        with semaphore:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                conn = idle.pop() if idle and not new else None
+            if conn is None:
+                conn = create_connection(url, timeout=self.timeout)
+            try:
+                yield conn
+            except Exception:
+                conn.close()
+                raise
+            if conn.reusable:
+                with self._lock:
+                    self._idle[key].append(conn)
+            else:
+                conn.close()
+
+    def fetch(self, url, fileobj):
+        """Write the file at *url* to *fileobj* using a pooled
+        connection.  Idle connections may have been closed by the remote
+        host, so on connection errors the connection is dropped and the
+        file is fetched once more with a new connection."""
+        start = fileobj.tell()
+        try:
+            with self.connection(url) as conn:
+                conn.fetch(url, fileobj)
+            return
+        except CONNECTION_ERRORS as err:
+            logger.debug("Reconnecting to %s after error: %s", url.netloc,
+                         str(err))
+        fileobj.seek(start)
+        fileobj.truncate()
+        with self.connection(url, new=True) as conn:
+            conn.fetch(url, fileobj)
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def create_connection(url, timeout=DEFAULT_TIMEOUT):
+    """Create a connection suitable for fetching *url*."""
+    if url.scheme in ("http", "https"):
+        return HTTPConnection(url, timeout=timeout)
+    if url.scheme == "ftp":
+        return FTPConnection(url, timeout=timeout)
+    if url.scheme in ("ssh", "scp", "sftp"):
+        if paramiko is None:
+            raise NotImplementedError("Paramiko is needed for fetching "
+                                      "files over SSH")
+        return SFTPConnection(url, timeout=timeout)
+    raise NotImplementedError("Don't know how to fetch %s files" %
+                              url.scheme)
+
+
+class HTTPConnection(object):
+
+    """Connection for fetching files over HTTP(S)."""
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+        if url.scheme == "https":
+            self._conn = http_client.HTTPSConnection(url.hostname, url.port,
+                                                     timeout=timeout)
+        else:
+            self._conn = http_client.HTTPConnection(url.hostname, url.port,
+                                                    timeout=timeout)
+        self.reusable = True
+
+    def fetch(self, url, fileobj):
+        """Write the file at *url* to *fileobj*."""
+        path = url.path
+        if url.query:
+            path += "?" + url.query
+        self._conn.request("GET", path)
+        resp = self._conn.getresponse()
+        if resp.status != 200:
+            resp.read()
+            raise IOError("Failed to fetch %s: %d %s" %
+                          (url.geturl(), resp.status, resp.reason))
+        shutil.copyfileobj(resp, fileobj, CHUNK_SIZE)
+        self.reusable = not resp.will_close
+
+    def close(self):
+        """Close the connection."""
+        self._conn.close()
+
+
+class FTPConnection(object):
+
+    """Connection for fetching files over FTP."""
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+        self._conn = ftplib.FTP(timeout=timeout)
+        self._conn.connect(url.hostname, url.port or ftplib.FTP_PORT)
+        self._conn.login(url.username or "anonymous", url.password or "")
+        self.reusable = True
+
+    def fetch(self, url, fileobj):
+        """Write the file at *url* to *fileobj*."""
+        try:
+            self._conn.retrbinary("RETR " + unquote(url.path),
+                                  fileobj.write, CHUNK_SIZE)
+        except ftplib.error_perm as err:
+            raise IOError("Failed to fetch %s: %s" % (url.geturl(),
+                                                      str(err)))
+
+    def close(self):
+        """Close the connection."""
+        try:
+            self._conn.quit()
+        except (ftplib.Error, socket.error, EOFError):
+            self._conn.close()
+
+
+class SFTPConnection(object):
+
+    """Connection for fetching files over SFTP.  Authentication is
+    done with the keys available for the user."""
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+        self._client = paramiko.SSHClient()
+        self._client.load_system_host_keys()
+        self._client.connect(url.hostname, port=url.port or 22,
+                             username=url.username, password=url.password,
+                             timeout=timeout)
+        self._sftp = self._client.open_sftp()
+        self.reusable = True
+
+    def fetch(self, url, fileobj):
+        """Write the file at *url* to *fileobj*."""
+        self._sftp.getfo(unquote(url.path), fileobj)
+
+    def close(self):
+        """Close the connection."""
+        self._sftp.close()
+        self._client.close()
+
+
+POOL = ConnectionPool()
@@ -0,0 +1,279 @@
+"""Granule footprints computed from orbital elements"""
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from trollflow_sat.utils import lazy_attributes
+
+LOGGER = logging.getLogger(__name__)
+
+_lazy = lazy_attributes(globals(),
+                        {"Orbital": ("pyorbital.orbital", "Orbital"),
+                         "Pass": ("trollsched.satpass", "Pass"),
+                         "SphPolygon": ("pyresample.spherical",
+                                        "SphPolygon"),
+                         "AreaDefBoundary": ("pyresample.boundary",
+                                             "AreaDefBoundary")},
+                        optional=("Orbital", "Pass"))
+__getattr__ = _lazy
+
+EARTH_RADIUS = 6371.
+
+# Maximum scan angle from nadir in degrees for each instrument
+SCAN_ANGLES = {'avhrr': 55.37,
+               'avhrr/3': 55.37,
+               'avhrr-3': 55.37,
+               'viirs': 56.28,
+               'modis': 55.,
+               'mersi-2': 55.08,
+               'mhs': 49.44,
+               'amsu-a': 48.33,
+               'amsu-b': 48.95,
+               'atms': 52.73,
+               'hirs/4': 49.5}
+DEFAULT_SCAN_ANGLE = 55.37
+
+# Number of points computed along the track of each granule
+NUM_TRACK_POINTS = 12
+
+# Number of points along each edge of the areas for the coverage
+AREA_BOUNDARY_POINTS = 100
+
+# Number of footprints and overpasses to keep in memory
+CACHE_SIZE = 1000
+
+_FOOTPRINTS = OrderedDict()
+_OVERPASSES = OrderedDict()
+_ORBITALS = {}
+
+
+class Footprint(object):
+
+    """Granule footprint given by the closed contour *lons*, *lats*
+    with the area coverage interface of `trollsched.satpass.Pass`."""
+
+    def __init__(self, lons, lats):
+        self.contour_poly = _lazy("SphPolygon")(
+            np.radians(np.vstack((lons, lats)).T))
+
+    def area_coverage(self, area_def):
+        """Get the fraction of *area_def* covered by the footprint."""
+        area_poly = _lazy("AreaDefBoundary")(
+            area_def, frequency=AREA_BOUNDARY_POINTS).contour_poly
+        inter = self.contour_poly.intersection(area_poly)
+        if inter is None:
+            return 0.
+        return inter.area() / area_poly.area()
+
+
+def get_footprints(platform_name, times, instrument=None, tle_file=None):
+    """Get the footprints of the granules of *platform_name* starting
+    and ending at the (start_time, end_time) pairs in *times*.  The
+    orbit is propagated for all the granules at once.  Footprints are
+    returned as closed (lons, lats) contours, and cached per platform
+    and granule times.
+    """
+    keys = [_get_key(platform_name, start_time, end_time, instrument) for
+            start_time, end_time in times]
+    res = {key: _FOOTPRINTS[key] for key in keys if key in _FOOTPRINTS}
+    missing = [key for key in keys if key not in res]
+    if missing:
+        for key, footprint in zip(missing, _compute_footprints(
+                platform_name, [key[1:3] for key in missing],
+                instrument, tle_file)):
+            res[key] = footprint
+            _add_to_cache(_FOOTPRINTS, key, footprint)
+
+    return [res[key] for key in keys]
+
+
+def get_footprint(platform_name, start_time, end_time, instrument=None,
+                  tle_file=None):
+    """Get the footprint of a single granule.  See `get_footprints`."""
+    return get_footprints(platform_name, [(start_time, end_time)],
+                          instrument=instrument, tle_file=tle_file)[0]
+
+
+def get_overpass(platform_name, start_time, end_time, instrument=None):
+    """Get a cached overpass of the granule for the coverage checks.
+    If the footprint of the granule has already been computed, for
+    example in a batch by the area gatherer, it is used as a
+    `Footprint`.  Otherwise a `trollsched.satpass.Pass` is used, or None
+    if pytroll-schedule isn't available."""
+    key = _get_key(platform_name, start_time, end_time, instrument)
+    if key not in _OVERPASSES:
+        if key in _FOOTPRINTS:
+            overpass = Footprint(*_FOOTPRINTS[key])
+        else:
+            Pass = _lazy("Pass")
+            if Pass is None:
+                return None
+            overpass = Pass(platform_name, start_time, end_time,
+                            instrument=key[3])
+        _add_to_cache(_OVERPASSES, key, overpass)
+    return _OVERPASSES[key]
+
+
+def clear_cache():
+    """Clear the cached footprints, overpasses and orbits."""
+    _FOOTPRINTS.clear()
+    _OVERPASSES.clear()
+    _ORBITALS.clear()
+
+
+def _get_key(platform_name, start_time, end_time, instrument):
+    """Get the cache key of a granule.  Of several instruments the
+    first one is used."""
+    if isinstance(instrument, (list, tuple, set)):
+        instrument = list(instrument)[0]
+    return (platform_name, start_time, end_time, instrument)
+
+
+def _add_to_cache(cache, key, val):
+    """Add *val* to *cache*, dropping the oldest item if the cache is
+    full."""
+    cache[key] = val
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def _get_orbital(platform_name, tle_file=None):
+    """Get a cached orbital object for *platform_name*."""
+    key = (platform_name, tle_file)
+    if key not in _ORBITALS:
+        Orbital = _lazy("Orbital")
+        if Orbital is None:
+            raise ImportError("Pyorbital is needed for footprints")
+        _ORBITALS[key] = Orbital(platform_name, tle_file=tle_file)
+    return _ORBITALS[key]
+
+
+def _get_scan_angle(instrument):
+    """Get the maximum scan angle of *instrument*."""
+    if isinstance(instrument, (list, tuple, set)):
+        instrument = list(instrument)[0]
+    if instrument is None:
+        return DEFAULT_SCAN_ANGLE
+    return SCAN_ANGLES.get(instrument.lower(), DEFAULT_SCAN_ANGLE)
+
+
+def _compute_footprints(platform_name, times, instrument=None,
+                        tle_file=None):
+    """Compute the footprints of all the granules in *times*."""
+    orbital = _get_orbital(platform_name, tle_file=tle_file)
+
+    # Time vector covering all the granules, NUM_TRACK_POINTS points
+    # per granule.  One extra point is added to both ends to get the
+    # heading at the ends of the granule
+    fractions = np.arange(-1, NUM_TRACK_POINTS + 1) / \
+        float(NUM_TRACK_POINTS - 1)
+    utc_times = []
+    for start_time, end_time in times:
+        start = np.datetime64(start_time, 'us')
+        duration = np.datetime64(end_time, 'us') - start
+        utc_times.append(start + (fractions * duration.astype(np.float64)
+                                  ).astype('timedelta64[us]'))
+    utc_times = np.concatenate(utc_times)
+
+    lons, lats, alts = orbital.get_lonlatalt(utc_times)
+    shape = (len(times), NUM_TRACK_POINTS + 2)
+    lons = np.radians(lons).reshape(shape)
+    lats = np.radians(lats).reshape(shape)
+    alts = np.asarray(alts).reshape(shape)
+
+    # Heading of the sub-satellite track
+    headings = _get_bearing(lons[:, :-2], lats[:, :-2],
+                            lons[:, 2:], lats[:, 2:])
+    lons, lats, alts = lons[:, 1:-1], lats[:, 1:-1], alts[:, 1:-1]
+
+    # Earth central angle from nadir to the swath edge
+    scan_angle = np.radians(_get_scan_angle(instrument))
+    ratio = np.clip((EARTH_RADIUS + alts) / EARTH_RADIUS *
+                    np.sin(scan_angle), -1., 1.)
+    half_width = np.arcsin(ratio) - scan_angle
+
+    left_lons, left_lats = _get_destination(lons, lats,
+                                            headings - np.pi / 2,
+                                            half_width)
+    right_lons, right_lats = _get_destination(lons, lats,
+                                              headings + np.pi / 2,
+                                              half_width)
+
+    # Closed contours: left edge forward, right edge backward
+    contour_lons = np.degrees(np.hstack((left_lons, right_lons[:, ::-1])))
+    contour_lats = np.degrees(np.hstack((left_lats, right_lats[:, ::-1])))
+    contour_lons = (contour_lons + 180.) % 360. - 180.
+
+    return [(contour_lons[i], contour_lats[i]) for i in range(len(times))]
+
+
+def _get_bearing(lon1, lat1, lon2, lat2):
+    """Get the initial bearing from points 1 to points 2 in radians."""
+    dlon = lon2 - lon1
+    return np.arctan2(np.sin(dlon) * np.cos(lat2),
+                      np.cos(lat1) * np.sin(lat2) -
+                      np.sin(lat1) * np.cos(lat2) * np.cos(dlon))
+
+
+def _get_destination(lon, lat, bearing, distance):
+    """Get the points at angular *distance* from the given points in
+    direction of *bearing*.  All in radians."""
+    dest_lat = np.arcsin(np.sin(lat) * np.cos(distance) +
+                         np.cos(lat) * np.sin(distance) * np.cos(bearing))
+    dest_lon = lon + np.arctan2(
+        np.sin(bearing) * np.sin(distance) * np.cos(lat),
+        np.cos(distance) - np.sin(lat) * np.sin(dest_lat))
+    return dest_lon, dest_lat
+
+
+def get_lonlat_bbox(lons, lats):
+    """Get the bounding box of the closed contour given by *lons* and
+    *lats*.  Contours enclosing a pole extend to the pole and cover all
+    the longitudes, contours crossing the antimeridian have lon_min >
+    lon_max.  Returns None if none of the points are valid."""
+    lons = np.asarray(lons, dtype=np.float64).ravel()
+    lats = np.asarray(lats, dtype=np.float64).ravel()
+    valid = np.isfinite(lons) & np.isfinite(lats)
+    if not valid.any():
+        return None
+    lons, lats = lons[valid], lats[valid]
+    lat_min, lat_max = lats.min(), lats.max()
+
+    # A contour around a pole winds once around the globe
+    dlons = np.diff(np.concatenate((lons, lons[:1])))
+    dlons = (dlons + 180.) % 360. - 180.
+    if abs(dlons.sum()) > 180.:
+        if lats.mean() > 0:
+            lat_max = 90.
+        else:
+            lat_min = -90.
+        return (-180., lat_min, 180., lat_max)
+
+    # The longitude range is the complement of the largest gap between
+    # the longitudes
+    lons = np.sort(lons)
+    gaps = np.diff(np.concatenate((lons, lons[:1] + 360.)))
+    idx = int(np.argmax(gaps))
+    if idx == lons.size - 1:
+        return (lons[0], lat_min, lons[-1], lat_max)
+    return (lons[idx + 1], lat_min, lons[idx], lat_max)
+
+
+def get_area_bbox(area_def, num_samples=50):
+    """Get the longitude/latitude bounding box of *area_def* from
+    *num_samples* points along each of its edges.  Returns None if the
+    edges are outside of the Earth, as for full disk areas."""
+    rows = np.linspace(0, area_def.shape[0] - 1, num_samples)
+    cols = np.linspace(0, area_def.shape[1] - 1, num_samples)
+    first_row, last_row = np.zeros(num_samples), np.full(num_samples,
+                                                        rows[-1])
+    first_col, last_col = np.zeros(num_samples), np.full(num_samples,
+                                                        cols[-1])
+    # Go around the area in order
+    rows = np.concatenate((first_row, rows, last_row, rows[::-1]))
+    cols = np.concatenate((cols, last_col, cols[::-1], first_col))
+    lons, lats = area_def.get_lonlat_from_array_coordinates(
+        cols.round().astype(int), rows.round().astype(int))
+    return get_lonlat_bbox(lons, lats)
@@ -0,0 +1,142 @@
+"""Memory use tracking for Trollflow based Trollduction.
+
+The current resident set size (RSS) of the process, its change since
+the scene was created, and the size of the datasets held by the scene
+are logged with the time slot of the scene after each processing
+stage.  The peak RSS is the peak over the lifetime of the process, so
+it is only logged for reference.  A warning is logged when the current
+RSS exceeds the optional "memory_warning_threshold" given in megabytes
+in the component configuration.
+"""
+
+import logging
+import os
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOGGER = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+
+# Number of time slots whose RSS at the start is remembered
+MAX_SLOTS = 100
+
+# Latest statistics of each stage
+_STATS = {}
+# RSS at the creation of the scene of each time slot
+_START_RSS = OrderedDict()
+_STATS_LOCK = Lock()
+
+
+def get_peak_rss():
+    """Get the peak resident set size of the process in bytes, or None
+    if it isn't available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on Mac, kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def get_rss():
+    """Get the current resident set size of the process in bytes, or
+    None if it isn't available."""
+    try:
+        with open("/proc/self/statm", "r") as fid:
+            pages = int(fid.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, IndexError, ValueError, AttributeError):
+        return None
+
+
+def get_scene_nbytes(scene):
+    """Get the total size of the datasets in *scene* in bytes, or None
+    if the datasets can't be listed.  Lazy datasets are counted by their
+    size when computed."""
+    if scene is None:
+        return 0
+    try:
+        return int(sum(getattr(dset, "nbytes", 0) for dset in scene))
+    except TypeError:
+        return None
+
+
+def get_slot_id(attrs):
+    """Get an identifier of the time slot of the scene *attrs*."""
+    start_time = attrs.get("start_time")
+    if start_time is not None and hasattr(start_time, "strftime"):
+        start_time = start_time.strftime("%Y%m%d_%H%M%S")
+    return "%s_%s" % (attrs.get("platform_name"), start_time)
+
+
+def start(scene=None, slot_id=None):
+    """Remember the current RSS at the creation of *scene*, so that the
+    change of the RSS is reported for it by `track`.  Returns the RSS
+    in bytes."""
+    if slot_id is None and scene is not None:
+        slot_id = get_slot_id(scene.attrs)
+    rss = get_rss()
+    with _STATS_LOCK:
+        _START_RSS.pop(slot_id, None)
+        _START_RSS[slot_id] = rss
+        while len(_START_RSS) > MAX_SLOTS:
+            _START_RSS.popitem(last=False)
+    return rss
+
+
+def track(stage, scene=None, slot_id=None, threshold=None, logger=LOGGER,
+          **extra):
+    """Log the memory use after *stage* of *scene*.  Returns the
+    statistics as a dictionary, with the values in bytes.  The change of
+    the RSS is given since the `start` of the scene, if known.  If the
+    current RSS exceeds *threshold* megabytes, a warning is logged.
+    Additional statistics can be given as keyword arguments."""
+    if slot_id is None and scene is not None:
+        slot_id = get_slot_id(scene.attrs)
+    rss = get_rss()
+    with _STATS_LOCK:
+        start_rss = _START_RSS.get(slot_id)
+    stats = {"stage": stage,
+             "slot": slot_id,
+             "peak_rss": get_peak_rss(),
+             "rss": rss,
+             "rss_delta": (rss - start_rss if None not in (rss, start_rss)
+                           else None),
+             "scene_nbytes": get_scene_nbytes(scene)}
+    stats.update(extra)
+    with _STATS_LOCK:
+        _STATS[stage] = stats
+
+    logger.info("Memory after %s of %s: RSS %s MB (%s MB since the "
+                "start of the scene), scene datasets %s MB, peak RSS "
+                "of the process %s MB", stage, slot_id,
+                _to_mb(rss), _to_mb(stats["rss_delta"], sign=True),
+                _to_mb(stats["scene_nbytes"]), _to_mb(stats["peak_rss"]))
+    if threshold is not None and rss is not None and \
+            rss > threshold * MEGABYTE:
+        logger.warning("RSS %s MB after %s of %s exceeds the "
+                       "threshold of %s MB", _to_mb(rss),
+                       stage, slot_id, str(threshold))
+    return stats
+
+
+def get_stats():
+    """Get the latest memory statistics of each stage."""
+    with _STATS_LOCK:
+        return {stage: stats.copy() for stage, stats in _STATS.items()}
+
+
+def _to_mb(nbytes, sign=False):
+    """Convert *nbytes* to megabytes for logging, with the *sign* if
+    requested."""
+    if nbytes is None:
+        return "-"
+    return ("%+.1f" if sign else "%.1f") % (nbytes / float(MEGABYTE))
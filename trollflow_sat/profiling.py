@@ -0,0 +1,181 @@
+"""Profiling of the processing for Trollflow based Trollduction.
+
+The profiled functions record cProfile statistics, and dask task
+profiles, of their next calls when the profiler is armed, either from
+the "profiling" item of the component configuration::
+
+    profiling:
+      # Number of calls of each profiled function to record
+      items: 3
+      # Directory for the profile files, default: temporary directory
+      output_dir: /tmp/profiles
+      # Arm the profiler again when this signal is received
+      signal: SIGUSR1
+
+or by sending the configured signal to the process.  The signal
+handler can be installed only from the main thread, so the signal is
+used from the configuration of the DataWriter, which is created in the
+main thread.  A signal given in the configuration of a component
+invoked in a worker thread is installed by the next
+`install_signal_handler` call from the main thread.
+"""
+
+import cProfile
+import functools
+import logging
+import os
+import signal
+import threading
+import datetime as dt
+from tempfile import gettempdir
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Profiler(object):
+
+    """Profile the next *items* calls of each profiled function."""
+
+    def __init__(self):
+        self.output_dir = gettempdir()
+        self._items = 0
+        self._remaining = {}
+        self._configs = []
+        self._signal = None
+        self._pending_signal = None
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        """Configure and arm the profiler from the *config* dictionary.
+        Each configuration is applied only once, so the components can
+        pass their configuration on every call."""
+        with self._lock:
+            if not config or config in self._configs:
+                return
+            self._configs.append(dict(config))
+        self.output_dir = config.get("output_dir", gettempdir())
+        if config.get("signal") and self._signal is None:
+            self._pending_signal = config["signal"]
+            self.install_signal_handler()
+        self.arm(config.get("items", 1))
+
+    def arm(self, items):
+        """Profile the next *items* calls of each profiled function."""
+        with self._lock:
+            self._items = items
+            self._remaining = {}
+        LOGGER.info("Profiling the next %d call(s)", items)
+
+    def install_signal_handler(self, signame=None):
+        """Arm the profiler when the signal *signame* is received,
+        by default the one from the configuration.  Only possible in
+        the main thread, elsewhere the signal is left pending."""
+        signame = signame or self._pending_signal
+        if signame is None:
+            return
+        if not _in_main_thread():
+            self._pending_signal = signame
+            LOGGER.warning("Signal %s for profiling can be installed "
+                           "only from the main thread, eg. from the "
+                           "DataWriter configuration", signame)
+            return
+
+        def _handler(signum, frame):
+            del signum, frame
+            self.arm(self._items or 1)
+        self._pending_signal = None
+        try:
+            signal.signal(getattr(signal, signame), _handler)
+        except (AttributeError, ValueError) as err:
+            LOGGER.warning("Can't use signal %s for profiling: %s",
+                           signame, str(err))
+            return
+        self._signal = signame
+
+    def is_armed(self, name):
+        """Check if the next call of *name* is profiled, and count it."""
+        with self._lock:
+            remaining = self._remaining.get(name, self._items)
+            if remaining <= 0:
+                return False
+            self._remaining[name] = remaining - 1
+            return True
+
+    def run(self, name, func, *args, **kwargs):
+        """Call *func* and profile the call if the profiler is armed."""
+        if not self.is_armed(name):
+            return func(*args, **kwargs)
+
+        fname = os.path.join(
+            self.output_dir,
+            "%s_%s" % (name, dt.datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")))
+        dask_profiler = _get_dask_profiler()
+        profile = cProfile.Profile()
+        try:
+            if dask_profiler is not None:
+                dask_profiler.__enter__()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                if dask_profiler is not None:
+                    dask_profiler.__exit__(None, None, None)
+        finally:
+            profile.dump_stats(fname + ".prof")
+            if dask_profiler is not None:
+                _write_dask_profile(dask_profiler.results, fname + "_dask.txt")
+            LOGGER.info("Profile of %s saved to %s.prof", name, fname)
+
+
+def _in_main_thread():
+    """Check if the current thread is the main thread."""
+    try:
+        return threading.current_thread() is threading.main_thread()
+    except AttributeError:
+        # Python 2
+        return isinstance(threading.current_thread(), threading._MainThread)
+
+
+def _get_dask_profiler():
+    """Get a dask profiler, if dask is available."""
+    try:
+        from dask.diagnostics import Profiler as DaskProfiler
+    except ImportError:
+        return None
+    return DaskProfiler()
+
+
+def _write_dask_profile(results, fname):
+    """Write the dask task *results* to *fname*, one task per line,
+    sorted by the starting time."""
+    with open(fname, "w") as fid:
+        fid.write("start_time end_time duration worker_id key\n")
+        for res in sorted(results, key=lambda res: res.start_time):
+            fid.write("%.6f %.6f %.6f %s %s\n" % (
+                res.start_time, res.end_time,
+                res.end_time - res.start_time, str(res.worker_id),
+                str(res.key)))
+
+
+PROFILER = Profiler()
+
+
+def configure(config):
+    """Configure the global profiler, see `Profiler.configure`."""
+    PROFILER.configure(config)
+
+
+def install_signal_handler(signame=None):
+    """Install the profiling signal handler of the global profiler from
+    the main thread, see `Profiler.install_signal_handler`."""
+    PROFILER.install_signal_handler(signame)
+
+
+def profiled(name):
+    """Decorator profiling the calls of the function as *name* when the
+    global profiler is armed."""
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            return PROFILER.run(name, func, *args, **kwargs)
+        return _wrapper
+    return _decorator
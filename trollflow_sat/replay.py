@@ -0,0 +1,355 @@
+"""Recording and replaying of messages for offline load testing.
+
+The messages seen by the SegmentGatherer and the SceneLoader can be
+recorded to a file with the "record_messages" option.  The recorded
+messages can then be replayed to the processing stages at the original
+speed, accelerated, or as fast as possible, and the throughput and
+latencies of the stages are reported.  For example, to replay a day of
+segments to a gatherer ten times faster than in reality::
+
+    python -m trollflow_sat.replay messages.log -s 10 -g gatherer.yaml
+
+or the datasets received by the SceneLoader to a loader configured
+with the component context of the workflow in a YAML file::
+
+    python -m trollflow_sat.replay messages.log -l loader.yaml
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from threading import Lock
+
+import six.moves.queue as queue
+import yaml
+from posttroll.message import Message
+
+LOGGER = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99)
+
+_RECORDERS = {}
+_RECORDERS_LOCK = Lock()
+
+
+class MessageRecorder(object):
+
+    """Record messages to *fname*, one JSON record per line."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._fid = open(fname, "a")
+        self._lock = Lock()
+
+    def record(self, msg, stage=None):
+        """Record *msg* received by *stage*."""
+        line = json.dumps({"time": time.time(), "stage": stage,
+                           "msg": str(msg)})
+        with self._lock:
+            self._fid.write(line + "\n")
+            self._fid.flush()
+
+    def close(self):
+        """Close the file."""
+        with self._lock:
+            self._fid.close()
+
+
+def get_recorder(fname):
+    """Get a recorder writing to *fname*, shared by all the users of
+    the same file."""
+    with _RECORDERS_LOCK:
+        if fname not in _RECORDERS:
+            _RECORDERS[fname] = MessageRecorder(fname)
+        return _RECORDERS[fname]
+
+
+def read_records(fname, stage=None):
+    """Read the recorded (time, stage, message) tuples from *fname*.
+    If *stage* is given, only the messages of that stage are read."""
+    with open(fname, "r") as fid:
+        for line in fid:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if stage is not None and record["stage"] != stage:
+                continue
+            yield (record["time"], record["stage"],
+                   Message(rawstr=record["msg"]))
+
+
+def _get_uids(item):
+    """Get the uids of the files in message *item*."""
+    if not isinstance(item, Message):
+        return []
+    if item.type == "dataset":
+        files = item.data["dataset"]
+    elif item.type == "collection":
+        files = []
+        for col in item.data["collection"]:
+            files += col.get("dataset", [col])
+    else:
+        files = [item.data]
+    return [itm.get("uid", itm.get("uri")) for itm in files]
+
+
+def percentile(values, pct):
+    """Get the *pct* percentile of *values* using the nearest rank."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(round(pct / 100. * (len(values) - 1)))
+    return values[rank]
+
+
+class ReplayStats(object):
+
+    """Throughput and latency statistics of a replay.  The latency of
+    an output message is the time since the newest of the input files
+    it contains was replayed."""
+
+    def __init__(self):
+        self._sent = {}
+        self._received = {}
+        self._start = None
+        self._lock = Lock()
+
+    def sent(self, msg):
+        """Register replaying *msg*."""
+        now = time.time()
+        with self._lock:
+            if self._start is None:
+                self._start = now
+            for uid in _get_uids(msg):
+                self._sent[uid] = now
+
+    def received(self, stage, item):
+        """Register output *item* of *stage*."""
+        now = time.time()
+        with self._lock:
+            times = [self._sent[uid] for uid in _get_uids(item)
+                     if uid in self._sent]
+            latency = now - max(times) if times else None
+            self._received.setdefault(stage, []).append((now, latency))
+
+    def report(self):
+        """Get the statistics of each stage: number of outputs,
+        throughput in outputs per second, and latency percentiles in
+        seconds."""
+        res = {}
+        with self._lock:
+            for stage, received in self._received.items():
+                duration = received[-1][0] - self._start
+                latencies = [lat for _, lat in received if lat is not None]
+                stats = {"count": len(received),
+                         "throughput": (len(received) / duration
+                                        if duration > 0 else None)}
+                for pct in PERCENTILES:
+                    stats["p%d" % pct] = percentile(latencies, pct)
+                stats["max"] = max(latencies) if latencies else None
+                res[stage] = stats
+        return res
+
+
+class QueueProbe(object):
+
+    """Output queue of a stage registering the outputs to *stats* and
+    passing them on to *output_queue*, if given.  For stages whose
+    outputs aren't messages, like the scenes of the SceneLoader, the
+    latencies are counted from the *source* message being handled."""
+
+    def __init__(self, stage, stats, output_queue=None):
+        self.stage = stage
+        self.stats = stats
+        self.output_queue = output_queue
+        self.source = None
+
+    def put(self, item, *args, **kwargs):
+        """Register and pass on *item*.  Terminators (None) aren't
+        registered."""
+        if item is not None:
+            if self.source is not None and not isinstance(item, Message):
+                self.stats.received(self.stage, self.source)
+            else:
+                self.stats.received(self.stage, item)
+        if self.output_queue is not None:
+            self.output_queue.put(item, *args, **kwargs)
+
+
+class Replayer(object):
+
+    """Replay *records*, (time, stage, message) tuples, to the input
+    queues given by stage in *queues*.  The messages are sent *speed*
+    times faster than they were recorded, or as fast as possible if
+    *speed* is None."""
+
+    def __init__(self, records, queues, speed=1., stats=None):
+        self.records = records
+        self.queues = queues
+        self.speed = speed
+        self.stats = stats or ReplayStats()
+
+    def replay(self):
+        """Replay the messages.  Returns the number of replayed
+        messages."""
+        count = 0
+        start = time.time()
+        first = None
+        for rec_time, stage, msg in self.records:
+            if stage not in self.queues:
+                continue
+            if first is None:
+                first = rec_time
+            if self.speed:
+                wait = (rec_time - first) / self.speed - \
+                    (time.time() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            self.stats.sent(msg)
+            self.queues[stage].put(msg)
+            count += 1
+        LOGGER.info("Replayed %d messages in %.1f s", count,
+                    time.time() - start)
+        return count
+
+
+def replay_to_gatherer(fname, gatherer_config, speed=None, wait=1.):
+    """Replay the messages recorded for the SegmentGatherer in *fname*
+    to a gatherer configured with *gatherer_config*, and return the
+    statistics of the published messages.  The recording, journal and
+    prefetching of the configuration aren't used, and the timeliness is
+    scaled by the *speed*.  After the replay, wait *wait* seconds for
+    the gatherer to finish, and publish the slots still open."""
+    from threading import Thread
+    from trollflow_sat.segment_gatherer import SegmentGatherer
+
+    stats = ReplayStats()
+    input_queue = queue.Queue()
+    config_fname = _write_replay_config(gatherer_config, speed)
+    try:
+        gatherer = SegmentGatherer(config_fname, input_queue,
+                                   QueueProbe("SegmentGatherer", stats))
+    finally:
+        os.remove(config_fname)
+    thread = Thread(target=gatherer.run)
+    thread.daemon = True
+    thread.start()
+    Replayer(read_records(fname, stage="SegmentGatherer"),
+             {"SegmentGatherer": input_queue}, speed=speed,
+             stats=stats).replay()
+    while not input_queue.empty():
+        time.sleep(0.1)
+    time.sleep(wait)
+    gatherer.stop()
+    thread.join()
+    gatherer.flush()
+    return stats.report()
+
+
+def _write_replay_config(gatherer_config, speed):
+    """Write the gatherer configuration in *gatherer_config* for
+    replaying at *speed* to a temporary file, and return its name."""
+    with open(gatherer_config, "r") as fid:
+        config = yaml.load(fid, Loader=yaml.Loader)
+    # Don't record the replayed messages again, or touch the journal
+    # and the files of the real processing
+    for key in ("record_messages", "journal", "prefetch"):
+        config["config"].pop(key, None)
+    if speed:
+        config["config"]["timeliness"] = \
+            config["config"].get("timeliness", 1200) / float(speed)
+    fid, fname = tempfile.mkstemp(suffix=".yaml")
+    with os.fdopen(fid, "w") as fid:
+        yaml.dump(config, fid)
+    return fname
+
+
+class _LoaderInput(object):
+
+    """Input of a SceneLoader invoking *loader* with *context* for each
+    message put to it, with the outputs going to *probe*."""
+
+    def __init__(self, loader, context, probe):
+        self.loader = loader
+        self.context = context
+        self.probe = probe
+
+    def put(self, msg):
+        """Invoke the loader for *msg*."""
+        self.probe.source = msg
+        try:
+            self.loader.invoke(dict(self.context, content=msg,
+                                    output_queue=self.probe))
+        except Exception:
+            LOGGER.exception("SceneLoader failed for %s", str(msg))
+        finally:
+            self.probe.source = None
+
+
+def replay_to_loader(fname, loader_config, speed=None):
+    """Replay the messages recorded for the SceneLoader in *fname* to a
+    SceneLoader configured with the component context in the YAML file
+    *loader_config*, and return the statistics of the scenes it
+    outputs.  The loader is invoked for each message in turn, so the
+    latency of a scene is the time it took to load it since its
+    message was replayed."""
+    from trollflow.utils import ordered_load
+    from trollflow_sat.satpy_compositor import SceneLoader
+
+    with open(loader_config, "r") as fid:
+        context = dict(ordered_load(fid))
+    # Don't record the replayed messages again
+    context.pop("record_messages", None)
+    context.update({"use_lock": False, "lock": None, "prev_lock": None})
+
+    stats = ReplayStats()
+    probe = QueueProbe("SceneLoader", stats)
+    Replayer(read_records(fname, stage="SceneLoader"),
+             {"SceneLoader": _LoaderInput(SceneLoader(), context, probe)},
+             speed=speed, stats=stats).replay()
+    return stats.report()
+
+
+def main():
+    """Replay recorded messages to a segment gatherer or a SceneLoader
+    and report the statistics."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("fname", help="File of recorded messages")
+    stages = parser.add_mutually_exclusive_group(required=True)
+    stages.add_argument("-g", "--gatherer-config",
+                        help="Segment gatherer configuration file")
+    stages.add_argument("-l", "--loader-config",
+                        help="YAML file of the SceneLoader context")
+    parser.add_argument("-s", "--speed", type=float, default=None,
+                        help="Replay speed relative to the recording, "
+                        "default: as fast as possible")
+    parser.add_argument("-w", "--wait", type=float, default=1.,
+                        help="Seconds to wait for the last outputs of "
+                        "the gatherer")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.gatherer_config:
+        report = replay_to_gatherer(args.fname, args.gatherer_config,
+                                    speed=args.speed, wait=args.wait)
+    else:
+        report = replay_to_loader(args.fname, args.loader_config,
+                                  speed=args.speed)
+    for stage, stats in report.items():
+        print("%s: %d outputs, %s/s" % (stage, stats["count"],
+                                        _format(stats["throughput"])))
+        print("  latency [s]: " + ", ".join(
+            "%s %s" % (key, _format(stats[key])) for key in
+            ["p%d" % pct for pct in PERCENTILES] + ["max"]))
+
+
+def _format(val):
+    """Format a statistic *val*."""
+    return "-" if val is None else "%.3f" % val
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 using satpy"""
 
 import logging
+import os
 import time
 from copy import deepcopy
 
@@ -9,7 +10,9 @@ from six.moves.urllib.parse import urlparse
 
 from satpy import Scene
 from trollflow.workflow_component import AbstractWorkflowComponent
-from trollflow_sat import utils
+from trollflow_sat import memory, utils
+from trollflow_sat.profiling import configure as configure_profiling
+from trollflow_sat.profiling import profiled
 from trollflow.utils import ordered_load
 
 
@@ -23,6 +26,8 @@ class SceneLoader(AbstractWorkflowComponent):
     def __init__(self):
         super(SceneLoader, self).__init__()
         self.use_lock = False
+        self.deduplicator = None
+        self.sunzen_memo = utils.SunZenithMemo()
 
     def pre_invoke(self):
         """Pre-invoke."""
@@ -30,6 +35,12 @@ class SceneLoader(AbstractWorkflowComponent):
 
     def invoke(self, context):
         """Invoke."""
+        configure_profiling(context.get("profiling"))
+        self._invoke(context)
+
+    @profiled("SceneLoader.invoke")
+    def _invoke(self, context):
+        """Load the data and composites for the message in *context*."""
         # Set locking status, default to False
         self.use_lock = context.get("use_lock", False)
         self.logger.debug("Locking is used in compositor: %s",
@@ -51,6 +62,20 @@ class SceneLoader(AbstractWorkflowComponent):
         with open(context["product_list"], "r") as fid:
             product_config = ordered_load(fid)
         msg = deepcopy(context['content'])
+        if context.get("record_messages"):
+            from trollflow_sat.replay import get_recorder
+            get_recorder(context["record_messages"]).record(
+                msg, stage="SceneLoader")
+
+        # Skip data that has already been processed
+        if self._is_duplicate(msg, context):
+            utils.release_locks([context["lock"], context["prev_lock"]],
+                                log=self.logger.info,
+                                log_msg="Data already processed, skipping. " +
+                                "%d duplicate(s) suppressed." %
+                                self.deduplicator.suppressed)
+            return
+
         for key, val in context.items():
             if key.startswith('ignore_') and val is True:
                 msg.data.pop(key[7:], None)
@@ -76,6 +101,20 @@ class SceneLoader(AbstractWorkflowComponent):
                                 log_msg="Unable to create Scene, " +
                                 "skipping data")
             return
+        memory.start(global_data)
+
+        # Optional precomputed solar zenith angles of the areas
+        sunzen_provider = None
+        if context.get("solar_zenith") is not None:
+            from trollflow_sat.solar_angles import get_provider
+            sunzen_provider = get_provider(**context["solar_zenith"])
+
+        # Static fields of the grid, eg. satellite angles, from the cache
+        static_names = []
+        if context.get("static_fields") is not None:
+            static_names = self._inject_static_fields(
+                global_data, context["static_fields"],
+                sunzen_provider=sunzen_provider)
 
         monitor_topic = context.get("monitor_topic", None)
         if monitor_topic is not None:
@@ -102,7 +141,27 @@ class SceneLoader(AbstractWorkflowComponent):
                               str(context["lock"]))
             utils.acquire_lock(context["lock"])
 
-        for area_id in product_config["product_list"]:
+        # Areas and products are handled in the order of their
+        # priority, highest first
+        plan = utils.get_processing_plan(product_config)
+
+        # Optionally track which areas still need each composite, and
+        # the datasets it is generated from, so that the Resampler can
+        # unload them from the global scene after the last area using
+        # them has been resampled
+        references = None
+        if context.get("early_release", False):
+            references = utils.DatasetReferences()
+            for priority, area_id, products in plan:
+                if msg.data.get("collection_area_id", area_id) == area_id:
+                    references.acquire((area_id, priority), products)
+
+        # Sun zenith angles of all the check locations in one go
+        self.sunzen_memo.update(global_data.attrs['start_time'],
+                                utils.get_sunzen_points(product_config))
+
+        prev_priority = None
+        for priority, area_id, products in plan:
             extra_metadata = {}
 
             # Check if the data was collected for specific area
@@ -114,18 +173,53 @@ class SceneLoader(AbstractWorkflowComponent):
                                         "area, skipping")
                     continue
 
-            # Load and unload composites for this area
-            composites = self.load_composites(global_data, product_config,
-                                              area_id)
+            # Each priority class is computed and published as a
+            # separate batch, so end the previous one
+            if not process_by_area and prev_priority is not None and \
+                    priority != prev_priority:
+                self.logger.debug("Ending batch for priority %s",
+                                  str(prev_priority))
+                context["output_queue"].put(None)
+            prev_priority = priority
+
+            # Load and unload composites for this area.  The Resampler
+            # may be resampling or unloading the previous areas at the
+            # same time, so the scene is locked, and the composites
+            # still needed by them are kept
+            with utils.hold(references and references.lock):
+                keep = set(static_names)
+                if references is not None:
+                    keep.update(utils.get_dataset_name(key) for key in
+                                references.needed())
+                composites = self.load_composites(
+                    global_data, product_config, area_id, products=products,
+                    keep=keep, sunzen_provider=sunzen_provider)
+                utils.coerce_dtypes(global_data, product_config, area_id,
+                                    composites, logger=self.logger)
+                if references is not None:
+                    references.acquire(
+                        (area_id, priority),
+                        utils.get_prerequisites(global_data, composites))
+                    # Composites skipped for this area aren't needed by it
+                    unused = references.release(
+                        (area_id, priority), set(products) - set(composites))
+                    utils.unload_datasets(global_data, unused,
+                                          logger=self.logger)
+
+            memory.track("SceneLoader", global_data,
+                         threshold=context.get("memory_warning_threshold"),
+                         logger=self.logger, area_id=area_id)
 
             extra_metadata['products'] = composites
             extra_metadata['area_id'] = area_id
+            extra_metadata['priority'] = priority
+            if references is not None:
+                extra_metadata['references'] = references
             context["output_queue"].put({'scene': global_data,
                                          'extra_metadata': extra_metadata})
             if process_by_area:
                 context["output_queue"].put(None)
 
-
         # Add "terminator" to the queue to trigger computations for
         # this global scene, if not already done
         if not process_by_area:
@@ -150,6 +244,8 @@ class SceneLoader(AbstractWorkflowComponent):
             monitor_metadata = utils.get_monitor_metadata(msg.data,
                                                           status="completed",
                                                           service=service)
+            monitor_metadata = dict(monitor_metadata,
+                                    memory=memory.get_stats())
             utils.send_message(monitor_topic,
                                "monitor",
                                monitor_metadata,
@@ -166,6 +262,35 @@ class SceneLoader(AbstractWorkflowComponent):
         """Post-invoke"""
         pass
 
+    def _is_duplicate(self, msg, context):
+        """Check if *msg* is a duplicate, if deduplication is
+        configured."""
+        dedup_config = context.get("deduplication", None)
+        if dedup_config is None:
+            return False
+        if self.deduplicator is None:
+            self.deduplicator = utils.MessageDeduplicator(**dedup_config)
+        return self.deduplicator.is_duplicate(msg)
+
+    def _inject_static_fields(self, global_data, config,
+                              sunzen_provider=None):
+        """Add the cached static fields configured in *config* to the
+        scene, and enable satpy's own caching of the angles.  Returns
+        the names of the added fields."""
+        from trollflow_sat import static_fields
+        cache = static_fields.get_cache(config["cache_dir"])
+        if config.get("satpy_cache", True):
+            static_fields.enable_satpy_cache(
+                os.path.join(config["cache_dir"], "satpy"))
+        try:
+            return static_fields.inject_fields(
+                global_data, cache, config["grid_dataset"],
+                fields=config.get("fields", static_fields.FIELDS),
+                logger=self.logger, sunzen_provider=sunzen_provider)
+        except Exception:
+            self.logger.exception("Adding static fields failed")
+            return []
+
     def create_scene_from_message(self, msg, instruments, readers=None):
         """Parse the message *msg* and return a corresponding MPOP scene.
         """
@@ -226,10 +351,19 @@ class SceneLoader(AbstractWorkflowComponent):
 
         return global_data
 
-    def load_composites(self, global_data, product_config, area_id):
-        """Get a set of composites for an area"""
-        all_composites = \
-            set(product_config["product_list"][area_id]['products'].keys())
+    def load_composites(self, global_data, product_config, area_id,
+                        products=None, unload_unused=True, keep=None,
+                        sunzen_provider=None):
+        """Get a set of composites for an area.  If *products* is
+        given, only those products of the area are considered.  The
+        previously loaded composites not needed for this area, other
+        than those listed in *keep*, are unloaded if *unload_unused*
+        is True.  The solar zenith angles of the area are checked with
+        *sunzen_provider*, if given."""
+        if products is None:
+            products = \
+                product_config["product_list"][area_id]['products'].keys()
+        all_composites = set(products)
 
         # Check solar elevations and remove those composites that
         # are outside of their specified ranges
@@ -242,7 +376,8 @@ class SceneLoader(AbstractWorkflowComponent):
             if utils.bad_sunzen_range(
                     product_config,
                     area_id, composite,
-                    start_time):
+                    start_time, sunzen_provider=sunzen_provider,
+                    sunzen_memo=self.sunzen_memo):
                 self.logger.info("Removing composite '%s'; out of "
                                  "valid solar angle range", composite)
             else:
@@ -250,8 +385,8 @@ class SceneLoader(AbstractWorkflowComponent):
 
         # Unload possible pre-existing composites that are not used
         prev_reqs = {itm.name for itm in global_data.datasets}
-        reqs_to_unload = prev_reqs - composites
-        if len(reqs_to_unload) > 0:
+        reqs_to_unload = prev_reqs - composites - set(keep or [])
+        if unload_unused and len(reqs_to_unload) > 0:
             self.logger.debug("Unloading unnecessary channels: %s",
                               str(sorted(reqs_to_unload)))
             global_data.unload(list(reqs_to_unload))
@@ -260,3 +395,5 @@ class SceneLoader(AbstractWorkflowComponent):
                          area_id,
                          ', '.join(sorted(composites)))
         global_data.load(composites)
+
+        return composites
@@ -5,12 +5,11 @@ import logging
 import time
 
 from trollflow.workflow_component import AbstractWorkflowComponent
-from trollflow_sat import utils
+from trollflow_sat import memory, utils
+from trollflow_sat.footprints import get_overpass
+from trollflow_sat.profiling import configure as configure_profiling
+from trollflow_sat.profiling import profiled
 from trollflow.utils import ordered_load
-try:
-    from trollsched.satpass import Pass
-except ImportError:
-    Pass = None
 
 
 class Resampler(AbstractWorkflowComponent):
@@ -29,6 +28,7 @@ class Resampler(AbstractWorkflowComponent):
 
     def invoke(self, context):
         """Invoke"""
+        configure_profiling(context.get("profiling"))
         # Set locking status, default to False
         self.use_lock = context.get("use_lock", False)
         self.logger.debug("Locking is used in resampler: %s",
@@ -51,6 +51,7 @@ class Resampler(AbstractWorkflowComponent):
                             log_msg="Resampler releses lock of previous " +
                             "worker: %s" % str(context["prev_lock"]))
 
+    @profiled("Resampler._process")
     def _process(self, context):
         """Process a context."""
 
@@ -88,14 +89,15 @@ class Resampler(AbstractWorkflowComponent):
 
         # Overpass for coverage calculations
         scn_metadata = glbl.attrs
-        if product_config['common'].get('coverage_check', True) and Pass:
+        if product_config['common'].get('coverage_check', True):
             instrument = scn_metadata['sensor']
             if isinstance(instrument, (list, tuple)):
                 instrument = instrument[0]
-            overpass = Pass(scn_metadata['platform_name'],
-                            scn_metadata['start_time'],
-                            scn_metadata['end_time'],
-                            instrument=instrument)
+            # The same overpass is used for all the areas
+            overpass = get_overpass(scn_metadata['platform_name'],
+                                    scn_metadata['start_time'],
+                                    scn_metadata['end_time'],
+                                    instrument=instrument)
         else:
             overpass = None
 
@@ -107,6 +109,7 @@ class Resampler(AbstractWorkflowComponent):
             min_coverage = prod_list[area_id].get("min_coverage", 0.0)
             if not utils.covers(overpass, area_id, min_coverage,
                                 self.logger):
+                self._release_datasets(glbl, extra_metadata)
                 return
 
         kwargs['radius_of_influence'] = None
@@ -135,12 +138,36 @@ class Resampler(AbstractWorkflowComponent):
             metadata = glbl.attrs
             self.logger.info("Resampling time slot %s to area %s",
                              metadata["start_time"], area_id)
-            lcl = glbl.resample(area_id, **kwargs)
+            references = extra_metadata.get("references")
+            # The SceneLoader may be loading the next area to the scene
+            with utils.hold(references and references.lock):
+                if references is not None:
+                    # Resample only the composites of this area and
+                    # their prerequisites, the global scene may hold
+                    # composites of the other areas
+                    datasets = utils.get_resample_datasets(
+                        glbl, extra_metadata['products'])
+                    if datasets is not None:
+                        kwargs['datasets'] = datasets
+                lcl = glbl.resample(area_id, **kwargs)
+            self._release_datasets(glbl, extra_metadata)
+
+        # Resampling may change the data type
+        if area_id != "satproj":
+            utils.coerce_dtypes(lcl, product_config, area_id,
+                                extra_metadata.get('products') or
+                                prod_list[area_id]['products'],
+                                logger=self.logger)
 
         # Add area ID to the scene attributes so everything needed
         # in filename composing is in the same dictionary
         lcl.attrs["area_id"] = area_id
 
+        memory.track("Resampler", lcl,
+                     slot_id=memory.get_slot_id(scn_metadata),
+                     threshold=context.get("memory_warning_threshold"),
+                     logger=self.logger, area_id=area_id)
+
         metadata = extra_metadata.copy()
         metadata["product_config"] = product_config
         metadata["products"] = prod_list[area_id]['products']
@@ -166,6 +193,17 @@ class Resampler(AbstractWorkflowComponent):
         del lcl
         lcl = None
 
+    def _release_datasets(self, glbl, extra_metadata):
+        """Unload the composites of the global scene no longer needed
+        by any area, if the SceneLoader tracks their use."""
+        references = extra_metadata.get("references")
+        if references is None:
+            return
+        with references.lock:
+            unused = references.release((extra_metadata['area_id'],
+                                         extra_metadata.get('priority')))
+            utils.unload_datasets(glbl, unused, logger=self.logger)
+
     def post_invoke(self):
         """Post-invoke"""
         pass
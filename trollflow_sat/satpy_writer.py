@@ -8,7 +8,9 @@ from satpy.writers import compute_writer_results
 
 from posttroll.message import Message
 from posttroll.publisher import Publish
-from trollflow_sat import utils
+from trollflow_sat import memory, utils
+from trollflow_sat.profiling import configure as configure_profiling
+from trollflow_sat.profiling import profiled
 from trollsift import compose
 
 
@@ -22,7 +24,8 @@ class DataWriterContainer(object):
 
     def __init__(self, topic=None, port=0, nameservers=None,
                  save_settings=None, use_lock=False,
-                 publish_vars=None):
+                 publish_vars=None, profiling=None,
+                 memory_warning_threshold=None):
         # store parameters for later writer restarts
         self.topic = topic
         self._input_queue = None
@@ -34,6 +37,8 @@ class DataWriterContainer(object):
         self._port = port
         self._nameservers = nameservers
         self._publish_vars = publish_vars
+        self._profiling = profiling
+        self._memory_warning_threshold = memory_warning_threshold
         self._init_writer()
 
     def _init_writer(self):
@@ -44,7 +49,10 @@ class DataWriterContainer(object):
                                  port=self._port,
                                  nameservers=self._nameservers,
                                  publish_vars=self._publish_vars,
-                                 prev_lock=self._prev_lock)
+                                 prev_lock=self._prev_lock,
+                                 profiling=self._profiling,
+                                 memory_warning_threshold=(
+                                     self._memory_warning_threshold))
         # Start Writer instance into a new daemonized thread.
         self.thread = Thread(target=self.writer.run)
         self.thread.setDaemon(True)
@@ -107,8 +115,10 @@ class DataWriter(Thread):
 
     def __init__(self, queue=None, save_settings=None,
                  topic=None, port=0, nameservers=None, prev_lock=None,
-                 publish_vars=None):
+                 publish_vars=None, profiling=None,
+                 memory_warning_threshold=None):
         Thread.__init__(self)
+        configure_profiling(profiling)
         self.queue = queue
         self._loop = False
         self._save_settings = save_settings
@@ -125,6 +135,8 @@ class DataWriter(Thread):
         self.data = []
         self.messages = []
         self.pub = None
+        self._memory_warning_threshold = memory_warning_threshold
+        self._slot_id = None
 
     def run(self):
         """Run the thread."""
@@ -133,8 +145,7 @@ class DataWriter(Thread):
         kwargs = self._save_settings.copy()
 
         # Initialize publisher context
-        with Publish("l2producer", port=self._port,
-                     nameservers=self._nameservers) as self.pub:
+        with self.create_publisher() as self.pub:
 
             while self._loop:
                 if self.queue is not None:
@@ -149,12 +160,7 @@ class DataWriter(Thread):
                     except queue_empty:
                         continue
                     try:
-                        if data is None:
-                            self._compute()
-                            self.data = []
-                            self.messages = []
-                        else:
-                            self._process(data, **kwargs)
+                        self.write(data, **kwargs)
                     except Exception:
                         self.logger.exception("Something went wrong when writing.")
 
@@ -170,6 +176,26 @@ class DataWriter(Thread):
                 else:
                     time.sleep(1)
 
+    def create_publisher(self):
+        """Create the publisher context for the messages of the saved
+        files."""
+        return Publish("l2producer", port=self._port,
+                       nameservers=self._nameservers)
+
+    def write(self, data, **kwargs):
+        """Save the scene in *data* lazily.  A terminator (None) computes
+        and saves all the collected data.  The keyword arguments are
+        passed to the writers, by default the save settings are used."""
+        if data is None:
+            self._compute()
+            self.data = []
+            self.messages = []
+        else:
+            if not kwargs:
+                kwargs = self._save_settings.copy()
+            self._process(data, **kwargs)
+
+    @profiled("DataWriter._compute")
     def _compute(self):
         """Compute the data."""
         if self.data:
@@ -178,6 +204,10 @@ class DataWriter(Thread):
             if 'overviews' in self._save_settings:
                 self._add_overviews()
             self._send_messages()
+            memory.track("DataWriter._compute", slot_id=self._slot_id,
+                         threshold=self._memory_warning_threshold,
+                         logger=self.logger,
+                         delayed_results=len(self.data))
 
     def _add_overviews(self):
         """Add overviews (reduced resolution versions of image data) to the
@@ -245,6 +275,12 @@ class DataWriter(Thread):
                 self._create_message(lcl[prod].attrs.get("area"),
                                      fname, scn_metadata, productname)
 
+        # The scenes stay alive in self.data until they are computed
+        self._slot_id = memory.get_slot_id(scn_metadata)
+        memory.track("DataWriter", lcl, slot_id=self._slot_id,
+                     threshold=self._memory_warning_threshold,
+                     logger=self.logger, delayed_results=len(self.data))
+
     def _create_message(self, area, fname, scn_metadata, productname):
         """Create a message and add it to self.messages"""
         # No messaging without a topic
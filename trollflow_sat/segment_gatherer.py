@@ -1,16 +1,22 @@
 """Classes for handling segment gathering for Trollflow based Trollduction"""
 
+import heapq
+import json
 import logging
+import os
 import six.moves.queue as queue
-from threading import Thread
+from threading import Lock, Thread
 import time
 import datetime as dt
 import yaml
 from collections import OrderedDict
 
 from trollsift import Parser
+from trollsift.parser import get_convert_dict
 from posttroll import message
 
+from trollflow_sat import utils
+
 SLOT_NOT_READY = 0
 SLOT_READY = 1
 SLOT_READY_BUT_WAIT_FOR_MORE = 2
@@ -18,6 +24,15 @@ SLOT_OBSOLETE_TIMEOUT = 3
 
 DO_NOT_COPY_KEYS = ("uid", "uri", "channel_name", "segment")
 
+EPOCH = dt.datetime(1970, 1, 1)
+
+# Name of the publish stage with all the files
+FINAL_STAGE = "final"
+
+# Segments needed for the areas, keyed by (source_area, area_ids,
+# segment_names)
+AREA_SEGMENT_CACHE = {}
+
 
 class SegmentGathererContainer(object):
 
@@ -87,8 +102,23 @@ class SegmentGatherer(Thread):
         self.output_queue = output_queue
         self._loop = False
         self._parsers = []
+        self._convert_dicts = []
+        self._fixed_fields = []
+        # Index of the expected files.  Each (pattern_id, channel_name,
+        # segment) key is a bit in the critical, wanted and all masks
+        self._index = {}
+        self._keys = []
+        self._critical_mask = 0
+        self._wanted_mask = 0
+        self._all_mask = 0
         with open(config, 'r') as fid:
-            self._config = yaml.load(fid)
+            self._config = yaml.load(fid, Loader=yaml.Loader)
+
+        try:
+            self._variable_tags = \
+                self._config["config"]["variable_tags"].split(',')
+        except KeyError:
+            self._variable_tags = []
 
         self._set_parsers()
 
@@ -97,23 +127,52 @@ class SegmentGatherer(Thread):
                 dt.timedelta(seconds=self._config["config"]["timeliness"])
         except KeyError:
             self._timeliness = dt.timedelta(seconds=1200)
-        try:
-            self._num_files_premature_publish = \
-                self._config["config"]["num_files_premature_publish"]
-        except KeyError:
-            self._num_files_premature_publish = -1
+        self._stages = []
+        self._set_stages()
 
         self.slots = OrderedDict()
+        # Heap of (timeout, time_slot) tuples
+        self._deadlines = []
 
         self.time_name = self._config["config"]["time_name"]
 
+        # Optional suppression of re-sent files
+        self._deduplicator = None
+        if "deduplication" in self._config["config"]:
+            self._deduplicator = utils.MessageDeduplicator(
+                **self._config["config"]["deduplication"])
+
+        # Optional journal of the slot state for restarts
+        self._journal = None
+        if "journal" in self._config["config"]:
+            self._journal = SlotJournal(
+                self._config["config"]["journal"],
+                compact_interval=self._config["config"].get(
+                    "journal_compact_interval", 1000))
+
+        # Optional fetching of the files as they arrive
+        self._prefetcher = None
+        if "prefetch" in self._config["config"]:
+            from trollflow_sat.fetch import Prefetcher
+            self._prefetcher = Prefetcher(
+                **self._config["config"]["prefetch"])
+
+        # Optional recording of the received messages for replaying
+        self._recorder = None
+        if "record_messages" in self._config["config"]:
+            from trollflow_sat.replay import get_recorder
+            self._recorder = get_recorder(
+                self._config["config"]["record_messages"])
+
     def _clear_data(self, time_slot):
         """Clear data."""
         if time_slot in self.slots:
             del self.slots[time_slot]
+            if self._journal is not None:
+                self._journal.write("clear", time_slot)
 
     def _init_data(self, msg, mda):
-        """Init wanted, all and critical files"""
+        """Init metadata and the received files of a new slot"""
         # Init metadata struct
         metadata = {}
         for key in msg.data:
@@ -128,98 +187,213 @@ class SegmentGatherer(Thread):
         self.slots[time_slot] = {}
         self.slots[time_slot]['metadata'] = metadata.copy()
 
-        # Critical files that are required, otherwise production will fail.
-        # If there are no critical files, empty set([]) is used.
-        # self.slots[time_slot]['critical_files'] = \
-        self._compose_filenames(time_slot)
-
-        self.slots[time_slot]['received_files'] = set([])
+        # Bitmask of the received files in the index, and the keys of
+        # received files that are not part of it
+        self.slots[time_slot]['received'] = 0
+        self.slots[time_slot]['other_files'] = set([])
         self.slots[time_slot]['delayed_files'] = dict()
-        self.slots[time_slot]['missing_files'] = set([])
         self.slots[time_slot]['timeout'] = None
-        self.slots[time_slot]['files_till_premature_publish'] = \
-            self._num_files_premature_publish
+        # Index of the next publish stage
+        self.slots[time_slot]['next_stage'] = 0
 
     def _set_parsers(self):
-        """Set parsers"""
+        """Set parsers and build the index of the expected files"""
         files = self._config["files"]
 
-        for fle in files:
+        for pattern_id, fle in enumerate(files):
             pattern = fle["pattern"]
             parser = Parser(pattern)
             self._parsers.append(parser)
+            self._convert_dicts.append(get_convert_dict(pattern))
+            # Fields that need to match the slot metadata, critical
+            # and wanted files are identified by the rest
+            self._fixed_fields.append(
+                [key for key in parser.keys()
+                 if key not in ('channel_name', 'segment') and
+                 key not in self._variable_tags])
 
-    def _compose_filenames(self, time_slot):
-        """Compose filename set()s"""
-
-        # Get copy of metadata
-        meta = self.slots[time_slot]['metadata'].copy()
-
-        # Replace variable tags (such as processing time) with
-        # wildcards, as these can't be forecasted.
-        try:
-            ignored_keys = self._config["config"]["variable_tags"].split(',')
-            meta = _copy_without_ignore_items(meta, ignored_keys=ignored_keys)
-        except KeyError:
-            pass
-
-        critical_files, wanted_files, all_files = [], [], []
-        files = self._config["files"]
-
-        for fle in files:
-            pattern = fle["pattern"]
-            parser = Parser(pattern)
             for seg in fle["segments"]:
                 chans = seg.get('channel_name', [''])
                 critical_segments = seg.get('critical_segments', [''])
                 wanted_segments = seg.get('wanted_segments', [''])
                 all_segments = seg.get('all_segments', [''])
+                if 'segment_geometry' in seg:
+                    # Wait only for the segments the areas need
+                    wanted_segments = self._get_area_segments(
+                        seg['segment_geometry'])
+                    if 'critical_segments' in seg:
+                        critical_segments = [itm for itm in
+                                             critical_segments
+                                             if itm in wanted_segments]
+                    self.logger.info("Wanted segments for %s: %s",
+                                     ', '.join(chans),
+                                     ', '.join(wanted_segments))
                 for chan in chans:
-                    meta['channel_name'] = chan
                     for seg2 in critical_segments:
-                        meta['segment'] = seg2
-                        critical_files.append(parser.globify(meta))
+                        self._critical_mask |= \
+                            self._add_key(pattern_id, chan, seg2)
                     for seg2 in wanted_segments:
-                        meta['segment'] = seg2
-                        wanted_files.append(parser.globify(meta))
+                        self._wanted_mask |= \
+                            self._add_key(pattern_id, chan, seg2)
                     for seg2 in all_segments:
-                        meta['segment'] = seg2
-                        all_files.append(parser.globify(meta))
+                        self._all_mask |= \
+                            self._add_key(pattern_id, chan, seg2)
+
+        # Critical files are always also wanted
+        self._wanted_mask |= self._critical_mask
+
+        self._parser_table = ParserTable(self._parsers)
+
+    def _get_area_segments(self, geometry):
+        """Get the segments covering the areas of the product list"""
+        with open(self._config["config"]["product_list"], 'r') as fid:
+            product_config = yaml.load(fid, Loader=yaml.Loader)
+        area_ids = list(product_config["product_list"].keys())
+        segment_names = geometry["segment_names"]
+
+        key = (geometry["source_area"], tuple(area_ids),
+               tuple(segment_names))
+        if key not in AREA_SEGMENT_CACHE:
+            # The whole source area is needed for data in satellite
+            # projection
+            if "satproj" in area_ids:
+                segments = list(segment_names)
+            else:
+                get_area_def = utils.get_area_definition
+                segments = get_area_segments(
+                    get_area_def(geometry["source_area"]),
+                    [get_area_def(area_id) for area_id in area_ids],
+                    segment_names)
+            AREA_SEGMENT_CACHE[key] = segments
+
+        return AREA_SEGMENT_CACHE[key]
+
+    def _set_stages(self):
+        """Set the stages for publishing the slots before all the
+        files have been received."""
+        config = self._config["config"]
+        stages = list(config.get("publish_stages", []))
+
+        # Single premature publication after the given number of files
+        num_files = config.get("num_files_premature_publish", -1)
+        if num_files > 0:
+            stages.insert(0, {"name": "premature", "num_files": num_files})
+
+        num_wanted = _count_bits(self._wanted_mask)
+        for stage in stages:
+            mask = None
+            if "segments" in stage:
+                mask = 0
+                # Configured segments and channels found in the index
+                found = set()
+                for key in self._keys:
+                    pattern_id, chan, seg = key
+                    convert_dict = self._convert_dicts[pattern_id]
+                    chans = [itm for itm in stage.get("channel_name", [])
+                             if _format_field(convert_dict, 'channel_name',
+                                              itm) == chan]
+                    if "channel_name" in stage and not chans:
+                        continue
+                    segs = [itm for itm in stage["segments"]
+                            if _format_field(convert_dict, 'segment',
+                                             itm) == seg]
+                    if segs:
+                        mask |= self._index[key]
+                        found.update(('channel_name', itm) for itm in chans)
+                        found.update(('segments', itm) for itm in segs)
+                missing = ["%s %s" % (name, str(itm))
+                           for name in ('channel_name', 'segments')
+                           for itm in stage.get(name, [])
+                           if (name, itm) not in found]
+                if missing:
+                    raise ValueError("Publish stage '%s' has files that "
+                                     "aren't expected: %s" %
+                                     (stage["name"], ', '.join(missing)))
+            num_files = stage.get("num_files")
+            if num_files is not None and num_files > num_wanted:
+                # The wanted files can be fewer than configured, eg.
+                # when the segments are limited to those covering the
+                # areas
+                self.logger.warning("Publish stage '%s' needs %d files, "
+                                    "but only %d are wanted, using %d",
+                                    stage["name"], num_files, num_wanted,
+                                    num_wanted)
+                num_files = num_wanted
+            self._stages.append({"name": stage["name"],
+                                 "mask": mask,
+                                 "num_files": num_files})
+
+    def _get_key(self, pattern_id, channel_name, segment):
+        """Get the index key of a file.  The values are formatted as
+        they'd be in the filename, and are None for fields not in the
+        pattern."""
+        convert_dict = self._convert_dicts[pattern_id]
+        return (pattern_id,
+                _format_field(convert_dict, 'channel_name', channel_name),
+                _format_field(convert_dict, 'segment', segment))
+
+    def _add_key(self, pattern_id, channel_name, segment):
+        """Add a file to the index and return its bit"""
+        key = self._get_key(pattern_id, channel_name, segment)
+        if key not in self._index:
+            self._index[key] = 1 << len(self._keys)
+            self._keys.append(key)
+        return self._index[key]
+
+    def _compose_filenames(self, time_slot, mask):
+        """Compose filename globs of the files in *mask*"""
+        # Get copy of metadata
+        meta = self.slots[time_slot]['metadata'].copy()
 
-        self.slots[time_slot]['critical_files'] = set(critical_files)
-        self.slots[time_slot]['wanted_files'] = set(wanted_files)
-        self.slots[time_slot]['all_files'] = set(all_files)
+        # Replace variable tags (such as processing time) with
+        # wildcards, as these can't be forecasted.
+        meta = _copy_without_ignore_items(meta,
+                                          ignored_keys=self._variable_tags)
+
+        fnames = []
+        for key in self._keys:
+            if not mask & self._index[key]:
+                continue
+            pattern_id, meta['channel_name'], meta['segment'] = key
+            fnames.append(self._parsers[pattern_id].globify(meta))
+
+        return fnames
 
     def slot_ready(self, slot):
         """Determine if slot is ready to be published."""
         # If no files have been collected, return False
-        if len(slot['received_files']) == 0:
+        if len(slot['metadata']['dataset']) == 0:
             return SLOT_NOT_READY
 
         time_slot = str(slot['metadata'][self.time_name])
 
-        wanted_and_critical_files = \
-            slot['wanted_files'].union(slot['critical_files'])
-        num_wanted_and_critical_files_received = \
-            len(wanted_and_critical_files & slot['received_files'])
+        wanted_received = slot['received'] & self._wanted_mask
+        num_wanted_and_critical_files_received = _count_bits(wanted_received)
 
         # self.logger.debug("Got %d wanted or critical files in slot %s.",
         #                   num_wanted_and_critical_files_received,
         #                   time_slot)
 
-        if num_wanted_and_critical_files_received \
-                == slot['files_till_premature_publish']:
-            slot['files_till_premature_publish'] = -1
-            return SLOT_READY_BUT_WAIT_FOR_MORE
+        # Check if the next partial publication can be done
+        if slot['next_stage'] < len(self._stages):
+            stage = self._stages[slot['next_stage']]
+            if (stage['mask'] is not None and
+                    slot['received'] & stage['mask'] == stage['mask']) or \
+                    (stage['num_files'] is not None and
+                     num_wanted_and_critical_files_received >=
+                     stage['num_files']):
+                self.logger.info("Files of stage '%s' received for "
+                                 "slot %s.", stage['name'], time_slot)
+                slot['next_stage'] += 1
+                return SLOT_READY_BUT_WAIT_FOR_MORE
 
         # If all wanted files have been received, return True
-        if wanted_and_critical_files.issubset(
-                slot['received_files']):
+        if wanted_received == self._wanted_mask:
             self.logger.info("All files received for slot %s.",
                              time_slot)
             return SLOT_READY
 
-        if slot['critical_files'].issubset(slot['received_files']):
+        if self._critical_received(slot):
             # All critical files have been received
             if slot['timeout'] is None:
                 # Set timeout
@@ -264,31 +438,16 @@ class SegmentGatherer(Thread):
     def run(self):
         """Run SegmentGatherer"""
         self._loop = True
+        self.restore()
         while self._loop:
-            # Check if there are slots ready for publication
-            slots = self.slots.copy()
-            for slot in slots:
-                slot = str(slot)
-                status = self.slot_ready(slots[slot])
-                if status == SLOT_READY:
-                    # Collection ready, publish and remove
-                    self._publish(slot)
-                    self._clear_data(slot)
-                if status == SLOT_READY_BUT_WAIT_FOR_MORE:
-                    # Collection ready, publish and but wait for more
-                    self._publish(slot, missing_files_check=False)
-                elif status == SLOT_OBSOLETE_TIMEOUT:
-                    # Collection unfinished and obslote, discard
-                    self._clear_data(slot)
-                else:
-                    # Collection unfinished, wait for more data
-                    pass
+            # Check the slots whose timeouts have passed
+            self.check_deadlines()
 
-            # Check queue for new data
+            # Check queue for new data, waiting until the next timeout
             msg = None
             if self.input_queue is not None:
                 try:
-                    msg = self.input_queue.get(True, 1)
+                    msg = self.input_queue.get(True, self.get_wait_time())
                 except KeyboardInterrupt:
                     self.stop()
                     continue
@@ -298,29 +457,169 @@ class SegmentGatherer(Thread):
                 time.sleep(1)
                 continue
 
-            if msg.type == "file":
-                self.logger.info("New message received: %s", str(msg))
-                self.process(msg)
+            self.handle_message(msg)
+
+    def handle_message(self, msg):
+        """Handle a message received from the input queue"""
+        if msg.type == "file":
+            self.logger.info("New message received: %s", str(msg))
+            self._add_file(msg)
+
+    def _add_file(self, msg):
+        """Add the file in *msg* to its slot and check the slot"""
+        if self._recorder is not None:
+            self._recorder.record(msg, stage="SegmentGatherer")
+        if self._deduplicator is not None and \
+                self._deduplicator.is_duplicate(msg):
+            self.logger.info("File already received, skipping. "
+                             "%d duplicate(s) suppressed.",
+                             self._deduplicator.suppressed)
+            return
+        time_slot = self.process(msg)
+        if time_slot is not None:
+            if self._prefetcher is not None:
+                self._prefetcher.submit(msg)
+            if self._journal is not None:
+                delay = self.slots[time_slot]['delayed_files'].get(
+                    msg.data['uid'])
+                if delay is None:
+                    self._journal.write("file", time_slot, msg=str(msg))
+                else:
+                    self._journal.write("file", time_slot, msg=str(msg),
+                                        delay=delay)
+            self._check_slot(time_slot)
+
+    def restore(self):
+        """Restore the open slots from the journal, if one is
+        configured"""
+        if self._journal is not None:
+            self._restore()
+
+    def _restore(self):
+        """Restore the slots from the journal"""
+        journal = self._journal
+        # Don't journal the replayed events again
+        self._journal = None
+        num_records = 0
+        for record in journal.read():
+            num_records += 1
+            time_slot = record["slot"]
+            if record["event"] == "file":
+                msg = message.Message(rawstr=record["msg"])
+                if self.process(msg) is None:
+                    continue
+                # The delay is measured when the file was received,
+                # not when it is replayed
+                delayed_files = self.slots[time_slot]['delayed_files']
+                delayed_files.pop(msg.data['uid'], None)
+                if "delay" in record:
+                    delayed_files[msg.data['uid']] = record["delay"]
+            elif time_slot not in self.slots:
+                continue
+            elif record["event"] == "timeout":
+                self.slots[time_slot]['timeout'] = \
+                    _from_timestamp(record["timeout"])
+            elif record["event"] == "stage":
+                self.slots[time_slot]['next_stage'] = record["stage"] + 1
+            elif record["event"] == "clear":
+                self._clear_data(time_slot)
+        self._journal = journal
+        self.logger.info("Restored %d slot(s) from %d journal records",
+                         len(self.slots), num_records)
+        journal.compact()
+
+        # Check the restored slots, and schedule their timeouts
+        for time_slot in list(self.slots.keys()):
+            timeout = self.slots[time_slot]['timeout']
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (timeout, time_slot))
+            self._check_slot(time_slot)
+
+    def _check_slot(self, time_slot):
+        """Check if the slot is ready for publication, and schedule
+        its timeout."""
+        slot = self.slots[time_slot]
+        timeout = slot['timeout']
+        status = self.slot_ready(slot)
+        while status == SLOT_READY_BUT_WAIT_FOR_MORE:
+            # Collection ready for a stage, publish but wait for more
+            stage = slot['next_stage'] - 1
+            self._publish(time_slot, missing_files_check=False,
+                          stage=self._stages[stage]['name'])
+            if self._journal is not None:
+                self._journal.write("stage", time_slot, stage=stage)
+            status = self.slot_ready(slot)
+
+        if status == SLOT_READY:
+            # Collection ready, publish and remove
+            self._publish(time_slot,
+                          stage=FINAL_STAGE if self._stages else None)
+            self._clear_data(time_slot)
+        elif status == SLOT_OBSOLETE_TIMEOUT:
+            # Collection unfinished and obsolete, discard
+            self._clear_data(time_slot)
+        elif slot['timeout'] is not None and slot['timeout'] != timeout:
+            # Collection unfinished, wait for more data until timeout
+            heapq.heappush(self._deadlines, (slot['timeout'], time_slot))
+            if self._journal is not None:
+                self._journal.write("timeout", time_slot,
+                                    timeout=_to_timestamp(slot['timeout']))
+
+    def flush(self):
+        """Handle the open slots as if their timeouts had passed, eg.
+        at the end of a replay"""
+        expired = dt.datetime.utcnow() - dt.timedelta(seconds=1)
+        for time_slot in list(self.slots):
+            slot = self.slots[time_slot]
+            if slot['timeout'] is not None:
+                slot['timeout'] = expired
+                self._check_slot(time_slot)
+        self._deadlines = []
+
+    def check_deadlines(self):
+        """Check the slots whose timeouts have passed"""
+        now = dt.datetime.utcnow()
+        while self._deadlines and self._deadlines[0][0] < now:
+            deadline, time_slot = heapq.heappop(self._deadlines)
+            # Skip slots that have been published or rescheduled
+            if time_slot not in self.slots or \
+                    self.slots[time_slot]['timeout'] != deadline:
+                continue
+            self._check_slot(time_slot)
+
+    def get_wait_time(self, max_wait=1.):
+        """Get the time to wait for new messages before the next slot
+        timeout.  Wait at most *max_wait* seconds to notice stopping.
+        If *max_wait* is None and there are no timeouts, None is
+        returned."""
+        if not self._deadlines:
+            return max_wait
+        wait = (self._deadlines[0][0] - dt.datetime.utcnow()).total_seconds()
+        wait = max(wait, 0.)
+        if max_wait is None:
+            return wait
+        return min(wait, max_wait)
 
     def stop(self):
         """Stop gatherer."""
         self.logger.info("Stopping gatherer.")
+        self.logger.debug("Filename parsing statistics: %s",
+                          str(self._parser_table.stats))
         self._loop = False
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+        if self._journal is not None:
+            self._journal.close()
 
     def process(self, msg):
-        """Process message"""
+        """Process message.  Return the time slot of the file, or None
+        if the file is unknown or already received."""
 
-        mda = None
-        for parser in self._parsers:
-            try:
-                mda = parser.parse(msg.data["uid"])
-                break
-            except ValueError:
-                continue
+        pattern_id, mda = self._parser_table.parse(msg.data["uid"])
 
         if mda is None:
             self.logger.debug("Unknown file, skipping.")
-            return
+            return None
 
         metadata = {}
         for key in msg.data:
@@ -336,24 +635,23 @@ class SegmentGatherer(Thread):
 
         slot = self.slots[time_slot]
 
-        # Replace variable tags (such as processing time) with
-        # wildcards, as these can't be forecasted.
-        try:
-            variable_tags = self._config["config"]["variable_tags"].split(',')
-            mda = _copy_without_ignore_items(mda, ignored_keys=variable_tags)
-        except KeyError:
-            pass
-
-        mask = None
-        for parser in self._parsers:
-            try:
-                mask = parser.globify(mda)
-                break
-            except ValueError:
-                continue
-
-        if mask is None or mask in slot['received_files']:
-            return
+        # Locate the file in the index.  Files that don't match the
+        # slot metadata, or aren't configured, don't affect readiness
+        bit = None
+        if all(slot['metadata'].get(key, mda[key]) == mda[key]
+               for key in self._fixed_fields[pattern_id]):
+            bit = self._index.get(
+                self._get_key(pattern_id, mda.get('channel_name'),
+                              mda.get('segment')))
+        if bit is None:
+            other_key = (pattern_id,
+                         mda.get('channel_name'), mda.get('segment'),
+                         tuple((key, mda[key])
+                               for key in self._fixed_fields[pattern_id]))
+            if other_key in slot['other_files']:
+                return None
+        elif slot['received'] & bit:
+            return None
 
         # Add uid and uri
         slot['metadata']['dataset'].append({'uri': msg.data['uri'],
@@ -361,16 +659,25 @@ class SegmentGatherer(Thread):
 
         # If critical files have been received but the slot is
         # not complete, add the file to list of delayed files
-        if len(slot['critical_files']) > 0 and \
-           slot['critical_files'].issubset(slot['received_files']):
+        if self._critical_mask and self._critical_received(slot):
             delay = dt.datetime.utcnow() - (slot['timeout'] - self._timeliness)
             slot['delayed_files'][msg.data['uid']] = delay.total_seconds()
 
         # Add to received files
-        slot['received_files'].add(mask)
+        if bit is None:
+            slot['other_files'].add(other_key)
+        else:
+            slot['received'] |= bit
+
+        return time_slot
+
+    def _critical_received(self, slot):
+        """Check if all the critical files of *slot* have been received"""
+        return slot['received'] & self._critical_mask == self._critical_mask
 
-    def _publish(self, time_slot, missing_files_check=True):
-        """Publish file dataset and reinitialize gatherer."""
+    def _publish(self, time_slot, missing_files_check=True, stage=None):
+        """Publish file dataset and reinitialize gatherer.  The name of
+        the publish *stage* is added to the metadata if given."""
 
         data = self.slots[time_slot]
 
@@ -386,18 +693,184 @@ class SegmentGatherer(Thread):
         if missing_files_check:
             # and missing files
             missing_files = \
-                data['all_files'].difference(data['received_files'])
+                self._compose_filenames(time_slot,
+                                        self._all_mask & ~data['received'])
             if len(missing_files) > 0:
                 self.logger.warning("Missing files: %s",
                                     ', '.join(missing_files))
 
         # Although we're not publishing a message, generate one anyway
         # for compatibility
-        msg = message.Message("/placeholder", "dataset", data['metadata'])
+        metadata = data['metadata'].copy()
+        metadata['dataset'] = list(metadata['dataset'])
+        if stage is not None:
+            metadata['publish_stage'] = stage
+        msg = message.Message("/placeholder", "dataset", metadata)
         self.logger.info("Forwarding: %s", str(msg))
         self.output_queue.put(msg)
 
 
+class SlotJournal(object):
+
+    """Append-only journal of the files and timeouts of the open slots,
+    one JSON record per line.  Records of the cleared slots are
+    dropped when the journal is compacted."""
+
+    logger = logging.getLogger("SlotJournal")
+
+    def __init__(self, fname, compact_interval=1000):
+        self.fname = fname
+        self._compact_interval = compact_interval
+        self._fid = None
+        self._num_lines = 0
+        # Records of the open slots, and their total number
+        self._records = OrderedDict()
+        self._num_records = 0
+        self._lock = Lock()
+
+    def read(self):
+        """Read the records of the open slots from the journal"""
+        with self._lock:
+            self._records = OrderedDict()
+            self._num_records = 0
+            self._num_lines = 0
+            if not os.path.exists(self.fname):
+                return []
+            with open(self.fname, 'r') as fid:
+                for line in fid:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partially written record at the time of a crash
+                        self.logger.warning(
+                            "Skipping corrupted journal record")
+                        continue
+                    self._add(record)
+                    self._num_lines += 1
+            return [record for records in self._records.values()
+                    for record in records]
+
+    def _add(self, record):
+        """Add *record* to the records of the open slots"""
+        if record["event"] == "clear":
+            self._num_records -= len(self._records.pop(record["slot"], []))
+        else:
+            self._records.setdefault(record["slot"], []).append(record)
+            self._num_records += 1
+
+    def write(self, event, time_slot, **kwargs):
+        """Append a record of *event* in *time_slot* to the journal"""
+        record = {"event": event, "slot": time_slot}
+        record.update(kwargs)
+        with self._lock:
+            self._add(record)
+            if self._fid is None:
+                self._fid = open(self.fname, 'a')
+            self._fid.write(json.dumps(record) + '\n')
+            self._fid.flush()
+            self._num_lines += 1
+
+            if self._num_lines > max(self._compact_interval,
+                                     2 * self._num_records):
+                self._compact()
+
+    def compact(self):
+        """Rewrite the journal with only the records of the open slots"""
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        """Compact the journal, with the lock held"""
+        self._close()
+        tmp_fname = self.fname + '.tmp'
+        num_lines = 0
+        with open(tmp_fname, 'w') as fid:
+            for records in self._records.values():
+                for record in records:
+                    fid.write(json.dumps(record) + '\n')
+                    num_lines += 1
+        os.rename(tmp_fname, self.fname)
+        self.logger.debug("Compacted journal from %d to %d records",
+                          self._num_lines, num_lines)
+        self._num_lines = num_lines
+
+    def close(self):
+        """Close the journal file"""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        """Close the journal file, with the lock held"""
+        if self._fid is not None:
+            self._fid.close()
+            self._fid = None
+
+
+class ParserTable(object):
+
+    """Select the parsers to try for a filename by the literal prefix
+    and suffix of their patterns."""
+
+    def __init__(self, parsers):
+        self.parsers = parsers
+        # Literal prefix -> [(pattern_id, literal suffix), ]
+        self._prefixes = {}
+        for pattern_id, parser in enumerate(parsers):
+            prefix, suffix = _get_literals(parser.fmt)
+            self._prefixes.setdefault(prefix, []).append((pattern_id,
+                                                          suffix))
+        self._prefix_lengths = sorted(set(len(prefix) for prefix in
+                                          self._prefixes))
+        self.stats = {'filenames': 0,
+                      'parse_attempts': 0,
+                      'dispatched': 0,
+                      'ambiguous': 0,
+                      'rejected': 0,
+                      'unknown': 0}
+
+    def get_candidates(self, fname):
+        """Get the ids of the patterns that can match *fname*, in the
+        configured order."""
+        candidates = []
+        for length in self._prefix_lengths:
+            for pattern_id, suffix in \
+                    self._prefixes.get(fname[:length], []):
+                if fname.endswith(suffix):
+                    candidates.append(pattern_id)
+        return sorted(candidates)
+
+    def parse(self, fname):
+        """Parse *fname* and return the pattern id and the parsed
+        metadata, or (None, None) if no pattern matches."""
+        self.stats['filenames'] += 1
+        candidates = self.get_candidates(fname)
+        if not candidates:
+            self.stats['rejected'] += 1
+            return None, None
+        if len(candidates) == 1:
+            self.stats['dispatched'] += 1
+        else:
+            # Several patterns share the literals, try them in turn
+            self.stats['ambiguous'] += 1
+
+        for pattern_id in candidates:
+            self.stats['parse_attempts'] += 1
+            try:
+                return pattern_id, self.parsers[pattern_id].parse(fname)
+            except ValueError:
+                continue
+
+        self.stats['unknown'] += 1
+        return None, None
+
+
+def _get_literals(pattern):
+    """Get the literal prefix and suffix of a trollsift *pattern*"""
+    if '{' not in pattern:
+        return pattern, ''
+    return pattern[:pattern.index('{')], pattern[pattern.rindex('}') + 1:]
+
+
 def _copy_without_ignore_items(the_dict, ignored_keys=['ignore']):
     """
     get a copy of *the_dict* without entries having substring
@@ -408,3 +881,65 @@ def _copy_without_ignore_items(the_dict, ignored_keys=['ignore']):
         if key not in ignored_keys:
             new_dict[key] = val
     return new_dict
+
+
+def _format_field(convert_dict, key, val):
+    """Format *val* of field *key* as it would be in a filename using
+    the formats in *convert_dict*.  Return None if the field isn't in
+    the pattern."""
+    if key not in convert_dict:
+        return None
+    fmt = convert_dict[key]
+    if fmt:
+        try:
+            return ('{0:' + fmt + '}').format(val)
+        except (ValueError, TypeError):
+            pass
+    return str(val)
+
+
+def get_area_segments(source_area, target_areas, segment_names,
+                      num_samples=100):
+    """Get the segments of *source_area* needed to cover
+    *target_areas*.  The segments are named in *segment_names* in
+    order from the first to the last row of the source area.  The
+    target areas are sampled on a grid of *num_samples* x
+    *num_samples* points."""
+    import numpy as np
+
+    lines_per_segment = source_area.shape[0] / float(len(segment_names))
+    indices = set()
+    for area in target_areas:
+        rows = np.unique(np.linspace(0, area.shape[0] - 1,
+                                     num_samples).round().astype(int))
+        cols = np.unique(np.linspace(0, area.shape[1] - 1,
+                                     num_samples).round().astype(int))
+        rows, cols = np.meshgrid(rows, cols, indexing='ij')
+        lons, lats = area.get_lonlat_from_array_coordinates(cols, rows)
+        src_cols, src_rows = \
+            source_area.get_array_indices_from_lonlat(lons, lats)
+        valid = ~(np.ma.getmaskarray(src_cols) |
+                  np.ma.getmaskarray(src_rows))
+        if not valid.any():
+            continue
+        src_rows = np.ma.getdata(src_rows)[valid]
+        first = int(src_rows.min() // lines_per_segment)
+        last = int(src_rows.max() // lines_per_segment)
+        indices.update(range(first, min(last, len(segment_names) - 1) + 1))
+
+    return [segment_names[idx] for idx in sorted(indices)]
+
+
+def _to_timestamp(utc_time):
+    """Convert *utc_time* to seconds since epoch"""
+    return (utc_time - EPOCH).total_seconds()
+
+
+def _from_timestamp(seconds):
+    """Convert seconds since epoch to UTC time"""
+    return EPOCH + dt.timedelta(seconds=seconds)
+
+
+def _count_bits(mask):
+    """Count the set bits in *mask*"""
+    return bin(mask).count('1')
@@ -0,0 +1,224 @@
+"""Solar zenith angles of areas interpolated from precomputed grids.
+
+The solar zenith angles of an area are computed on a coarse time grid,
+by default hourly for each date, and saved to the cache directory next
+to the static fields of the area (see `trollflow_sat.static_fields`).
+The angles at the slot time are interpolated from the two nearest
+grids, which are memory-mapped, so for full resolution areas a slot
+costs a few vectorised operations instead of the astronomical
+computations for every pixel.
+
+The grids are named by their date, including the year.  Reusing the
+grids of a day of the year in other years would shift both the
+declination and the equation of time by up to a quarter of a day,
+changing the angles by up to about 0.4 degrees.  As the grids are not
+reused after their date, the grids more than a day older than a newly
+computed one are removed.  With "max_size" set, also the least
+recently used grids are removed when their total size exceeds it.
+
+The interpolation separates the hour angle and the declination terms
+of the cosine of the angle, so it is exact up to the small changes of
+the declination and the equation of time between the grids.
+"""
+
+import datetime as dt
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from trollflow_sat.static_fields import (get_area_hash, get_cache,
+                                         save_array)
+from trollflow_sat.utils import lazy_attributes
+
+LOGGER = logging.getLogger(__name__)
+
+_lazy = lazy_attributes(globals(),
+                        {"astronomy": ("pyorbital.astronomy", None)})
+__getattr__ = _lazy
+
+# Seconds between the precomputed grids
+DEFAULT_TIME_STEP = 3600
+
+# Number of memory-mapped grids kept open
+NUM_OPEN_GRIDS = 8
+
+_PROVIDERS = {}
+_PROVIDERS_LOCK = Lock()
+
+
+class SolarZenithProvider(object):
+
+    """Solar zenith angles of areas from the grids in *cache_dir*.  The
+    grids are computed *time_step* seconds apart.  The grids more than a
+    day older than the newest computed one are removed, and when the
+    total size of the grids exceeds *max_size* bytes, the least recently
+    used ones are removed."""
+
+    def __init__(self, cache_dir, time_step=DEFAULT_TIME_STEP,
+                 max_size=None):
+        # The interpolation weights divide by sin(2 * pi * time_step /
+        # 86400), which vanishes for the steps of half a day and a day
+        if 86400 % time_step or time_step >= 43200:
+            raise ValueError("The time step has to divide a day evenly "
+                             "and be shorter than 12 hours")
+        self.cache_dir = cache_dir
+        self.time_step = time_step
+        self.max_size = max_size
+        self._static = get_cache(cache_dir)
+        self._grids = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_sunzen(self, area_def, utc_time):
+        """Get the solar zenith angles in degrees over *area_def* at
+        *utc_time* as a float32 array."""
+        seconds = (utc_time - utc_time.replace(
+            hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+        node_time = utc_time - dt.timedelta(
+            seconds=seconds % self.time_step)
+        fraction = (utc_time - node_time).total_seconds() / self.time_step
+
+        cos0 = self._get_grid(area_def, node_time)
+        if fraction == 0:
+            cos_sunzen = np.array(cos0)
+        else:
+            next_time = node_time + dt.timedelta(seconds=self.time_step)
+            cos1 = self._get_grid(area_def, next_time)
+            # cos(sunzen) = sin(lat) * sin(dec) + cos(lat) * cos(dec) *
+            # cos(hour angle).  The hour angle term is interpolated
+            # exactly with spherical weights, and the declination term
+            # is corrected to the requested time
+            theta = 2 * np.pi * self.time_step / 86400.
+            weight0 = np.sin((1 - fraction) * theta) / np.sin(theta)
+            weight1 = np.sin(fraction * theta) / np.sin(theta)
+            correction = _sin_dec(utc_time) - weight0 * _sin_dec(node_time) - \
+                weight1 * _sin_dec(next_time)
+            cos_sunzen = np.float32(weight0) * cos0 + \
+                np.float32(weight1) * cos1
+            cos_sunzen += np.float32(correction) * \
+                self._get_sin_lat(area_def)
+        np.clip(cos_sunzen, -1., 1., out=cos_sunzen)
+        return np.degrees(np.arccos(cos_sunzen, out=cos_sunzen),
+                          out=cos_sunzen)
+
+    def get_path(self, area_def, node_time):
+        """Get the path of the grid of *area_def* at *node_time*."""
+        node = (node_time.hour * 3600 + node_time.minute * 60 +
+                node_time.second) // self.time_step
+        return os.path.join(
+            self.cache_dir, "%s_sunzen_%d_%s_%03d.npy" % (
+                get_area_hash(area_def), self.time_step,
+                node_time.strftime("%Y%m%d"), node))
+
+    def _get_grid(self, area_def, node_time):
+        """Get the cosines of the solar zenith angles of *area_def* at
+        the grid time *node_time*."""
+        path = self.get_path(area_def, node_time)
+        with self._lock:
+            if path in self._grids:
+                self.hits += 1
+                self._grids[path] = self._grids.pop(path)
+                return self._grids[path]
+
+        try:
+            grid = np.load(path, mmap_mode="r")
+            os.utime(path, None)
+            with self._lock:
+                self.hits += 1
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            lons = self._static.get(area_def, "longitude")
+            lats = self._static.get(area_def, "latitude")
+            sunzen = _lazy("astronomy").sun_zenith_angle(node_time, lons,
+                                                         lats)
+            save_array(path, np.cos(np.radians(sunzen)).astype(np.float32))
+            grid = np.load(path, mmap_mode="r")
+            self.remove_past(node_time)
+            self.evict()
+
+        with self._lock:
+            self._grids[path] = grid
+            while len(self._grids) > NUM_OPEN_GRIDS:
+                self._grids.popitem(last=False)
+        return grid
+
+    def _get_sin_lat(self, area_def):
+        """Get the sines of the latitudes of *area_def*."""
+        path = os.path.join(self.cache_dir, "%s_sin_latitude.npy" %
+                            get_area_hash(area_def))
+        with self._lock:
+            if path in self._grids:
+                return self._grids[path]
+        if not os.path.exists(path):
+            lats = self._static.get(area_def, "latitude")
+            save_array(path, np.sin(np.radians(lats)).astype(np.float32))
+        sin_lat = np.load(path, mmap_mode="r")
+        with self._lock:
+            self._grids[path] = sin_lat
+        return sin_lat
+
+    def remove_past(self, node_time):
+        """Remove the grids dated more than a day before *node_time*.
+        The previous day is kept for the slots around midnight."""
+        oldest = (node_time - dt.timedelta(days=1)).strftime("%Y%m%d")
+        step = "_sunzen_%d_" % self.time_step
+        for fname in os.listdir(self.cache_dir):
+            if step not in fname or not fname.endswith(".npy"):
+                continue
+            date = fname.split(step)[1].split("_")[0]
+            if date >= oldest:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, fname))
+            except OSError:
+                continue
+            LOGGER.debug("Removed %s", fname)
+
+    def evict(self):
+        """Remove the least recently used grids until their total size
+        is below the limit."""
+        if self.max_size is None:
+            return
+        files = []
+        total_size = 0
+        for fname in os.listdir(self.cache_dir):
+            if "_sunzen_" not in fname or not fname.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            LOGGER.debug("Evicted %s", path)
+
+
+def _sin_dec(utc_time):
+    """Get the sine of the solar declination at *utc_time*."""
+    return np.sin(_lazy("astronomy").sun_ra_dec(utc_time)[1])
+
+
+def get_provider(cache_dir, time_step=DEFAULT_TIME_STEP, max_size=None):
+    """Get a provider using the grids in *cache_dir*, shared by all the
+    users of the same directory and time step."""
+    key = (cache_dir, time_step)
+    with _PROVIDERS_LOCK:
+        if key not in _PROVIDERS:
+            _PROVIDERS[key] = SolarZenithProvider(
+                cache_dir, time_step=time_step, max_size=max_size)
+        return _PROVIDERS[key]
@@ -0,0 +1,251 @@
+"""Cache of static auxiliary fields of fixed grids.
+
+Longitudes, latitudes and, for geostationary grids, the satellite
+viewing angles are the same for every time slot of the same grid.  The
+fields are computed once, saved to the cache directory as .npy files
+named by a hash of the area definition, and memory-mapped from there,
+so all the processes using the same cache directory share them.
+
+SceneLoader adds the fields to the scene as datasets before the
+composites are loaded, so they can be listed as products of the areas,
+or used by custom compositors requiring them by name.  The angle
+modifiers of satpy, eg. "sunz_corrected" and "rayleigh_corrected",
+compute their angles themselves and don't use these datasets, so the
+caching of satpy's own longitudes, latitudes and sensor angles is
+enabled in the "satpy" subdirectory of the cache directory, unless
+"satpy_cache" is false.  The grid is taken from the area of a lightly
+loaded reference channel::
+
+    static_fields:
+      cache_dir: /var/cache/trollflow_sat
+      grid_dataset: IR_108
+      fields:
+        - satellite_zenith_angle
+        - satellite_azimuth_angle
+      satpy_cache: True
+
+The "solar_zenith_angle" field is interpolated for each slot from the
+precomputed grids of `trollflow_sat.solar_angles`, when the
+"solar_zenith" option of SceneLoader is configured.
+"""
+
+import datetime as dt
+import hashlib
+import logging
+import os
+import tempfile
+from threading import Lock
+
+import numpy as np
+
+from trollflow_sat.utils import lazy_attributes
+
+LOGGER = logging.getLogger(__name__)
+
+_lazy = lazy_attributes(globals(),
+                        {"get_observer_look": ("pyorbital.orbital",
+                                               "get_observer_look")},
+                        optional=("get_observer_look", ))
+__getattr__ = _lazy
+
+LONLAT_FIELDS = ("longitude", "latitude")
+ANGLE_FIELDS = ("satellite_zenith_angle", "satellite_azimuth_angle")
+FIELDS = LONLAT_FIELDS + ANGLE_FIELDS
+
+UNITS = {"longitude": "degrees_east",
+         "latitude": "degrees_north",
+         "satellite_zenith_angle": "degrees",
+         "satellite_azimuth_angle": "degrees",
+         "solar_zenith_angle": "degrees"}
+
+_CACHES = {}
+_CACHES_LOCK = Lock()
+
+
+def get_area_hash(area_def):
+    """Get a hash identifying the grid of *area_def*."""
+    try:
+        projection = area_def.crs.to_wkt()
+    except AttributeError:
+        projection = area_def.proj_str
+    desc = "%s %s %s" % (projection, str(area_def.shape),
+                         str(["%.6f" % val for val in area_def.area_extent]))
+    return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+
+def get_satellite_position(area_def):
+    """Get the (lon, lat, altitude in km) of the satellite of a
+    geostationary *area_def*, or None if the area isn't geostationary."""
+    try:
+        proj = area_def.crs.to_dict()
+    except AttributeError:
+        proj = area_def.proj_dict
+    if proj.get("proj") != "geos":
+        return None
+    return (float(proj.get("lon_0", 0.)), 0., float(proj["h"]) / 1000.)
+
+
+class StaticFieldCache(object):
+
+    """Memory-mapped static fields of the grids, stored in
+    *cache_dir*.  The fields are written atomically, so reading needs
+    no locking."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._fields = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, area_def, name):
+        """Get the path of field *name* of *area_def* in the cache."""
+        return os.path.join(self.cache_dir,
+                            "%s_%s.npy" % (get_area_hash(area_def), name))
+
+    def get(self, area_def, name):
+        """Get the memory-mapped field *name* of *area_def*.  The field
+        is computed and saved if it isn't in the cache.  Returns None
+        if the field can't be computed for the grid."""
+        path = self.get_path(area_def, name)
+        with self._lock:
+            if path in self._fields:
+                self.hits += 1
+                return self._fields[path]
+        exists = os.path.exists(path)
+        with self._lock:
+            if exists:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not exists:
+            fields = compute_fields(area_def, name)
+            if fields is None:
+                return None
+            for field_name, data in fields.items():
+                save_array(self.get_path(area_def, field_name), data)
+        data = np.load(path, mmap_mode="r")
+        with self._lock:
+            self._fields[path] = data
+        return data
+
+
+def save_array(path, data):
+    """Save *data* atomically to the .npy file *path*."""
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as fid:
+            np.save(fid, data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    LOGGER.debug("Saved %s", path)
+
+
+def get_cache(cache_dir):
+    """Get a cache of the fields in *cache_dir*, shared by all the users
+    of the same directory."""
+    with _CACHES_LOCK:
+        if cache_dir not in _CACHES:
+            _CACHES[cache_dir] = StaticFieldCache(cache_dir)
+        return _CACHES[cache_dir]
+
+
+def enable_satpy_cache(cache_dir):
+    """Enable the caching of the longitudes, latitudes and sensor angles
+    computed by satpy, eg. in its angle modifiers, to *cache_dir*.
+    Returns False if the satpy version doesn't support the caching."""
+    try:
+        import satpy
+        satpy.config.set(cache_dir=cache_dir, cache_lonlats=True,
+                         cache_sensor_angles=True)
+    except (ImportError, AttributeError):
+        LOGGER.warning("Caching of satpy angles not supported")
+        return False
+    return True
+
+
+def compute_fields(area_def, name):
+    """Compute field *name* of *area_def*, and the fields computed with
+    it.  Returns a dictionary of float32 arrays, or None if the field
+    can't be computed for the grid."""
+    lons, lats = area_def.get_lonlats()
+    lons = np.where(np.isfinite(lons), lons, np.nan)
+    lats = np.where(np.isfinite(lats), lats, np.nan)
+    if name in LONLAT_FIELDS:
+        return {"longitude": lons.astype(np.float32),
+                "latitude": lats.astype(np.float32)}
+    if name not in ANGLE_FIELDS:
+        raise KeyError("Unknown static field: %s" % name)
+
+    position = get_satellite_position(area_def)
+    get_observer_look = _lazy("get_observer_look")
+    if position is None or get_observer_look is None:
+        LOGGER.debug("Can't compute static %s for area %s", name,
+                     area_def.area_id)
+        return None
+    # The geometry of a geostationary satellite doesn't depend on time
+    sat_lon, sat_lat, sat_alt = [np.full(lons.shape, val)
+                                 for val in position]
+    azimuth, elevation = get_observer_look(
+        sat_lon, sat_lat, sat_alt, dt.datetime(2000, 1, 1), lons, lats,
+        np.zeros(lons.shape))
+    return {"satellite_zenith_angle": (90. - elevation).astype(np.float32),
+            "satellite_azimuth_angle": azimuth.astype(np.float32)}
+
+
+def inject_fields(scene, cache, grid_dataset, fields=FIELDS, logger=LOGGER,
+                  sunzen_provider=None):
+    """Add the static *fields* of the grid of *grid_dataset* to
+    *scene*.  The fields get the metadata of the grid dataset, and are
+    chunked like it.  Given a *sunzen_provider*, also the
+    "solar_zenith_angle" field at the middle of the scene time is
+    available.  Returns the names of the added fields."""
+    import dask.array as da
+    import xarray as xr
+
+    loaded = grid_dataset in scene
+    scene.load([grid_dataset])
+    ref = scene[grid_dataset]
+    if not loaded:
+        # Only the metadata of the reference dataset is needed
+        del scene[grid_dataset]
+    area_def = ref.attrs.get("area")
+    if area_def is None or not hasattr(area_def, "area_extent"):
+        logger.warning("No fixed grid for %s, static fields not used",
+                       grid_dataset)
+        return []
+
+    chunks = ref.chunks[-2:] if ref.chunks else "auto"
+    added = []
+    for name in fields:
+        if name in scene:
+            continue
+        if name == "solar_zenith_angle":
+            if sunzen_provider is None:
+                continue
+            start_time = ref.attrs["start_time"]
+            end_time = ref.attrs.get("end_time", start_time)
+            data = sunzen_provider.get_sunzen(
+                area_def, start_time + (end_time - start_time) / 2)
+        else:
+            data = cache.get(area_def, name)
+        if data is None:
+            continue
+        attrs = {key: val for key, val in ref.attrs.items() if key in
+                 ("area", "start_time", "end_time", "platform_name",
+                  "sensor", "resolution")}
+        attrs.update({"name": name, "standard_name": name,
+                      "units": UNITS[name]})
+        scene[name] = xr.DataArray(da.from_array(data, chunks=chunks),
+                                   dims=ref.dims[-2:], attrs=attrs)
+        added.append(name)
+    logger.debug("Added static fields: %s", ", ".join(added))
+    return added
@@ -24,10 +24,18 @@
 """
 
 # from trollduction.tests import test_listener
+import sys
 import unittest
 import doctest
 from trollflow_sat.tests import (test_utils, test_satpy_compositor,
-                                 test_satpy_resampler, test_satpy_writer)
+                                 test_satpy_resampler, test_satpy_writer,
+                                 test_segment_gatherer, test_footprints,
+                                 test_fetch, test_profiling, test_replay,
+                                 test_memory, test_static_fields,
+                                 test_solar_angles, test_area_gatherer)
+# The asyncio pipeline uses "async def", added in Python 3.5
+if sys.version_info >= (3, 5):
+    from trollflow_sat.tests import test_aio
 
 
 def suite():
@@ -38,5 +46,16 @@ def suite():
     mysuite.addTests(test_satpy_compositor.suite())
     mysuite.addTests(test_satpy_resampler.suite())
     mysuite.addTests(test_satpy_writer.suite())
+    mysuite.addTests(test_segment_gatherer.suite())
+    mysuite.addTests(test_footprints.suite())
+    mysuite.addTests(test_fetch.suite())
+    mysuite.addTests(test_profiling.suite())
+    mysuite.addTests(test_replay.suite())
+    mysuite.addTests(test_memory.suite())
+    mysuite.addTests(test_static_fields.suite())
+    mysuite.addTests(test_solar_angles.suite())
+    mysuite.addTests(test_area_gatherer.suite())
+    if sys.version_info >= (3, 5):
+        mysuite.addTests(test_aio.suite())
 
     return mysuite
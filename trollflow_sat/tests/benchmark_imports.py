@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the import times of the trollflow-sat modules.
+
+Each module is imported in a fresh interpreter, so the times include
+all the dependencies.  Usage::
+
+    python -m trollflow_sat.tests.benchmark_imports [-n REPEATS] [MODULE ...]
+"""
+
+import argparse
+import subprocess
+import sys
+
+MODULES = ["trollflow_sat.utils",
+           "trollflow_sat.segment_gatherer",
+           "trollflow_sat.fetch",
+           "trollflow_sat.footprints",
+           "trollflow_sat.satpy_compositor",
+           "trollflow_sat.satpy_resampler",
+           "trollflow_sat.satpy_writer"]
+
+CODE = """import time
+start = time.time()
+import %s
+print(time.time() - start)
+"""
+
+
+def time_import(module):
+    """Get the time in seconds to import *module* in a new
+    interpreter."""
+    out = subprocess.check_output([sys.executable, "-c", CODE % module])
+    return float(out.decode().strip().split()[-1])
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", "--repeats", type=int, default=3,
+                        help="Number of imports of each module")
+    parser.add_argument("modules", nargs="*", default=MODULES,
+                        help="Modules to import")
+    args = parser.parse_args()
+
+    print("%-35s %8s %8s" % ("module", "min [s]", "max [s]"))
+    for module in args.modules:
+        try:
+            times = [time_import(module) for _ in range(args.repeats)]
+        except subprocess.CalledProcessError:
+            print("%-35s %17s" % (module, "failed"))
+            continue
+        print("%-35s %8.3f %8.3f" % (module, min(times), max(times)))
+
+
+if __name__ == "__main__":
+    main()
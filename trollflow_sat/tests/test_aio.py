@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the asyncio runtime"""
+
+import asyncio
+import datetime as dt
+import os
+import tempfile
+import unittest
+from threading import Lock
+
+import six.moves.queue as queue
+
+try:
+    from unittest.mock import call, MagicMock
+except ImportError:
+    from mock import call, MagicMock
+
+from posttroll.message import Message
+
+from trollflow_sat import aio
+from trollflow_sat.segment_gatherer import SegmentGatherer
+from trollflow_sat.tests.test_segment_gatherer import CONFIG, create_message
+from trollflow_sat.tests.utils import write_yaml
+
+
+class FakeComponent(object):
+
+    """Workflow component putting its input twice to the output"""
+
+    def __init__(self):
+        self.contexts = []
+
+    def invoke(self, context):
+        self.contexts.append(context)
+        context['output_queue'].put(context['content'])
+        context['output_queue'].put(context['content'])
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.pipeline = aio.Pipeline(queue_size=2)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _run(self, collect, num_items, timeout=5.):
+        """Run the pipeline until *num_items* are received from the
+        *collect* queue"""
+        async def _collect():
+            items = []
+            for _ in range(num_items):
+                items.append(await collect.get())
+            self.pipeline.stop()
+            return items
+
+        collector = asyncio.ensure_future(_collect())
+        self.loop.run_until_complete(
+            asyncio.wait_for(self.pipeline.run(), timeout))
+        return collector.result()
+
+    def _create_gatherer(self):
+        config = write_yaml(CONFIG)
+        try:
+            return SegmentGatherer(config, None, None)
+        finally:
+            os.remove(config)
+
+    def test_segment_gatherer_stage(self):
+        files, datasets = self.pipeline.queue(10), self.pipeline.queue()
+        gatherer = self._create_gatherer()
+        for chan, seg in [('', 'PRO'), ('VIS006', '000007'),
+                          ('VIS006', '000008'), ('IR_108', '000007'),
+                          ('IR_108', '000008'), ('', 'EPI')]:
+            files.put_nowait(create_message(chan, seg))
+        self.pipeline.add(aio.segment_gatherer_stage(gatherer, files,
+                                                     datasets))
+        msg, = self._run(datasets, 1)
+        self.assertEqual(msg.type, 'dataset')
+        self.assertEqual(len(msg.data['dataset']), 6)
+        self.assertFalse(gatherer.slots)
+
+    def test_segment_gatherer_stage_timeout(self):
+        files, datasets = self.pipeline.queue(), self.pipeline.queue()
+        gatherer = self._create_gatherer()
+        gatherer._timeliness = dt.timedelta(seconds=0.2)
+        # The slot is published at the timeout without all the files
+        files.put_nowait(create_message('', 'PRO'))
+        self.pipeline.add(aio.segment_gatherer_stage(gatherer, files,
+                                                     datasets))
+        msg, = self._run(datasets, 1)
+        self.assertEqual(len(msg.data['dataset']), 1)
+
+    def test_component_stage(self):
+        in_queue, out_queue = self.pipeline.queue(3), self.pipeline.queue(1)
+        component = FakeComponent()
+        lock, prev_lock = Lock(), Lock()
+        for i in range(3):
+            in_queue.put_nowait(i)
+        self.pipeline.add(aio.component_stage(component,
+                                              {'foo': 'bar',
+                                               'use_lock': True},
+                                              in_queue, out_queue,
+                                              lock=lock,
+                                              prev_lock=prev_lock))
+        # The component waits for room in the output queue
+        self.assertEqual(self._run(out_queue, 6), [0, 0, 1, 1, 2, 2])
+        context = component.contexts[0]
+        self.assertEqual(context['foo'], 'bar')
+        self.assertTrue(context['use_lock'])
+        self.assertIs(context['lock'], lock)
+        self.assertIs(context['prev_lock'], prev_lock)
+
+    def test_queue_source(self):
+        sync_queue = queue.Queue()
+        out_queue = self.pipeline.queue()
+        for i in range(3):
+            sync_queue.put(i)
+        self.pipeline.add(aio.queue_source(sync_queue, out_queue,
+                                           timeout=0.1))
+        self.assertEqual(self._run(out_queue, 3), [0, 1, 2])
+
+    def test_fetcher_stage(self):
+        in_queue, out_queue = self.pipeline.queue(), self.pipeline.queue()
+        fid, fname = tempfile.mkstemp()
+        os.close(fid)
+        try:
+            in_queue.put_nowait(Message('/topic', 'file', {'uri': fname}))
+            in_queue.put_nowait(None)
+            self.pipeline.add(aio.fetcher_stage(in_queue, out_queue,
+                                                tempfile.gettempdir()))
+            msg, terminator = self._run(out_queue, 2)
+        finally:
+            os.remove(fname)
+        self.assertEqual(msg.data['uri'], fname)
+        self.assertIsNone(terminator)
+
+    def test_writer_stage(self):
+        in_queue = self.pipeline.queue()
+        writer = MagicMock()
+        prev_lock = Lock()
+        in_queue.put_nowait({'scene': 'scene'})
+        in_queue.put_nowait(None)
+        done = self.pipeline.queue()
+        locked = []
+
+        def _write(data):
+            locked.append(prev_lock.locked())
+            if data is None:
+                self.loop.call_soon_threadsafe(done.put_nowait, True)
+
+        writer.write.side_effect = _write
+        self.pipeline.add(aio.writer_stage(writer, in_queue,
+                                           prev_lock=prev_lock))
+        self._run(done, 1)
+        self.assertEqual(writer.write.call_args_list,
+                         [call({'scene': 'scene'}), call(None)])
+        self.assertTrue(writer.create_publisher.called)
+        self.assertEqual(locked, [True, True])
+
+    def test_failing_stage(self):
+        async def _fail():
+            raise ValueError
+
+        self.pipeline.add(_fail())
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(self.pipeline.run())
+
+
+def suite():
+    """The suite for test_aio
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPipeline))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
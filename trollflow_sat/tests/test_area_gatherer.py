@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for area gatherer"""
+
+import datetime as dt
+import unittest
+
+import numpy as np
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from trollflow_sat import area_gatherer
+
+NORTH = (0., 50., 10., 60.)
+PACIFIC = (160., -10., -160., 10.)
+SOUTH = (0., -60., 10., -50.)
+
+
+class TestRegionIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = area_gatherer.RegionIndex(10.)
+        for item, bbox in enumerate([NORTH, PACIFIC, SOUTH]):
+            self.index.insert(item, bbox)
+
+    def test_split_bbox(self):
+        self.assertEqual(area_gatherer._split_bbox(NORTH), [NORTH])
+        self.assertEqual(area_gatherer._split_bbox(PACIFIC),
+                         [(160., -10., 180., 10.),
+                          (-180., -10., -160., 10.)])
+
+    def test_intersects(self):
+        split = area_gatherer._split_bbox
+        self.assertTrue(area_gatherer._intersects(
+            split(PACIFIC), split((-170., 0., -165., 5.))))
+        self.assertFalse(area_gatherer._intersects(
+            split(PACIFIC), split((-150., 0., -140., 5.))))
+        # Touching edges intersect
+        self.assertTrue(area_gatherer._intersects(
+            split(NORTH), split((10., 60., 20., 70.))))
+
+    def test_query(self):
+        index = self.index
+        self.assertEqual(index.query((2., 52., 4., 54.)), [0])
+        # Both sides of the antimeridian
+        self.assertEqual(index.query((165., 0., 170., 5.)), [1])
+        self.assertEqual(index.query((-170., 0., -165., 5.)), [1])
+        self.assertEqual(index.query((175., -5., -175., 5.)), [1])
+        # A box crossing the antimeridian only overlapping the other
+        # side of the region
+        self.assertEqual(index.query((150., 20., -175., 30.)), [])
+        # Overlapping several regions, in insertion order
+        self.assertEqual(index.query((5., -55., 170., 55.)), [0, 1, 2])
+        # In the same grid cells, but not overlapping
+        self.assertEqual(index.query((11., 51., 12., 52.)), [])
+        self.assertEqual(index.query((100., 0., 110., 10.)), [])
+
+    def test_query_global(self):
+        index = self.index
+        index.insert(3, None)
+        self.assertEqual(index.query((100., 0., 110., 10.)), [3])
+        self.assertEqual(index.query((2., 52., 4., 54.)), [0, 3])
+
+
+class TestAreaGatherer(unittest.TestCase):
+
+    @patch('trollflow_sat.area_gatherer.AreaGatherer.create_collectors')
+    @patch('trollflow_sat.utils.get_area_def')
+    @patch('trollflow_sat.area_gatherer.get_area_bbox')
+    def setUp(self, get_area_bbox, get_area_def, create_collectors):
+        bboxes = {'north': NORTH, 'pacific': PACIFIC, 'south': SOUTH,
+                  'full_disk': None}
+        get_area_def.side_effect = lambda area_id: area_id
+        get_area_bbox.side_effect = lambda area_id: bboxes[area_id]
+        config = {"timeliness": 10, "pattern": None, "aliases": None,
+                  "metadata": None, "platform_names": ["NOAA-19"],
+                  "regions": ["north", "pacific", "south", "full_disk"]}
+        self.gatherer = area_gatherer.AreaGatherer(config, None, None)
+        self.gatherer.collectors = {"NOAA-19": ["north", "pacific",
+                                                "south", "full_disk"]}
+        self.metadata = {"platform_name": "NOAA-19",
+                         "start_time": dt.datetime(2021, 12, 22, 12, 0),
+                         "end_time": dt.datetime(2021, 12, 22, 12, 1),
+                         "sensor": "avhrr"}
+
+    @patch('trollflow_sat.footprints.get_footprint')
+    def test_get_collectors(self, get_footprint):
+        gatherer = self.gatherer
+        get_footprint.return_value = (np.array([2., 4., 4., 2.]),
+                                      np.array([52., 52., 54., 54.]))
+        # Full disk areas without a bounding box get all the granules
+        self.assertEqual(gatherer.get_collectors(self.metadata),
+                         ["north", "full_disk"])
+        # Crossing the antimeridian
+        get_footprint.return_value = (np.array([175., -175., -175., 175.]),
+                                      np.array([-5., -5., 5., 5.]))
+        self.assertEqual(gatherer.get_collectors(self.metadata),
+                         ["pacific", "full_disk"])
+        # Not overlapping any region
+        get_footprint.return_value = (np.array([100., 110., 110., 100.]),
+                                      np.array([0., 0., 10., 10.]))
+        self.assertEqual(gatherer.get_collectors(self.metadata),
+                         ["full_disk"])
+        # All the regions are tried without a footprint
+        get_footprint.side_effect = ValueError
+        self.assertEqual(gatherer.get_collectors(self.metadata),
+                         ["north", "pacific", "south", "full_disk"])
+        # No collectors for other platforms
+        self.assertEqual(gatherer.get_collectors(
+            dict(self.metadata, platform_name="NOAA-20")), [])
+
+
+def suite():
+    """The suite for test_area_gatherer
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestRegionIndex))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestAreaGatherer))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
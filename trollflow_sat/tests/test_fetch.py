@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for file fetching"""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from threading import Thread
+
+from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver
+from posttroll.message import Message
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from trollflow_sat import fetch
+
+
+class TestResolver(unittest.TestCase):
+
+    @patch('trollflow_sat.fetch.time.time')
+    @patch('trollflow_sat.fetch.socket.gethostbyname')
+    def test_gethostbyname(self, gethostbyname, time):
+        time.return_value = 0
+        gethostbyname.return_value = '10.0.0.1'
+        resolver = fetch.Resolver(ttl=10)
+        for _ in range(3):
+            self.assertEqual(resolver.gethostbyname('host'), '10.0.0.1')
+        self.assertEqual(gethostbyname.call_count, 1)
+        # Expired
+        time.return_value = 11
+        gethostbyname.return_value = '10.0.0.2'
+        self.assertEqual(resolver.gethostbyname('host'), '10.0.0.2')
+        self.assertEqual(gethostbyname.call_count, 2)
+
+    @patch('trollflow_sat.fetch.time.time')
+    @patch('trollflow_sat.fetch.socket.gethostbyname')
+    def test_gethostbyname_failed(self, gethostbyname, time):
+        time.return_value = 0
+        gethostbyname.side_effect = socket.gaierror
+        resolver = fetch.Resolver(ttl=10)
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                resolver.gethostbyname('unknown')
+        self.assertEqual(gethostbyname.call_count, 1)
+
+
+class TestLocalAddresses(unittest.TestCase):
+
+    @patch('trollflow_sat.fetch.time.time')
+    @patch('trollflow_sat.fetch.get_local_ips')
+    def test_contains(self, get_local_ips, time):
+        time.return_value = 0
+        get_local_ips.return_value = ['127.0.0.1', '10.0.0.1']
+        local_ips = fetch.LocalAddresses(ttl=100, min_refresh=10)
+        self.assertTrue('10.0.0.1' in local_ips)
+        self.assertFalse('10.0.0.2' in local_ips)
+        self.assertTrue('127.0.0.1' in local_ips)
+        self.assertEqual(get_local_ips.call_count, 1)
+        # An unknown address refreshes the addresses, at most every
+        # min_refresh seconds
+        get_local_ips.return_value = ['127.0.0.1', '10.0.0.2']
+        time.return_value = 5
+        self.assertFalse('10.0.0.2' in local_ips)
+        time.return_value = 11
+        self.assertTrue('10.0.0.2' in local_ips)
+        self.assertEqual(get_local_ips.call_count, 2)
+        # Known addresses are refreshed after ttl
+        self.assertTrue('127.0.0.1' in local_ips)
+        self.assertEqual(get_local_ips.call_count, 2)
+        time.return_value = 112
+        get_local_ips.return_value = ['10.0.0.3']
+        self.assertFalse('127.0.0.1' in local_ips)
+        self.assertEqual(get_local_ips.call_count, 3)
+
+
+class TestCheckUri(unittest.TestCase):
+
+    def setUp(self):
+        fid, self.fname = tempfile.mkstemp()
+        os.close(fid)
+        fetch.RESOLVER.clear()
+        fetch.LOCAL_IPS.clear()
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    @patch('trollflow_sat.fetch.socket.gethostbyname')
+    @patch('trollflow_sat.fetch.get_local_ips')
+    def test_check_uri(self, get_local_ips, gethostbyname):
+        get_local_ips.return_value = ['127.0.0.1', '10.0.0.1']
+        gethostbyname.return_value = '10.0.0.1'
+        uris = ['ssh://host' + self.fname] * 114
+        self.assertEqual(fetch.check_uri(uris), [self.fname] * 114)
+        self.assertEqual(fetch.check_uri(self.fname), self.fname)
+        self.assertEqual(get_local_ips.call_count, 1)
+        self.assertEqual(gethostbyname.call_count, 1)
+
+    @patch('trollflow_sat.fetch.socket.gethostbyname')
+    @patch('trollflow_sat.fetch.get_local_ips')
+    def test_check_uri_remote(self, get_local_ips, gethostbyname):
+        get_local_ips.return_value = ['127.0.0.1']
+        gethostbyname.return_value = '10.0.0.1'
+        with self.assertRaises(IOError):
+            fetch.check_uri('ssh://host/no/such/file')
+
+    @patch('trollflow_sat.fetch.socket.gethostbyname')
+    @patch('trollflow_sat.fetch.get_local_ips')
+    def test_is_uri_on_server(self, get_local_ips, gethostbyname):
+        get_local_ips.return_value = ['127.0.0.1']
+        gethostbyname.return_value = '127.0.0.1'
+        uri = 'ssh://localhost' + self.fname
+        self.assertTrue(fetch.is_uri_on_server(uri))
+        self.assertTrue(fetch.is_uri_on_server(uri, strict=True))
+        self.assertFalse(fetch.is_uri_on_server('ssh://localhost/no/file'))
+        gethostbyname.return_value = '10.0.0.1'
+        fetch.RESOLVER.clear()
+        self.assertFalse(fetch.is_uri_on_server(uri))
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    connections = []
+
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ServerTestCase(unittest.TestCase):
+
+    """Base class for tests using files served over HTTP"""
+
+    def setUp(self):
+        self.srv_dir = tempfile.mkdtemp()
+        self.dest_dir = tempfile.mkdtemp()
+        self.fnames = []
+        for i in range(6):
+            fname = 'segment_%d.dat' % i
+            with open(os.path.join(self.srv_dir, fname), 'wb') as fid:
+                fid.write(os.urandom(100000 + i))
+            self.fnames.append(fname)
+
+        srv_dir = self.srv_dir
+
+        class Handler(_Handler):
+            connections = []
+
+            def translate_path(self, path):
+                return os.path.join(srv_dir, path.lstrip('/'))
+
+        self.handler = Handler
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.srv_dir)
+        shutil.rmtree(self.dest_dir)
+
+    def _check_file(self, path, fname):
+        self.assertEqual(os.path.dirname(path), self.dest_dir)
+        with open(path, 'rb') as fid:
+            fetched = fid.read()
+        with open(os.path.join(self.srv_dir, fname), 'rb') as fid:
+            self.assertEqual(fetched, fid.read())
+
+
+class TestDownload(_ServerTestCase):
+
+    def test_download(self):
+        pool = fetch.ConnectionPool(max_connections=1)
+        for fname in self.fnames:
+            path = fetch.download(self.base + fname, self.dest_dir,
+                                  pool=pool)
+            self._check_file(path, fname)
+        # The connection is reused
+        self.assertEqual(len(self.handler.connections), 1)
+        pool.close()
+
+    def test_download_stale_connection(self):
+        from six.moves import http_client
+        from six.moves.urllib.parse import urlparse
+
+        class StaleConnection(object):
+            reusable = True
+            closed = False
+
+            def fetch(self, url, fileobj):
+                fileobj.write(b'partial')
+                raise http_client.BadStatusLine('')
+
+            def close(self):
+                self.closed = True
+
+        pool = fetch.ConnectionPool(max_connections=1)
+        url = urlparse(self.base)
+        stale = StaleConnection()
+        pool._idle[(url.scheme, url.netloc)] = [stale]
+        path = fetch.download(self.base + self.fnames[0], self.dest_dir,
+                              pool=pool)
+        # The stale connection is dropped, and the file is fetched again
+        self._check_file(path, self.fnames[0])
+        self.assertTrue(stale.closed)
+        self.assertEqual(len(self.handler.connections), 1)
+        pool.close()
+
+    def test_download_missing(self):
+        with self.assertRaises(IOError):
+            fetch.download(self.base + 'missing', self.dest_dir)
+        # No partial files are left
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+    def test_fetch_files(self):
+        msg = Message('/topic', 'dataset',
+                      {'dataset': [{'uri': self.base + fname,
+                                    'uid': fname}
+                                   for fname in self.fnames]})
+        pool = fetch.ConnectionPool(max_connections=2)
+        res = fetch.fetch_files(msg, self.dest_dir, pool=pool, workers=4)
+        for dset, fname in zip(res.data['dataset'], self.fnames):
+            self._check_file(dset['uri'], fname)
+        self.assertEqual(sorted(os.listdir(self.dest_dir)),
+                         sorted(self.fnames))
+        # At most two connections are used
+        self.assertTrue(len(self.handler.connections) <= 2)
+        pool.close()
+
+    def test_unknown_scheme(self):
+        with self.assertRaises(NotImplementedError):
+            fetch.download('gopher://127.0.0.1/file', self.dest_dir)
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+
+class TestFetcher(unittest.TestCase):
+
+    @patch('trollflow_sat.fetch.fetch_files')
+    def test_invoke_failure(self, fetch_files):
+        from threading import Lock
+        fetch_files.side_effect = IOError
+        context = {'use_lock': True, 'prev_lock': Lock(), 'lock': Lock(),
+                   'content': None, 'output_queue': None}
+        fetcher = fetch.Fetcher()
+        with self.assertRaises(IOError):
+            fetcher.invoke(context)
+        # The previous worker isn't left locked
+        self.assertFalse(context['prev_lock'].locked())
+        self.assertFalse(context['lock'].locked())
+
+
+class TestFetchCache(_ServerTestCase):
+
+    def setUp(self):
+        super(TestFetchCache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestFetchCache, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_path(self):
+        cache = fetch.FetchCache(self.cache_dir)
+        path = cache.get_path('segment_0.dat')
+        self.assertTrue(path.startswith(self.cache_dir))
+        self.assertEqual(path, cache.get_path('segment_0.dat'))
+        self.assertNotEqual(path, cache.get_path('segment_1.dat'))
+        self.assertIsNone(cache.get('segment_0.dat'))
+
+    def test_fetch(self):
+        cache = fetch.FetchCache(self.cache_dir)
+        msg = Message('/topic', 'dataset',
+                      {'dataset': [{'uri': self.base + fname,
+                                    'uid': fname}
+                                   for fname in self.fnames]})
+        job_dirs = [os.path.join(self.dest_dir, 'job1'),
+                    os.path.join(self.dest_dir, 'job2')]
+        for job_dir in job_dirs:
+            os.mkdir(job_dir)
+            res = fetch.fetch_files(msg, job_dir, cache=cache)
+            for dset, fname in zip(res.data['dataset'], self.fnames):
+                self.assertEqual(dset['uri'], os.path.join(job_dir, fname))
+                with open(dset['uri'], 'rb') as fid:
+                    fetched = fid.read()
+                with open(os.path.join(self.srv_dir, fname), 'rb') as fid:
+                    self.assertEqual(fetched, fid.read())
+        self.assertEqual(cache.misses, len(self.fnames))
+        self.assertEqual(cache.hits, len(self.fnames))
+        # The job files are links to the cached files
+        for fname in self.fnames:
+            self.assertTrue(os.path.samefile(
+                os.path.join(job_dirs[0], fname),
+                os.path.join(job_dirs[1], fname)))
+            self.assertTrue(os.path.samefile(
+                os.path.join(job_dirs[0], fname), cache.get(fname)))
+
+    def test_evict(self):
+        cache = fetch.FetchCache(self.cache_dir, max_size=250000)
+        for i, fname in enumerate(self.fnames[:3]):
+            cache.fetch(self.base + fname, self.dest_dir, key=fname)
+            os.utime(cache.get_path(fname), (i, i))
+        # The least recently used file is removed
+        cache.evict()
+        self.assertIsNone(cache.get(self.fnames[0]))
+        self.assertIsNotNone(cache.get(self.fnames[1]))
+        self.assertIsNotNone(cache.get(self.fnames[2]))
+        # The linked file is still usable
+        self.assertTrue(os.path.exists(os.path.join(self.dest_dir,
+                                                    self.fnames[0])))
+
+
+    def test_evict_running_size(self):
+        cache = fetch.FetchCache(self.cache_dir, max_size=10 ** 7)
+        with patch('trollflow_sat.fetch.os.walk', wraps=os.walk) as walk:
+            for fname in self.fnames:
+                cache.fetch(self.base + fname, self.dest_dir, key=fname)
+        # The cache is scanned only once while below the limit
+        self.assertEqual(walk.call_count, 1)
+
+    def test_evict_other_processes(self):
+        fname = self.fnames[0]
+        size = os.path.getsize(os.path.join(self.srv_dir, fname))
+        cache = fetch.FetchCache(self.cache_dir, max_size=2 * size + 10)
+        cache.fetch(self.base + fname, self.dest_dir, key=fname)
+        # Another process sharing the cache adds files
+        other = fetch.FetchCache(self.cache_dir)
+        for i, fname in enumerate(self.fnames[1:3]):
+            other.fetch(self.base + fname, None, key=fname)
+            os.utime(other.get_path(fname), (i, i))
+        cache.evict()
+        self.assertTrue(os.path.exists(cache.get_path(self.fnames[1])))
+        # and they are seen once the last scan is old enough
+        cache._scanned -= fetch.CACHE_SCAN_INTERVAL
+        cache.evict()
+        self.assertIsNone(cache.get(self.fnames[1]))
+        self.assertIsNotNone(cache.get(self.fnames[2]))
+
+    def test_evict_large_file(self):
+        cache = fetch.FetchCache(self.cache_dir, max_size=1000)
+        path = cache.fetch(self.base + self.fnames[0], self.dest_dir,
+                           key=self.fnames[0])
+        # A file larger than the cache is still fetched
+        self._check_file(path, self.fnames[0])
+        self.assertIsNotNone(cache.get(self.fnames[0]))
+        # and evicted when the next file is added
+        cache.fetch(self.base + self.fnames[1], self.dest_dir,
+                    key=self.fnames[1])
+        self.assertIsNone(cache.get(self.fnames[0]))
+        self.assertIsNotNone(cache.get(self.fnames[1]))
+
+    def test_evicted_before_link(self):
+        cache = fetch.FetchCache(self.cache_dir)
+        fname = self.fnames[0]
+        cache.fetch(self.base + fname, None, key=fname)
+        # Another process removes the file after it has been found
+        cached = cache.get(fname)
+        os.remove(cached)
+        with patch.object(cache, 'get', return_value=cached):
+            path = cache.fetch(self.base + fname, self.dest_dir, key=fname)
+        self._check_file(path, fname)
+        self.assertEqual(cache.misses, 2)
+
+
+class TestDecompress(unittest.TestCase):
+
+    def setUp(self):
+        import bz2
+        import gzip
+        self.src_dir = tempfile.mkdtemp()
+        self.dest_dir = tempfile.mkdtemp()
+        self.data = os.urandom(1000) * 100
+        self.paths = []
+        for ext, opener in [('.bz2', bz2.BZ2File), ('.gz', gzip.GzipFile)]:
+            path = os.path.join(self.src_dir, 'segment' + ext)
+            with opener(path, 'wb') as fid:
+                fid.write(self.data)
+            self.paths.append(path)
+        self.msg = Message('/topic', 'dataset',
+                           {'dataset': [{'uri': path,
+                                         'uid': os.path.basename(path)}
+                                        for path in self.paths]})
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(self.dest_dir)
+
+    def _check(self, res):
+        for dset in res.data['dataset']:
+            self.assertEqual(os.path.dirname(dset['uri']), self.dest_dir)
+            self.assertEqual(dset['uid'], 'segment')
+            with open(dset['uri'], 'rb') as fid:
+                self.assertEqual(fid.read(), self.data)
+
+    def test_is_compressed(self):
+        self.assertTrue(fetch.is_compressed('/path/to/file.bz2'))
+        self.assertTrue(fetch.is_compressed('/path/to/file.gz'))
+        self.assertFalse(fetch.is_compressed('/path/to/file.nc'))
+
+    def test_decompress(self):
+        res = fetch.fetch_files(self.msg, self.dest_dir, decompress=True)
+        self._check(res)
+        self.assertEqual(os.listdir(self.dest_dir), ['segment'])
+        # The original files are untouched
+        res = fetch.fetch_files(self.msg, self.dest_dir)
+        self.assertEqual([dset['uri'] for dset in res.data['dataset']],
+                         self.paths)
+
+    def test_decompress_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = fetch.FetchCache(cache_dir)
+            msg = Message('/topic', 'file', {'uri': self.paths[0],
+                                             'uid': 'segment.bz2'})
+            for _ in range(2):
+                res = fetch.fetch_files(msg, self.dest_dir, cache=cache,
+                                        decompress=True)
+                self.assertEqual(res.data['uid'], 'segment')
+                with open(res.data['uri'], 'rb') as fid:
+                    self.assertEqual(fid.read(), self.data)
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(cache.hits, 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_prefetch_decompress(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            prefetcher = fetch.Prefetcher(cache_dir=cache_dir,
+                                          decompress=True)
+            prefetcher.submit(self.msg)
+            prefetcher.wait()
+            prefetcher.close()
+            self.assertEqual(prefetcher.cache.misses, len(self.paths))
+            # The Fetcher finds the decompressed files in the cache
+            cache = fetch.FetchCache(cache_dir)
+            res = fetch.fetch_files(self.msg, self.dest_dir, cache=cache,
+                                    decompress=True)
+            self._check(res)
+            self.assertEqual(cache.hits, len(self.paths))
+            self.assertEqual(cache.misses, 0)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class TestPrefetcher(_ServerTestCase):
+
+    def test_prefetch(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            prefetcher = fetch.Prefetcher(cache_dir=cache_dir, workers=2)
+            for fname in self.fnames:
+                prefetcher.submit(Message('/topic', 'file',
+                                          {'uri': self.base + fname,
+                                           'uid': fname}))
+            prefetcher.wait()
+            prefetcher.close()
+            self.assertEqual(prefetcher.cache.misses, len(self.fnames))
+            # The Fetcher finds the files in the cache
+            cache = fetch.FetchCache(cache_dir)
+            msg = Message('/topic', 'dataset',
+                          {'dataset': [{'uri': self.base + fname,
+                                        'uid': fname}
+                                       for fname in self.fnames]})
+            res = fetch.fetch_files(msg, self.dest_dir, cache=cache)
+            self.assertEqual(cache.hits, len(self.fnames))
+            self.assertEqual(cache.misses, 0)
+            for dset, fname in zip(res.data['dataset'], self.fnames):
+                self._check_file(dset['uri'], fname)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @patch('trollflow_sat.fetch.warm_page_cache')
+    def test_prefetch_local(self, warm_page_cache):
+        prefetcher = fetch.Prefetcher(mode="page_cache")
+        path = os.path.join(self.srv_dir, self.fnames[0])
+        prefetcher.submit(Message('/topic', 'file', {'uri': path}))
+        # Remote files are not fetched without a cache
+        prefetcher.submit(Message('/topic', 'file',
+                                  {'uri': self.base + self.fnames[1]}))
+        prefetcher.wait()
+        prefetcher.close()
+        warm_page_cache.assert_called_once_with(path)
+        self.assertEqual(self.handler.connections, [])
+
+    def test_warm_page_cache(self):
+        fetch.warm_page_cache(os.path.join(self.srv_dir, self.fnames[0]))
+
+
+def suite():
+    """The suite for test_fetch
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestResolver))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestLocalAddresses))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestCheckUri))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDownload))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestFetcher))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestFetchCache))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDecompress))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPrefetcher))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
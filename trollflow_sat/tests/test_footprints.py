@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for granule footprints"""
+
+import datetime as dt
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from trollflow_sat import footprints
+
+TLE = """NOAA 19
+1 33591U 09005A   21355.91138073  .00000074  00000+0  65091-4 0  9998
+2 33591  99.1688  21.1338 0013414 329.8936  30.1462 14.12516400663123
+"""
+
+START_TIME = dt.datetime(2021, 12, 22, 12, 0)
+
+
+def _get_distance(lon1, lat1, lon2, lat2):
+    """Great circle distance in degrees"""
+    lon1, lat1, lon2, lat2 = np.radians([lon1, lat1, lon2, lat2])
+    return np.degrees(np.arccos(np.clip(
+        np.sin(lat1) * np.sin(lat2) +
+        np.cos(lat1) * np.cos(lat2) * np.cos(lon2 - lon1), -1, 1)))
+
+
+class TestFootprints(unittest.TestCase):
+
+    def setUp(self):
+        fid, self.tle_file = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fid, 'w') as tle:
+            tle.write(TLE)
+        footprints.clear_cache()
+
+    def tearDown(self):
+        os.remove(self.tle_file)
+        footprints.clear_cache()
+
+    def test_get_footprint(self):
+        end_time = START_TIME + dt.timedelta(minutes=1)
+        lons, lats = footprints.get_footprint('NOAA 19', START_TIME,
+                                              end_time, instrument='avhrr/3',
+                                              tle_file=self.tle_file)
+        num = footprints.NUM_TRACK_POINTS
+        self.assertEqual(lons.shape, (2 * num, ))
+        self.assertEqual(lats.shape, (2 * num, ))
+        # The swath of AVHRR is about 2900 km wide, 26 degrees
+        width = _get_distance(lons[0], lats[0], lons[-1], lats[-1])
+        self.assertTrue(24. < width < 28.)
+        # One minute of flight is about 400 km, 3.6 degrees
+        length = _get_distance(lons[0], lats[0], lons[num - 1],
+                               lats[num - 1])
+        self.assertTrue(3. < length < 4.5)
+
+        # Narrower swath for instruments with smaller scan angle
+        lons, lats = footprints.get_footprint('NOAA 19', START_TIME,
+                                              end_time, instrument='mhs',
+                                              tle_file=self.tle_file)
+        self.assertTrue(_get_distance(lons[0], lats[0],
+                                      lons[-1], lats[-1]) < width)
+
+    def test_get_footprints(self):
+        times = [(START_TIME + dt.timedelta(minutes=i),
+                  START_TIME + dt.timedelta(minutes=i + 1))
+                 for i in range(10)]
+        res = footprints.get_footprints('NOAA 19', times,
+                                        tle_file=self.tle_file)
+        self.assertEqual(len(res), 10)
+        footprints.clear_cache()
+        for (start_time, end_time), (lons, lats) in zip(times, res):
+            single = footprints.get_footprint('NOAA 19', start_time,
+                                              end_time,
+                                              tle_file=self.tle_file)
+            np.testing.assert_allclose(single[0], lons)
+            np.testing.assert_allclose(single[1], lats)
+
+    @patch('trollflow_sat.footprints._compute_footprints')
+    def test_cache(self, compute):
+        compute.side_effect = lambda platform, times, *args: \
+            [(i, i) for i in range(len(times))]
+        times = [(START_TIME, START_TIME + dt.timedelta(minutes=1))]
+        footprints.get_footprints('NOAA 19', times)
+        footprints.get_footprints('NOAA 19', times)
+        self.assertEqual(compute.call_count, 1)
+        # Only the missing footprints are computed
+        times.append((START_TIME + dt.timedelta(minutes=1),
+                      START_TIME + dt.timedelta(minutes=2)))
+        footprints.get_footprints('NOAA 19', times)
+        self.assertEqual(compute.call_count, 2)
+        self.assertEqual(compute.mock_calls[-1][1][1], times[1:])
+
+    @patch('trollflow_sat.footprints.Pass')
+    def test_get_overpass(self, Pass):
+        end_time = START_TIME + dt.timedelta(minutes=1)
+        res = footprints.get_overpass('NOAA 19', START_TIME, end_time,
+                                      instrument='avhrr')
+        self.assertTrue(res is Pass.return_value)
+        footprints.get_overpass('NOAA 19', START_TIME, end_time,
+                                instrument='avhrr')
+        self.assertEqual(Pass.call_count, 1)
+
+    @patch('trollflow_sat.footprints.Pass')
+    def test_get_overpass_footprint(self, Pass):
+        from pyresample.geometry import AreaDefinition
+        end_time = START_TIME + dt.timedelta(minutes=3)
+        lons, lats = footprints.get_footprints(
+            'NOAA 19', [(START_TIME, end_time)], instrument=['avhrr/3'],
+            tle_file=self.tle_file)[0]
+        # The footprints computed beforehand are used for the coverage
+        res = footprints.get_overpass('NOAA 19', START_TIME, end_time,
+                                      instrument='avhrr/3')
+        self.assertFalse(Pass.called)
+        self.assertTrue(isinstance(res, footprints.Footprint))
+
+        def create_area(lon, lat, size):
+            return AreaDefinition('area', 'area', 'area',
+                                  {'proj': 'longlat', 'ellps': 'WGS84'},
+                                  10, 10, (lon - size, lat - size,
+                                           lon + size, lat + size))
+
+        num = footprints.NUM_TRACK_POINTS
+        center_lon = np.mean(lons[[num // 2, -num // 2]])
+        center_lat = np.mean(lats[[num // 2, -num // 2]])
+        self.assertAlmostEqual(
+            res.area_coverage(create_area(center_lon, center_lat, 1.)), 1.,
+            places=3)
+        self.assertEqual(
+            res.area_coverage(create_area(center_lon + 90., center_lat, 1.)),
+            0.)
+        # The swath edge crosses the area in the middle
+        coverage = res.area_coverage(create_area(lons[num // 2],
+                                                 lats[num // 2], 1.))
+        self.assertTrue(0.3 < coverage < 0.7)
+
+    def test_get_lonlat_bbox(self):
+        lons = np.array([10., 20., 20., 10.])
+        lats = np.array([50., 50., 60., 60.])
+        self.assertEqual(footprints.get_lonlat_bbox(lons, lats),
+                         (10., 50., 20., 60.))
+        # Crossing the antimeridian
+        lons = np.array([170., -170., -170., 170.])
+        self.assertEqual(footprints.get_lonlat_bbox(lons, lats),
+                         (170., 50., -170., 60.))
+        # Around the north pole
+        lons = np.array([0., 90., 180., -90.])
+        lats = np.array([80., 80., 80., 80.])
+        self.assertEqual(footprints.get_lonlat_bbox(lons, lats),
+                         (-180., 80., 180., 90.))
+        # No valid points, as in the corners of a full disk
+        lons = np.full(4, np.inf)
+        self.assertIsNone(footprints.get_lonlat_bbox(lons, lats))
+        lons = np.full(4, np.nan)
+        self.assertIsNone(footprints.get_lonlat_bbox(lons, lats))
+
+    def test_get_area_bbox(self):
+        from pyresample.geometry import AreaDefinition
+        area = AreaDefinition('pac', 'pac', 'pac',
+                              {'proj': 'longlat', 'ellps': 'WGS84',
+                               'lon_0': 180}, 100, 100, (-20, -10, 20, 10))
+        bbox = footprints.get_area_bbox(area)
+        self.assertTrue(bbox[0] > bbox[2])
+        np.testing.assert_allclose(bbox, (160., -10., -160., 10.),
+                                   atol=0.5)
+
+
+def suite():
+    """The suite for test_footprints
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestFootprints))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for memory use tracking"""
+
+import datetime as dt
+import logging
+import unittest
+
+import numpy as np
+import xarray as xr
+try:
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
+
+from trollflow_sat import memory
+
+
+class MockScene(list):
+
+    def __init__(self, datasets, attrs):
+        super(MockScene, self).__init__(datasets)
+        self.attrs = attrs
+
+
+class TestMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.scene = MockScene(
+            [xr.DataArray(np.zeros((10, 10), dtype=np.float32)),
+             xr.DataArray(np.zeros((10, 10), dtype=np.float64))],
+            {'platform_name': 'NOAA-19',
+             'start_time': dt.datetime(2019, 1, 1, 12, 0)})
+
+    def test_rss(self):
+        peak = memory.get_peak_rss()
+        self.assertTrue(peak > 1024 * 1024)
+        rss = memory.get_rss()
+        if rss is not None:
+            self.assertTrue(rss > 0)
+
+    def test_scene_nbytes(self):
+        self.assertEqual(memory.get_scene_nbytes(self.scene), 1200)
+        self.assertEqual(memory.get_scene_nbytes(None), 0)
+
+    def test_get_slot_id(self):
+        self.assertEqual(memory.get_slot_id(self.scene.attrs),
+                         'NOAA-19_20190101_120000')
+
+    def test_track(self):
+        logger = logging.getLogger('test_memory')
+        stats = memory.track('Resampler', self.scene, logger=logger,
+                             area_id='euro4')
+        self.assertEqual(stats['slot'], 'NOAA-19_20190101_120000')
+        self.assertEqual(stats['scene_nbytes'], 1200)
+        self.assertEqual(stats['area_id'], 'euro4')
+        self.assertEqual(memory.get_stats()['Resampler'], stats)
+
+        logger = Mock()
+        memory.track('Resampler', self.scene, logger=logger)
+        self.assertFalse(logger.warning.called)
+        stats = memory.track('Resampler', self.scene, logger=logger,
+                             threshold=1)
+        if stats['rss'] is not None:
+            self.assertTrue(logger.warning.called)
+
+    @patch('trollflow_sat.memory.get_rss')
+    def test_track_delta(self, get_rss):
+        logger = Mock()
+        get_rss.return_value = 100 * memory.MEGABYTE
+        memory.start(self.scene)
+        stats = memory.track('SceneLoader', self.scene, logger=logger)
+        self.assertEqual(stats['rss_delta'], 0)
+        # The current RSS is compared to the threshold, not the peak
+        get_rss.return_value = 150 * memory.MEGABYTE
+        stats = memory.track('Resampler', self.scene, logger=logger,
+                             threshold=200)
+        self.assertEqual(stats['rss_delta'], 50 * memory.MEGABYTE)
+        self.assertFalse(logger.warning.called)
+        stats = memory.track('Resampler', self.scene, logger=logger,
+                             threshold=120)
+        self.assertTrue(logger.warning.called)
+        # Unknown start of the scene
+        stats = memory.track('Resampler', slot_id='unknown', logger=logger)
+        self.assertIsNone(stats['rss_delta'])
+
+
+def suite():
+    """The suite for test_memory
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestMemory))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for profiling"""
+
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from trollflow_sat import profiling
+
+
+def _add(val1, val2):
+    return val1 + val2
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.profiler = profiling.Profiler()
+        self.profiler.output_dir = self.output_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_is_armed(self):
+        self.assertFalse(self.profiler.is_armed('foo'))
+        self.profiler.arm(2)
+        for _ in range(2):
+            self.assertTrue(self.profiler.is_armed('foo'))
+            self.assertTrue(self.profiler.is_armed('bar'))
+        self.assertFalse(self.profiler.is_armed('foo'))
+        self.assertFalse(self.profiler.is_armed('bar'))
+
+    def test_run(self):
+        self.assertEqual(self.profiler.run('foo', _add, 1, val2=2), 3)
+        self.assertEqual(os.listdir(self.output_dir), [])
+        self.profiler.arm(1)
+        self.assertEqual(self.profiler.run('foo', _add, 1, val2=2), 3)
+        fnames = sorted(os.listdir(self.output_dir))
+        self.assertTrue(fnames[0].startswith('foo_'))
+        self.assertTrue(fnames[0].endswith('.prof'))
+        if len(fnames) > 1:
+            self.assertTrue(fnames[1].endswith('_dask.txt'))
+        # The stats can be read
+        import pstats
+        pstats.Stats(os.path.join(self.output_dir, fnames[0]))
+
+    def test_run_exception(self):
+        def _fail():
+            raise ValueError
+        self.profiler.arm(1)
+        with self.assertRaises(ValueError):
+            self.profiler.run('foo', _fail)
+        self.assertTrue(os.listdir(self.output_dir))
+
+    def test_configure(self):
+        config = {'items': 2, 'output_dir': self.output_dir}
+        self.profiler.configure(config)
+        self.assertTrue(self.profiler.is_armed('foo'))
+        # The same configuration doesn't arm again
+        self.profiler.configure(config)
+        self.assertTrue(self.profiler.is_armed('foo'))
+        self.assertFalse(self.profiler.is_armed('foo'))
+        self.profiler.configure(None)
+        self.assertFalse(self.profiler.is_armed('foo'))
+
+    def test_configure_alternating(self):
+        loader_config = {'items': 1, 'output_dir': self.output_dir}
+        resampler_config = {'items': 2, 'output_dir': self.output_dir}
+        self.profiler.configure(loader_config)
+        self.profiler.configure(resampler_config)
+        for _ in range(2):
+            self.assertTrue(self.profiler.is_armed('foo'))
+        # The components passing their configurations again don't arm
+        # the profiler again
+        self.profiler.configure(loader_config)
+        self.profiler.configure(resampler_config)
+        self.assertFalse(self.profiler.is_armed('foo'))
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), "No SIGUSR1")
+    def test_signal(self):
+        orig = signal.getsignal(signal.SIGUSR1)
+        try:
+            self.profiler.configure({'items': 1, 'signal': 'SIGUSR1'})
+            self.assertTrue(self.profiler.is_armed('foo'))
+            self.assertFalse(self.profiler.is_armed('foo'))
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertTrue(self.profiler.is_armed('foo'))
+        finally:
+            signal.signal(signal.SIGUSR1, orig)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), "No SIGUSR1")
+    def test_signal_worker_thread(self):
+        orig = signal.getsignal(signal.SIGUSR1)
+        try:
+            thread = threading.Thread(
+                target=self.profiler.configure,
+                args=({'items': 1, 'signal': 'SIGUSR1'}, ))
+            thread.start()
+            thread.join()
+            # The handler isn't installed from the worker thread
+            self.assertIs(signal.getsignal(signal.SIGUSR1), orig)
+            self.assertTrue(self.profiler.is_armed('foo'))
+            self.assertFalse(self.profiler.is_armed('foo'))
+            # but from the main thread
+            self.profiler.install_signal_handler()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertTrue(self.profiler.is_armed('foo'))
+        finally:
+            signal.signal(signal.SIGUSR1, orig)
+
+    def test_profiled(self):
+        with patch('trollflow_sat.profiling.PROFILER', self.profiler):
+            func = profiling.profiled('add')(_add)
+            self.profiler.arm(1)
+            self.assertEqual(func(1, 2), 3)
+            self.assertEqual(func(1, 2), 3)
+        self.assertEqual(len([fname for fname in os.listdir(self.output_dir)
+                              if fname.endswith('.prof')]), 1)
+
+
+def suite():
+    """The suite for test_profiling
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestProfiler))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for message recording and replaying"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from copy import deepcopy
+
+import six.moves.queue as queue
+import yaml
+from posttroll.message import Message
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from trollflow_sat import replay
+from trollflow_sat.tests.test_segment_gatherer import CONFIG, create_message
+from trollflow_sat.tests.utils import write_yaml
+
+class FakeLoader(object):
+
+    """SceneLoader putting one scene per area and a terminator to the
+    output queue"""
+
+    contexts = []
+
+    def invoke(self, context):
+        self.contexts.append(context)
+        time.sleep(0.05)
+        for area_id in context['areas']:
+            context['output_queue'].put({'scene': 'scene',
+                                         'extra_metadata':
+                                         {'area_id': area_id}})
+            context['output_queue'].put(None)
+
+
+SEGMENTS = [('', 'PRO'), ('VIS006', '000007'), ('VIS006', '000008'),
+            ('IR_108', '000007'), ('IR_108', '000008'), ('', 'EPI')]
+
+
+class TestRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tempdir, 'messages.log')
+
+    def tearDown(self):
+        for recorder in replay._RECORDERS.values():
+            recorder.close()
+        replay._RECORDERS.clear()
+        shutil.rmtree(self.tempdir)
+
+    def test_record_and_read(self):
+        recorder = replay.get_recorder(self.fname)
+        self.assertTrue(replay.get_recorder(self.fname) is recorder)
+        msg1 = create_message('VIS006', '000007')
+        msg2 = Message('/topic', 'dataset', {'dataset': [msg1.data]})
+        recorder.record(msg1, stage='SegmentGatherer')
+        recorder.record(msg2, stage='SceneLoader')
+        recorder.close()
+
+        records = list(replay.read_records(self.fname))
+        self.assertEqual(len(records), 2)
+        self.assertTrue(records[0][0] <= records[1][0])
+        self.assertEqual(records[0][1], 'SegmentGatherer')
+        self.assertEqual(records[0][2].data, msg1.data)
+        self.assertEqual(records[1][2].type, 'dataset')
+
+        records = list(replay.read_records(self.fname, stage='SceneLoader'))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][1], 'SceneLoader')
+
+    def test_gatherer_recording(self):
+        config = deepcopy(CONFIG)
+        config["config"]["record_messages"] = self.fname
+        config_fname = write_yaml(config)
+        try:
+            from trollflow_sat.segment_gatherer import SegmentGatherer
+            gatherer = SegmentGatherer(config_fname, None, queue.Queue())
+            gatherer._add_file(create_message('VIS006', '000007'))
+        finally:
+            os.remove(config_fname)
+        records = list(replay.read_records(self.fname))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][1], 'SegmentGatherer')
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertIsNone(replay.percentile([], 50))
+        values = list(range(101))[::-1]
+        self.assertEqual(replay.percentile(values, 50), 50)
+        self.assertEqual(replay.percentile(values, 99), 99)
+        self.assertEqual(replay.percentile(values, 100), 100)
+
+    def test_stats(self):
+        stats = replay.ReplayStats()
+        msg1 = create_message('VIS006', '000007')
+        msg2 = create_message('VIS006', '000008')
+        stats.sent(msg1)
+        time.sleep(0.05)
+        stats.sent(msg2)
+        time.sleep(0.05)
+        probe = replay.QueueProbe('stage', stats, queue.Queue())
+        probe.put(Message('/topic', 'dataset',
+                          {'dataset': [msg1.data, msg2.data]}))
+        probe.put(None)
+        self.assertEqual(probe.output_queue.qsize(), 2)
+        report = stats.report()['stage']
+        self.assertEqual(report['count'], 1)
+        # Latency is counted from the newest file of the dataset
+        self.assertTrue(0.05 <= report['p50'] < 0.1)
+        self.assertEqual(report['p50'], report['max'])
+        self.assertTrue(report['throughput'] > 0)
+
+    def test_replay_speed(self):
+        records = [(100. + i, 'SegmentGatherer', create_message(*seg))
+                   for i, seg in enumerate(SEGMENTS[:3])]
+        records.insert(1, (100.5, 'other', create_message(*SEGMENTS[3])))
+        in_queue = queue.Queue()
+
+        tic = time.time()
+        replayer = replay.Replayer(records, {'SegmentGatherer': in_queue},
+                                   speed=10.)
+        self.assertEqual(replayer.replay(), 3)
+        self.assertTrue(0.2 <= time.time() - tic < 1.)
+        self.assertEqual(in_queue.qsize(), 3)
+
+        tic = time.time()
+        replay.Replayer(records, {'SegmentGatherer': in_queue},
+                        speed=None).replay()
+        self.assertTrue(time.time() - tic < 0.1)
+        self.assertEqual(in_queue.qsize(), 6)
+
+    def test_replay_to_gatherer(self):
+        tempdir = tempfile.mkdtemp()
+        fname = os.path.join(tempdir, 'messages.log')
+        config_fname = write_yaml(CONFIG)
+        try:
+            recorder = replay.MessageRecorder(fname)
+            for seg in SEGMENTS:
+                recorder.record(create_message(*seg),
+                                stage='SegmentGatherer')
+            recorder.close()
+            report = replay.replay_to_gatherer(fname, config_fname,
+                                               speed=None, wait=0.2)
+        finally:
+            os.remove(config_fname)
+            shutil.rmtree(tempdir)
+        self.assertEqual(report['SegmentGatherer']['count'], 1)
+        self.assertTrue(report['SegmentGatherer']['max'] < 0.5)
+
+    def test_replay_production_config(self):
+        tempdir = tempfile.mkdtemp()
+        fname = os.path.join(tempdir, 'messages.log')
+        config = deepcopy(CONFIG)
+        config['config'].update({
+            'record_messages': fname,
+            'journal': os.path.join(tempdir, 'journal'),
+            'prefetch': {'destination': tempdir}})
+        config_fname = write_yaml(config)
+        try:
+            recorder = replay.MessageRecorder(fname)
+            # The EPI segment is missing, so the slot is published only
+            # at the timeout
+            for seg in SEGMENTS[:-1]:
+                recorder.record(create_message(*seg),
+                                stage='SegmentGatherer')
+            recorder.close()
+            report = replay.replay_to_gatherer(fname, config_fname,
+                                               speed=None, wait=0.1)
+            # The replayed messages aren't recorded again, and the
+            # journal isn't written
+            self.assertEqual(len(list(replay.read_records(fname))), 5)
+            self.assertEqual(os.listdir(tempdir), ['messages.log'])
+        finally:
+            os.remove(config_fname)
+            shutil.rmtree(tempdir)
+            for recorder in replay._RECORDERS.values():
+                recorder.close()
+            replay._RECORDERS.clear()
+        # The open slot is published after the replay
+        self.assertEqual(report['SegmentGatherer']['count'], 1)
+
+    def test_replay_config_speed(self):
+        config_fname = write_yaml(CONFIG)
+        try:
+            fname = replay._write_replay_config(config_fname, 10.)
+            with open(fname) as fid:
+                config = yaml.load(fid, Loader=yaml.Loader)
+            os.remove(fname)
+        finally:
+            os.remove(config_fname)
+        # The timeouts are scaled by the speed
+        self.assertEqual(config['config']['timeliness'], 1.)
+
+    @patch('trollflow_sat.satpy_compositor.SceneLoader', FakeLoader)
+    def test_replay_to_loader(self):
+        tempdir = tempfile.mkdtemp()
+        fname = os.path.join(tempdir, 'messages.log')
+        config_fname = write_yaml({'areas': ['euron1', 'scan'],
+                                   'record_messages': fname})
+        FakeLoader.contexts = []
+        try:
+            recorder = replay.MessageRecorder(fname)
+            for seg in SEGMENTS[:2]:
+                msg = create_message(*seg)
+                recorder.record(msg, stage='SegmentGatherer')
+                recorder.record(Message('/topic', 'dataset',
+                                        {'dataset': [msg.data]}),
+                                stage='SceneLoader')
+            recorder.close()
+            report = replay.replay_to_loader(fname, config_fname)
+        finally:
+            os.remove(config_fname)
+            shutil.rmtree(tempdir)
+        self.assertEqual(len(FakeLoader.contexts), 2)
+        context = FakeLoader.contexts[0]
+        self.assertEqual(context['content'].type, 'dataset')
+        self.assertFalse(context['use_lock'])
+        self.assertNotIn('record_messages', context)
+        report = report['SceneLoader']
+        # One scene per area, latency counted from the replayed dataset
+        self.assertEqual(report['count'], 4)
+        self.assertTrue(0.05 <= report['p50'] < 0.5)
+
+
+def suite():
+    """The suite for test_replay
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestRecording))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestReplay))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
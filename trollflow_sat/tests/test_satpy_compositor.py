@@ -18,15 +18,16 @@
 
 import unittest
 try:
-    from unittest.mock import patch, Mock, call
+    from unittest.mock import patch, Mock, call, ANY
 except ImportError:
-    from mock import patch, Mock, call
+    from mock import patch, Mock, call, ANY
 import datetime as dt
 
 from trollflow_sat.satpy_compositor import SceneLoader
 from trollflow_sat.tests.utils import (write_yaml, PRODUCT_LIST,
                                        PRODUCT_LIST_TWO_AREAS,
                                        PRODUCT_LIST_TWO_AREAS_TOGETHER,
+                                       PRODUCT_LIST_PRIORITIES,
                                        METADATA_FILE, METADATA_DATASET,
                                        METADATA_COLLECTION,
                                        METADATA_COLLECTION_DATASET, MockScene)
@@ -43,6 +44,7 @@ class TestSceneLoader(unittest.TestCase):
         self.prodlist = write_yaml(PRODUCT_LIST)
         self.prodlist_2 = write_yaml(PRODUCT_LIST_TWO_AREAS)
         self.prodlist_2_together = write_yaml(PRODUCT_LIST_TWO_AREAS_TOGETHER)
+        self.prodlist_priorities = write_yaml(PRODUCT_LIST_PRIORITIES)
         self.lock = Lock()
         self.prev_lock = Lock()
         self.output_queue = queue.Queue()
@@ -121,11 +123,47 @@ class TestSceneLoader(unittest.TestCase):
                                                     service=None)])
         send_message.assert_has_calls([call(self.topic, 'monitor', {},
                                             nameservers=None, port=0),
-                                       call(self.topic, 'monitor', {},
+                                       call(self.topic, 'monitor',
+                                            {'memory': ANY},
                                             nameservers=None, port=0)])
         # Nothing has been put into the output queue
         self.assertEqual(self.output_queue.qsize(), 0)
 
+    @patch('trollflow_sat.satpy_compositor.SceneLoader.create_scene_from_message')
+    def test_invoke_duplicate(self, scene_from_msg):
+        context = self.context
+        context['instruments'] = ['spam']
+        context['product_list'] = self.prodlist
+        context['content'] = self.dataset_msg
+        context['deduplication'] = {'max_size': 10}
+        scene_from_msg.return_value = None
+        self.loader.invoke(context)
+        self.assertEqual(scene_from_msg.call_count, 1)
+        # The same data again is skipped
+        self.loader.invoke(context)
+        self.assertEqual(scene_from_msg.call_count, 1)
+        self.assertEqual(self.loader.deduplicator.suppressed, 1)
+        self.assertFalse(self.context['prev_lock'].locked())
+        self.assertFalse(self.context['lock'].locked())
+
+    @patch('trollflow_sat.satpy_compositor.SceneLoader.create_scene_from_message')
+    def test_invoke_duplicate_areas(self, scene_from_msg):
+        from posttroll.message import Message
+        context = self.context
+        context['instruments'] = ['spam']
+        context['product_list'] = self.prodlist
+        context['deduplication'] = {'max_size': 10}
+        scene_from_msg.return_value = None
+        # Collections of two regions sharing the same granules
+        for area_id in ['euron1', 'scan']:
+            context['content'] = Message(
+                self.topic, 'collection',
+                dict(METADATA_COLLECTION_DATASET,
+                     collection_area_id=area_id))
+            self.loader.invoke(context)
+        self.assertEqual(scene_from_msg.call_count, 2)
+        self.assertEqual(self.loader.deduplicator.suppressed, 0)
+
     @patch('trollflow_sat.satpy_compositor.SceneLoader.create_scene_from_message')
     def test_invoke_instrument_aliases(self, scene_from_msg):
         context = self.context
@@ -193,6 +231,75 @@ class TestSceneLoader(unittest.TestCase):
         res = self.output_queue.get(timeout=1)
         self.assertIsNone(res)
 
+    @patch('trollflow_sat.satpy_compositor.SceneLoader.load_composites')
+    @patch('trollflow_sat.satpy_compositor.SceneLoader.create_scene_from_message')
+    def test_invoke_scene_priorities(self, scene_from_msg, load_composites):
+        from posttroll.message import Message
+        context = self.context
+        context['instruments'] = ['spam']
+        context['product_list'] = self.prodlist_priorities
+        metadata = METADATA_FILE.copy()
+        metadata.pop('collection_area_id', None)
+        context['content'] = Message(self.topic, 'file', metadata)
+        scene_from_msg.return_value = self.scene
+        load_composites.side_effect = \
+            lambda glbl, conf, area_id, products, **kwargs: set(products)
+
+        self.loader.invoke(context)
+        # The high priority class is terminated before the rest:
+        # {area1: natural}, {area2: overview}, None, {area1: overview}, None
+        self.assertEqual(self.output_queue.qsize(), 5)
+        expected = [('area1', {'natural'}), ('area2', {'overview'}), None,
+                    ('area1', {'overview'}), None]
+        for exp in expected:
+            res = self.output_queue.get(timeout=1)
+            if exp is None:
+                self.assertIsNone(res)
+            else:
+                self.assertEqual(res['extra_metadata']['area_id'], exp[0])
+                self.assertEqual(res['extra_metadata']['products'], exp[1])
+
+    @patch('trollflow_sat.satpy_compositor.utils.bad_sunzen_range')
+    @patch('trollflow_sat.satpy_compositor.SceneLoader.create_scene_from_message')
+    def test_invoke_early_release(self, scene_from_msg, bad_sunzen_range):
+        from posttroll.message import Message
+        context = self.context
+        context['instruments'] = ['spam']
+        context['product_list'] = self.prodlist_priorities
+        context['early_release'] = True
+        metadata = METADATA_FILE.copy()
+        metadata.pop('collection_area_id', None)
+        context['content'] = Message(self.topic, 'file', metadata)
+        from satpy.dependency_tree import Node
+        scene = MockScene(attrs=METADATA_FILE)
+        # Loaded earlier, but not needed by any area
+        scene.load(['IR_108'])
+        scene._dependency_tree = {'overview': Node('overview')}
+        scene._dependency_tree['overview'].add_child(Node('VIS006'))
+        scene_from_msg.return_value = scene
+        # Natural colours are skipped for area1
+        bad_sunzen_range.side_effect = \
+            lambda conf, area_id, composite, start_time, **kwargs: \
+            composite == 'natural'
+
+        self.loader.invoke(context)
+        items = [itm for itm in self.output_queue.queue if itm is not None]
+        self.assertEqual(len(items), 3)
+        references = items[0]['extra_metadata']['references']
+        self.assertTrue(all(itm['extra_metadata']['references'] is
+                            references for itm in items))
+        # The composites needed by the other areas, and the channels
+        # they are generated from, are kept loaded, the rest are
+        # unloaded
+        self.assertEqual({dset.name for dset in scene.datasets},
+                         {'overview', 'VIS006'})
+        self.assertFalse(references.lock.locked())
+        self.assertFalse('natural' in references)
+        self.assertEqual(references.release(('area1', 10)), [])
+        self.assertEqual(references.release(('area2', 10)), [])
+        self.assertEqual(references.release(('area1', 0)),
+                         ['VIS006', 'overview'])
+
     def test_post_invoke(self):
         self.assertIsNone(self.loader.post_invoke())
 
@@ -269,6 +376,72 @@ class TestSceneLoader(unittest.TestCase):
         self.loader.load_composites(glbl_data, PRODUCT_LIST, 'area1')
         self.assertEqual(len(glbl_data.datasets), 1)
 
+        # Static fields are kept
+        glbl_data = MockScene(attrs=METADATA_FILE)
+        glbl_data.load(['satellite_zenith_angle', 'natural'])
+        self.loader.load_composites(glbl_data, PRODUCT_LIST, 'area1',
+                                    keep=['satellite_zenith_angle'])
+        self.assertEqual({dset.name for dset in glbl_data.datasets},
+                         {'satellite_zenith_angle', 'overview'})
+
+    @patch('trollflow_sat.utils.astronomy.sun_zenith_angle')
+    def test_load_composites_sunzen_memo(self, sun_zenith_angle):
+        from copy import deepcopy
+        import numpy as np
+        from trollflow_sat import utils
+        product_config = deepcopy(PRODUCT_LIST_TWO_AREAS)
+        for area_config in product_config['product_list'].values():
+            area_config['products']['overview'].update(
+                {'sunzen_day_maximum': 90., 'sunzen_lon': 25.,
+                 'sunzen_lat': 60.})
+        sun_zenith_angle.return_value = np.array([95.])
+        glbl_data = MockScene(attrs=METADATA_FILE)
+        self.loader.sunzen_memo.update(
+            glbl_data.attrs['start_time'],
+            utils.get_sunzen_points(product_config))
+        # The angle is computed once for all the areas
+        for area_id in ('area1', 'area2'):
+            self.assertEqual(self.loader.load_composites(
+                glbl_data, product_config, area_id), set())
+        sun_zenith_angle.assert_called_once()
+
+    @patch('trollflow_sat.static_fields.enable_satpy_cache')
+    @patch('trollflow_sat.static_fields.inject_fields')
+    @patch('trollflow_sat.satpy_compositor.SceneLoader.load_composites')
+    @patch('trollflow_sat.satpy_compositor.SceneLoader.create_scene_from_message')
+    def test_invoke_static_fields(self, scene_from_msg, load_composites,
+                                  inject_fields, enable_satpy_cache):
+        from posttroll.message import Message
+        context = self.context
+        context['instruments'] = ['spam']
+        context['product_list'] = self.prodlist
+        metadata = METADATA_FILE.copy()
+        metadata.pop('collection_area_id', None)
+        context['content'] = Message(self.topic, 'file', metadata)
+        context['static_fields'] = {'cache_dir': '/tmp',
+                                    'grid_dataset': 'IR_108'}
+        scene_from_msg.return_value = self.scene
+        load_composites.return_value = set()
+        inject_fields.return_value = ['satellite_zenith_angle']
+
+        self.loader.invoke(context)
+        self.assertEqual(inject_fields.call_args[0][0], self.scene)
+        self.assertEqual(inject_fields.call_args[0][2], 'IR_108')
+        self.assertEqual(load_composites.call_args[1]['keep'],
+                         {'satellite_zenith_angle'})
+        # The angle modifiers of satpy use satpy's own cache
+        enable_satpy_cache.assert_called_with('/tmp/satpy')
+
+        # Failures don't stop the processing
+        inject_fields.side_effect = ValueError
+        self.loader.invoke(context)
+        self.assertEqual(load_composites.call_args[1]['keep'], set())
+
+        enable_satpy_cache.reset_mock()
+        context['static_fields']['satpy_cache'] = False
+        self.loader.invoke(context)
+        self.assertFalse(enable_satpy_cache.called)
+
 
 def suite():
     """The suite for test_utils
@@ -23,6 +23,7 @@ try:
 except ImportError:
     from mock import patch, Mock, call
 
+from trollflow_sat import footprints
 from trollflow_sat.satpy_resampler import Resampler
 from trollflow_sat.tests.utils import (write_yaml, PRODUCT_LIST, MockScene,
                                        METADATA_FILE, PRODUCT_LIST_SATPROJ,
@@ -44,6 +45,7 @@ class TestResampler(unittest.TestCase):
         self.prodlist = write_yaml(PRODUCT_LIST)
         self.prodlist_satproj = write_yaml(PRODUCT_LIST_SATPROJ)
         self.prodlist_two_areas = write_yaml(PRODUCT_LIST_TWO_AREAS)
+        footprints.clear_cache()
 
     def tearDown(self):
         import os
@@ -70,7 +72,7 @@ class TestResampler(unittest.TestCase):
         self.assertTrue(release.called)
 
     @patch('trollflow_sat.satpy_resampler.utils.covers')
-    @patch('trollflow_sat.satpy_resampler.Pass')
+    @patch('trollflow_sat.footprints.Pass')
     def test_invoke_scene_no_coverage(self, Pass, covers):
         import six.moves.queue as queue
         scene = MockScene(attrs=METADATA_FILE)
@@ -86,7 +88,7 @@ class TestResampler(unittest.TestCase):
         self.assertRaises(queue.Empty, context['output_queue'].get, timeout=1)
 
     @patch('trollflow_sat.satpy_resampler.utils.covers')
-    @patch('trollflow_sat.satpy_resampler.Pass')
+    @patch('trollflow_sat.footprints.Pass')
     def test_invoke_scene(self, Pass, covers):
         scene = MockScene(attrs=METADATA_FILE)
         context = self.context
@@ -104,7 +106,7 @@ class TestResampler(unittest.TestCase):
         self.assertIsNotNone(context['output_queue'].get(timeout=1))
 
     @patch('trollflow_sat.satpy_resampler.utils.covers')
-    @patch('trollflow_sat.satpy_resampler.Pass')
+    @patch('trollflow_sat.footprints.Pass')
     def test_invoke_scene_satproj(self, Pass, covers):
         scene = MockScene(attrs=METADATA_FILE)
         context = self.context
@@ -124,7 +126,7 @@ class TestResampler(unittest.TestCase):
         self.assertTrue(lcl['scene'] is scene)
 
     @patch('trollflow_sat.satpy_resampler.utils.covers')
-    @patch('trollflow_sat.satpy_resampler.Pass')
+    @patch('trollflow_sat.footprints.Pass')
     def test_invoke_overpass_is_none(self, Pass, covers):
         scene = MockScene(attrs=METADATA_FILE)
         context = self.context
@@ -138,6 +140,109 @@ class TestResampler(unittest.TestCase):
         self.assertFalse(any(covers.mock_calls))
         self.assertIsNotNone(context['output_queue'].get(timeout=1))
 
+    @patch('trollflow_sat.satpy_resampler.utils.covers')
+    @patch('trollflow_sat.footprints.Pass')
+    def test_invoke_overpass_cached(self, Pass, covers):
+        scene = MockScene(attrs=METADATA_FILE)
+        context = self.context
+        context['product_list'] = self.prodlist_two_areas
+        covers.return_value = True
+        for area_id in ['area1', 'area2']:
+            context['content'] = {'scene': scene,
+                                  'extra_metadata': {'area_id': area_id}}
+            self.resampler.invoke(context)
+        # The overpass is computed only once for the scene
+        self.assertEqual(Pass.call_count, 1)
+        self.assertEqual(covers.call_count, 2)
+        self.assertTrue(covers.mock_calls[0][1][0] is
+                        covers.mock_calls[1][1][0])
+
+    @patch('trollflow_sat.satpy_resampler.utils.covers')
+    @patch('trollflow_sat.footprints.Pass')
+    def test_invoke_early_release(self, Pass, covers):
+        from trollflow_sat.utils import DatasetReferences
+        scene = MockScene(attrs=METADATA_FILE)
+        scene.load(['overview'])
+        references = DatasetReferences()
+        references.acquire(('area1', 0), ['overview'])
+        references.acquire(('area2', 0), ['overview'])
+        context = self.context
+        context['product_list'] = self.prodlist_two_areas
+        covers.return_value = True
+        # The scene is resampled holding its lock
+        locked = []
+        resample = scene.resample
+
+        def _resample(area_id, **kwargs):
+            locked.append(references.lock.locked())
+            return resample(area_id, **kwargs)
+
+        scene.resample = _resample
+        for area_id in ['area1', 'area2']:
+            context['content'] = {'scene': scene,
+                                  'extra_metadata': {
+                                      'area_id': area_id, 'priority': 0,
+                                      'products': {'overview'},
+                                      'references': references}}
+            self.resampler.invoke(context)
+            lcl = context['output_queue'].get(timeout=1)['scene']
+            self.assertEqual(len(lcl.datasets), 1)
+        # Unloaded from the global scene after the last area
+        self.assertEqual(len(scene.datasets), 0)
+        self.assertEqual(locked, [True, True])
+        self.assertFalse(references.lock.locked())
+
+        # Areas not covered are released without resampling
+        scene.load(['overview'])
+        references.acquire(('area1', 0), ['overview'])
+        covers.return_value = False
+        context['content']['extra_metadata']['area_id'] = 'area1'
+        self.resampler.invoke(context)
+        self.assertEqual(len(scene.datasets), 0)
+
+    @patch('trollflow_sat.satpy_resampler.utils.covers')
+    @patch('trollflow_sat.footprints.Pass')
+    def test_invoke_early_release_pending(self, Pass, covers):
+        from satpy.dependency_tree import Node
+        from trollflow_sat.utils import DatasetReferences
+        scene = MockScene(attrs=METADATA_FILE)
+        scene.load(['overview', 'VIS006', 'IR_108', 'natural'])
+        # "hrv_fog" mixes resolutions, so it is generated only after
+        # resampling
+        tree = {'overview': Node('overview'), 'hrv_fog': Node('hrv_fog')}
+        tree['overview'].add_child(Node('VIS006'))
+        tree['hrv_fog'].add_child(Node('HRV'))
+        tree['hrv_fog'].add_child(Node('IR_108'))
+        scene._dependency_tree = tree
+        kwargs = []
+        resample = scene.resample
+
+        def _resample(area_id, **kws):
+            kwargs.append(kws)
+            return resample(area_id, **kws)
+
+        scene.resample = _resample
+        references = DatasetReferences()
+        context = self.context
+        context['product_list'] = self.prodlist_two_areas
+        covers.return_value = True
+        for area_id, products in (('area1', {'overview'}),
+                                  ('area2', {'overview', 'hrv_fog'})):
+            references.acquire((area_id, 0), products)
+            context['content'] = {'scene': scene,
+                                  'extra_metadata': {
+                                      'area_id': area_id, 'priority': 0,
+                                      'products': products,
+                                      'references': references}}
+            self.resampler.invoke(context)
+            context['output_queue'].get(timeout=1)
+        # The composite and its prerequisites, but not the composites
+        # of the other areas, are resampled
+        self.assertEqual(sorted(kwargs[0]['datasets']),
+                         ['VIS006', 'overview'])
+        # Everything is resampled for the pending composite
+        self.assertNotIn('datasets', kwargs[1])
+
     def test_post_invoke(self):
         self.assertIsNone(self.resampler.post_invoke())
 
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for segment gatherer"""
+
+import unittest
+import datetime as dt
+from copy import deepcopy
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from posttroll.message import Message
+
+from trollflow_sat.segment_gatherer import (SegmentGatherer, ParserTable,
+                                            AREA_SEGMENT_CACHE,
+                                            SLOT_NOT_READY,
+                                            SLOT_READY,
+                                            SLOT_READY_BUT_WAIT_FOR_MORE,
+                                            SLOT_OBSOLETE_TIMEOUT,
+                                            _count_bits)
+from trollflow_sat.tests.utils import write_yaml
+
+PATTERN = ("H-000-{platform_name:4s}__-{platform_name:4s}________-"
+           "{channel_name:_<9s}-{segment:_<9s}-{start_time:%Y%m%d%H%M}-__")
+
+CONFIG = {"config": {"time_name": "start_time",
+                     "timeliness": 10},
+          "files": [{"pattern": PATTERN,
+                     "segments": [{"channel_name": ["VIS006", "IR_108"],
+                                   "critical_segments": [],
+                                   "wanted_segments": ["000007", "000008"],
+                                   "all_segments": ["000001", "000002",
+                                                    "000003", "000004",
+                                                    "000005", "000006",
+                                                    "000007", "000008"]},
+                                  {"channel_name": [""],
+                                   "critical_segments": ["PRO"],
+                                   "wanted_segments": ["PRO", "EPI"],
+                                   "all_segments": ["PRO", "EPI"]}]}]}
+
+TIME = dt.datetime(2019, 1, 1, 12, 0)
+
+
+def create_message(channel_name, segment, platform_name='MSG4'):
+    """Create a file message of a HRIT segment"""
+    uid = PATTERN.replace('{platform_name:4s}', platform_name)
+    uid = uid.replace('{channel_name:_<9s}', '{0:_<9s}'.format(channel_name))
+    uid = uid.replace('{segment:_<9s}', '{0:_<9s}'.format(segment))
+    uid = uid.replace('{start_time:%Y%m%d%H%M}', TIME.strftime('%Y%m%d%H%M'))
+    return Message('/topic', 'file', {'uid': uid, 'uri': '/data/' + uid,
+                                      'sensor': 'seviri'})
+
+
+class TestSegmentGatherer(unittest.TestCase):
+
+    def setUp(self):
+        import six.moves.queue as queue
+        self.config = write_yaml(CONFIG)
+        self.output_queue = queue.Queue()
+        self.gatherer = SegmentGatherer(self.config, None, self.output_queue)
+
+    def tearDown(self):
+        import os
+        os.remove(self.config)
+
+    def test_index(self):
+        # 2 channels * 8 segments + PRO and EPI
+        self.assertEqual(len(self.gatherer._keys), 18)
+        self.assertEqual(bin(self.gatherer._critical_mask).count('1'), 1)
+        self.assertEqual(bin(self.gatherer._wanted_mask).count('1'), 6)
+        self.assertEqual(bin(self.gatherer._all_mask).count('1'), 18)
+
+    def test_process(self):
+        gatherer = self.gatherer
+        gatherer.process(create_message('IR_108', '000007'))
+        slot = gatherer.slots[str(TIME)]
+        self.assertEqual(len(slot['metadata']['dataset']), 1)
+        self.assertEqual(bin(slot['received']).count('1'), 1)
+        # Duplicates are ignored
+        gatherer.process(create_message('IR_108', '000007'))
+        self.assertEqual(len(slot['metadata']['dataset']), 1)
+        # Files of other platforms are collected, but aren't counted
+        gatherer.process(create_message('IR_108', '000008', 'MSG3'))
+        self.assertEqual(len(slot['metadata']['dataset']), 2)
+        self.assertEqual(bin(slot['received']).count('1'), 1)
+        self.assertEqual(len(slot['other_files']), 1)
+        # Unknown files are skipped
+        gatherer.process(Message('/topic', 'file', {'uid': 'foo',
+                                                    'uri': '/data/foo'}))
+        self.assertEqual(len(slot['metadata']['dataset']), 2)
+
+    def test_slot_ready(self):
+        gatherer = self.gatherer
+        gatherer.process(create_message('', 'PRO'))
+        slot = gatherer.slots[str(TIME)]
+        # Critical files received, timeout is set
+        self.assertEqual(gatherer.slot_ready(slot), SLOT_NOT_READY)
+        self.assertIsNotNone(slot['timeout'])
+        for chan in ['VIS006', 'IR_108']:
+            for seg in ['000007', '000008']:
+                gatherer.process(create_message(chan, seg))
+        self.assertEqual(len(slot['delayed_files']), 4)
+        self.assertEqual(gatherer.slot_ready(slot), SLOT_NOT_READY)
+        gatherer.process(create_message('', 'EPI'))
+        self.assertEqual(gatherer.slot_ready(slot), SLOT_READY)
+
+    def test_slot_ready_timeout(self):
+        gatherer = self.gatherer
+        gatherer.process(create_message('IR_108', '000007'))
+        slot = gatherer.slots[str(TIME)]
+        self.assertEqual(gatherer.slot_ready(slot), SLOT_NOT_READY)
+        slot['timeout'] = dt.datetime.utcnow() - dt.timedelta(seconds=1)
+        self.assertEqual(gatherer.slot_ready(slot), SLOT_OBSOLETE_TIMEOUT)
+
+    def test_slot_ready_premature(self):
+        gatherer = self.gatherer
+        gatherer._stages = [{"name": "premature", "mask": None,
+                             "num_files": 2}]
+        gatherer.process(create_message('IR_108', '000007'))
+        slot = gatherer.slots[str(TIME)]
+        self.assertEqual(gatherer.slot_ready(slot), SLOT_NOT_READY)
+        gatherer.process(create_message('IR_108', '000008'))
+        self.assertEqual(gatherer.slot_ready(slot),
+                         SLOT_READY_BUT_WAIT_FOR_MORE)
+        self.assertEqual(gatherer.slot_ready(slot), SLOT_NOT_READY)
+
+    def test_publish(self):
+        gatherer = self.gatherer
+        gatherer.process(create_message('IR_108', '000007'))
+        time_slot = str(TIME)
+        missing = gatherer._compose_filenames(
+            time_slot, gatherer._all_mask & ~gatherer.slots[time_slot]['received'])
+        self.assertEqual(len(missing), 17)
+        self.assertTrue(create_message('', 'EPI').data['uid'] in missing)
+        gatherer._publish(time_slot)
+        msg = self.output_queue.get(timeout=1)
+        self.assertEqual(msg.type, 'dataset')
+        self.assertEqual(len(msg.data['dataset']), 1)
+        self.assertEqual(msg.data['start_time'], TIME)
+
+    def test_check_slot(self):
+        gatherer = self.gatherer
+        time_slot = gatherer.process(create_message('', 'PRO'))
+        self.assertEqual(time_slot, str(TIME))
+        gatherer._check_slot(time_slot)
+        # The timeout is scheduled once
+        self.assertEqual(len(gatherer._deadlines), 1)
+        self.assertTrue(0. < gatherer.get_wait_time() <= 1.)
+        gatherer._check_slot(gatherer.process(create_message('', 'EPI')))
+        self.assertEqual(len(gatherer._deadlines), 1)
+        # Duplicate files don't return a slot
+        self.assertIsNone(gatherer.process(create_message('', 'EPI')))
+
+    def test_check_deadlines(self):
+        gatherer = self.gatherer
+        time_slot = gatherer.process(create_message('', 'PRO'))
+        gatherer._check_slot(time_slot)
+        # Nothing happens before the timeout
+        gatherer.check_deadlines()
+        self.assertTrue(time_slot in gatherer.slots)
+        # Critical files are received, so the slot is published
+        timeout = dt.datetime.utcnow() - dt.timedelta(seconds=1)
+        gatherer.slots[time_slot]['timeout'] = timeout
+        gatherer._deadlines = [(timeout, time_slot)]
+        self.assertEqual(gatherer.get_wait_time(), 0.)
+        gatherer.check_deadlines()
+        self.assertFalse(time_slot in gatherer.slots)
+        self.assertFalse(gatherer._deadlines)
+        self.assertEqual(self.output_queue.qsize(), 1)
+
+    def test_publish_stages(self):
+        config = dict(CONFIG)
+        config["config"] = dict(CONFIG["config"],
+                                num_files_premature_publish=1,
+                                publish_stages=[{"name": "north_ir",
+                                                 "channel_name": ["IR_108"],
+                                                 "segments": ["000007"]},
+                                                {"name": "north",
+                                                 "segments": ["000008"]}])
+        config_fname = write_yaml(config)
+        try:
+            gatherer = SegmentGatherer(config_fname, None, self.output_queue)
+        finally:
+            import os
+            os.remove(config_fname)
+        self.assertEqual([stage['name'] for stage in gatherer._stages],
+                         ['premature', 'north_ir', 'north'])
+        self.assertEqual(_count_bits(gatherer._stages[1]['mask']), 1)
+        self.assertEqual(_count_bits(gatherer._stages[2]['mask']), 2)
+
+        gatherer._add_file(create_message('IR_108', '000008'))
+        gatherer._add_file(create_message('IR_108', '000007'))
+        gatherer._add_file(create_message('VIS006', '000008'))
+        gatherer._add_file(create_message('VIS006', '000007'))
+        gatherer._add_file(create_message('', 'PRO'))
+        gatherer._add_file(create_message('', 'EPI'))
+        stages = []
+        while not self.output_queue.empty():
+            msg = self.output_queue.get(timeout=1)
+            stages.append((msg.data['publish_stage'],
+                           len(msg.data['dataset'])))
+        self.assertEqual(stages, [('premature', 1), ('north_ir', 2),
+                                  ('north', 3), ('final', 6)])
+
+    def test_invalid_publish_stages(self):
+        import os
+        for stage in [{"name": "typo", "segments": ["00007"]},
+                      {"name": "no_channel", "channel_name": ["WV_062"],
+                       "segments": ["000007"]}]:
+            config = dict(CONFIG)
+            config["config"] = dict(CONFIG["config"], publish_stages=[stage])
+            config_fname = write_yaml(config)
+            try:
+                with self.assertRaises(ValueError):
+                    SegmentGatherer(config_fname, None, self.output_queue)
+            finally:
+                os.remove(config_fname)
+
+        # Stages needing more files than wanted wait for all of them
+        config = dict(CONFIG)
+        config["config"] = dict(CONFIG["config"], publish_stages=[
+            {"name": "too_many", "num_files": 20}])
+        config_fname = write_yaml(config)
+        try:
+            gatherer = SegmentGatherer(config_fname, None, self.output_queue)
+        finally:
+            os.remove(config_fname)
+        num_wanted = _count_bits(gatherer._wanted_mask)
+        self.assertTrue(num_wanted < 20)
+        self.assertEqual(gatherer._stages[0]["num_files"], num_wanted)
+
+    def test_deduplication(self):
+        config = dict(CONFIG)
+        config["config"] = dict(CONFIG["config"],
+                                deduplication={"max_size": 100})
+        config_fname = write_yaml(config)
+        try:
+            gatherer = SegmentGatherer(config_fname, None, self.output_queue)
+        finally:
+            import os
+            os.remove(config_fname)
+        for _ in range(2):
+            gatherer._add_file(create_message('', 'PRO'))
+            for chan in ['VIS006', 'IR_108']:
+                for seg in ['000007', '000008']:
+                    gatherer._add_file(create_message(chan, seg))
+            gatherer._add_file(create_message('', 'EPI'))
+        # Re-sent files don't create a new slot
+        self.assertEqual(self.output_queue.qsize(), 1)
+        self.assertFalse(gatherer.slots)
+        self.assertEqual(gatherer._deduplicator.suppressed, 6)
+
+    @patch('trollflow_sat.fetch.Prefetcher')
+    def test_prefetch(self, Prefetcher):
+        config = dict(CONFIG)
+        config["config"] = dict(CONFIG["config"],
+                                prefetch={"mode": "page_cache"})
+        config_fname = write_yaml(config)
+        try:
+            gatherer = SegmentGatherer(config_fname, None, self.output_queue)
+        finally:
+            import os
+            os.remove(config_fname)
+        Prefetcher.assert_called_once_with(mode="page_cache")
+        msg = create_message('VIS006', '000007')
+        gatherer._add_file(msg)
+        Prefetcher.return_value.submit.assert_called_once_with(msg)
+        # Unknown files are not prefetched
+        gatherer._add_file(Message('/topic', 'file',
+                                   {'uid': 'foo.txt', 'uri': '/data/foo.txt'}))
+        self.assertEqual(Prefetcher.return_value.submit.call_count, 1)
+        gatherer.stop()
+        self.assertTrue(Prefetcher.return_value.close.called)
+
+    def test_journal(self):
+        import os
+        import tempfile
+        import six.moves.queue as queue
+        journal = tempfile.mktemp(suffix='.journal')
+        config = dict(CONFIG)
+        config["config"] = dict(CONFIG["config"], journal=journal)
+        config_fname = write_yaml(config)
+        try:
+            gatherer = SegmentGatherer(config_fname, None, self.output_queue)
+            gatherer._add_file(create_message('', 'PRO'))
+            gatherer._add_file(create_message('IR_108', '000007'))
+            gatherer._add_file(create_message('IR_108', '000007'))
+            timeout = gatherer.slots[str(TIME)]['timeout']
+            gatherer.stop()
+            records = gatherer._journal.read()
+            self.assertEqual([rec["event"] for rec in records],
+                             ["file", "timeout", "file"])
+
+            # Restart and restore the slot
+            output_queue = queue.Queue()
+            gatherer = SegmentGatherer(config_fname, None, output_queue)
+            gatherer._restore()
+            slot = gatherer.slots[str(TIME)]
+            self.assertEqual(len(slot['metadata']['dataset']), 2)
+            self.assertEqual(slot['timeout'], timeout)
+            self.assertEqual(gatherer._deadlines, [(timeout, str(TIME))])
+            # The delays are those measured at reception
+            delay = slot['delayed_files'][
+                create_message('IR_108', '000007').data['uid']]
+            self.assertEqual(delay, records[-1]["delay"])
+            for chan in ['VIS006', 'IR_108']:
+                for seg in ['000007', '000008']:
+                    gatherer._add_file(create_message(chan, seg))
+            gatherer._add_file(create_message('', 'EPI'))
+            self.assertEqual(output_queue.qsize(), 1)
+            self.assertFalse(gatherer.slots)
+            gatherer.stop()
+            # Only the records of open slots are kept at compaction
+            gatherer._journal.compact()
+            self.assertEqual(gatherer._journal.read(), [])
+            self.assertEqual(gatherer._journal._num_records, 0)
+        finally:
+            os.remove(config_fname)
+            if os.path.exists(journal):
+                os.remove(journal)
+
+
+class TestAreaSegments(unittest.TestCase):
+
+    def setUp(self):
+        from pyresample.geometry import AreaDefinition
+        # 2 degrees per row, 10 rows per segment
+        self.source = AreaDefinition('source', 'source', 'source',
+                                     'EPSG:4326', 10, 80,
+                                     (-10, -80, 10, 80))
+        self.north = AreaDefinition('north', 'north', 'north', 'EPSG:4326',
+                                    100, 100, (0, 50, 10, 60))
+        self.equator = AreaDefinition('equator', 'equator', 'equator',
+                                      'EPSG:4326', 100, 100, (0, -5, 10, 5))
+        self.outside = AreaDefinition('outside', 'outside', 'outside',
+                                      'EPSG:4326', 100, 100,
+                                      (50, -5, 60, 5))
+        self.names = ["000008", "000007", "000006", "000005",
+                      "000004", "000003", "000002", "000001"]
+        AREA_SEGMENT_CACHE.clear()
+
+    def tearDown(self):
+        AREA_SEGMENT_CACHE.clear()
+
+    def test_get_area_segments(self):
+        from trollflow_sat.segment_gatherer import get_area_segments
+        res = get_area_segments(self.source, [self.north], self.names)
+        self.assertEqual(res, ["000007"])
+        res = get_area_segments(self.source, [self.equator, self.north],
+                                self.names)
+        self.assertEqual(res, ["000007", "000005", "000004"])
+        res = get_area_segments(self.source, [self.outside], self.names)
+        self.assertEqual(res, [])
+
+    @patch('trollflow_sat.utils.get_area_def')
+    def test_gatherer_segments(self, get_area_def):
+        import os
+        from trollflow_sat.tests.utils import PRODUCT_LIST_TWO_AREAS
+        areas = {'source': self.source, 'area1': self.north,
+                 'area2': self.equator}
+        get_area_def.side_effect = lambda area_id: areas[area_id]
+        prodlist = write_yaml(PRODUCT_LIST_TWO_AREAS)
+        config = deepcopy(CONFIG)
+        config["config"]["product_list"] = prodlist
+        segments = config["files"][0]["segments"][0]
+        segments["critical_segments"] = ["000001", "000004"]
+        segments["segment_geometry"] = {"source_area": "source",
+                                        "segment_names": self.names}
+        config_fname = write_yaml(config)
+        try:
+            gatherer = SegmentGatherer(config_fname, None, None)
+            # The mapping is cached
+            gatherer = SegmentGatherer(config_fname, None, None)
+        finally:
+            os.remove(config_fname)
+            os.remove(prodlist)
+        self.assertEqual(get_area_def.call_count, 3)
+        self.assertEqual(len(AREA_SEGMENT_CACHE), 1)
+        # 2 channels * 3 segments + PRO and EPI
+        self.assertEqual(_count_bits(gatherer._wanted_mask), 8)
+        # 2 channels * 1 segment + PRO
+        self.assertEqual(_count_bits(gatherer._critical_mask), 3)
+
+
+class TestParserTable(unittest.TestCase):
+
+    def setUp(self):
+        from trollsift import Parser
+        self.table = ParserTable([Parser("H-000-{foo}-__"),
+                                  Parser("H-000-{foo}.bz2"),
+                                  Parser("W_XX-{foo}.nc"),
+                                  Parser("{foo}.nc")])
+
+    def test_get_candidates(self):
+        self.assertEqual(self.table.get_candidates("H-000-bar-__"), [0])
+        self.assertEqual(self.table.get_candidates("W_XX-bar.nc"), [2, 3])
+        self.assertEqual(self.table.get_candidates("H-000-bar.nc"), [3])
+        self.assertEqual(self.table.get_candidates("bar.h5"), [])
+
+    def test_parse(self):
+        table = self.table
+        self.assertEqual(table.parse("H-000-bar.bz2"), (1, {'foo': 'bar'}))
+        self.assertEqual(table.stats['dispatched'], 1)
+        self.assertEqual(table.stats['parse_attempts'], 1)
+        self.assertEqual(table.parse("W_XX-bar.nc"), (2, {'foo': 'bar'}))
+        self.assertEqual(table.stats['ambiguous'], 1)
+        self.assertEqual(table.parse("bar.h5"), (None, None))
+        self.assertEqual(table.stats['rejected'], 1)
+        self.assertEqual(table.stats['parse_attempts'], 2)
+        self.assertEqual(table.stats['filenames'], 3)
+
+
+def suite():
+    """The suite for test_segment_gatherer
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSegmentGatherer))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestParserTable))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestAreaSegments))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the precomputed solar zenith angles"""
+
+import datetime as dt
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from pyorbital import astronomy
+
+from trollflow_sat import solar_angles, static_fields, utils
+from trollflow_sat.tests.test_static_fields import FakeScene, create_area
+
+AREA_EXTENT = (-10., 35., 30., 70.)
+
+
+def create_latlon_area(shape=(36, 41)):
+    return create_area(shape=shape, proj={'proj': 'latlong'},
+                       extent=AREA_EXTENT)
+
+
+class TestSolarZenithProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.provider = solar_angles.SolarZenithProvider(self.cache_dir)
+        self.area = create_latlon_area()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _grids(self):
+        return sorted(fname for fname in os.listdir(self.cache_dir)
+                      if '_sunzen_' in fname)
+
+    def test_time_step(self):
+        self.assertRaises(ValueError, solar_angles.SolarZenithProvider,
+                          self.cache_dir, time_step=7000)
+        for time_step in (43200, 86400):
+            self.assertRaises(ValueError, solar_angles.SolarZenithProvider,
+                              self.cache_dir, time_step=time_step)
+        # Up to the largest step that divides half a day
+        solar_angles.SolarZenithProvider(self.cache_dir, time_step=21600)
+
+    def test_accuracy(self):
+        lons, lats = self.area.get_lonlats()
+        for utc_time in (dt.datetime(2019, 3, 20, 6, 15),
+                         dt.datetime(2019, 6, 21, 12, 45),
+                         dt.datetime(2019, 12, 31, 23, 30)):
+            sunzen = self.provider.get_sunzen(self.area, utc_time)
+            self.assertEqual(sunzen.dtype, np.float32)
+            self.assertEqual(sunzen.shape, self.area.shape)
+            expected = astronomy.sun_zenith_angle(utc_time, lons, lats)
+            np.testing.assert_allclose(sunzen, expected, atol=0.05)
+        # The grids around the last time are on different days
+        self.assertTrue(any(fname.endswith('_20200101_000.npy')
+                            for fname in self._grids()))
+
+    def test_accuracy_years(self):
+        lons, lats = self.area.get_lonlats()
+        # The same day of the year around the equinox, where the
+        # declination changes fastest, and the leap days
+        for utc_time in (dt.datetime(2019, 3, 20, 6, 15),
+                         dt.datetime(2020, 3, 19, 6, 15),
+                         dt.datetime(2020, 2, 29, 10, 30),
+                         dt.datetime(2021, 3, 1, 10, 30)):
+            sunzen = self.provider.get_sunzen(self.area, utc_time)
+            expected = astronomy.sun_zenith_angle(utc_time, lons, lats)
+            np.testing.assert_allclose(sunzen, expected, atol=0.05)
+        # The grids of the past dates have been removed
+        self.assertEqual(len(self._grids()), 2)
+
+    def test_exact_node(self):
+        lons, lats = self.area.get_lonlats()
+        utc_time = dt.datetime(2019, 6, 21, 12)
+        sunzen = self.provider.get_sunzen(self.area, utc_time)
+        np.testing.assert_allclose(
+            sunzen, astronomy.sun_zenith_angle(utc_time, lons, lats),
+            atol=1e-3)
+        self.assertEqual(len(self._grids()), 1)
+
+    def test_caching(self):
+        utc_time = dt.datetime(2019, 6, 21, 12, 15)
+        sunzen = self.provider.get_sunzen(self.area, utc_time)
+        self.assertEqual((self.provider.hits, self.provider.misses), (0, 2))
+        self.assertEqual(len(self._grids()), 2)
+        # The next slots of the hour use the same grids
+        self.provider.get_sunzen(self.area, utc_time +
+                                 dt.timedelta(minutes=15))
+        self.assertEqual((self.provider.hits, self.provider.misses), (2, 2))
+
+        # Other processes use the saved grids
+        provider = solar_angles.SolarZenithProvider(self.cache_dir)
+        with patch('pyorbital.astronomy.sun_zenith_angle') as sun_zenith:
+            res = provider.get_sunzen(self.area, utc_time)
+            self.assertFalse(sun_zenith.called)
+        np.testing.assert_allclose(res, sunzen)
+
+    def test_evict(self):
+        grid_size = self.area.shape[0] * self.area.shape[1] * 4
+        self.provider.max_size = 2.5 * grid_size
+        for hour in range(3):
+            self.provider.get_sunzen(self.area,
+                                     dt.datetime(2019, 6, 21, hour))
+        self.assertEqual(len(self._grids()), 2)
+        self.assertFalse(self._grids()[0].endswith('_000.npy'))
+
+    def test_remove_past(self):
+        for day in (18, 19, 20):
+            self.provider.get_sunzen(self.area,
+                                     dt.datetime(2019, 6, day, 12))
+        grids = self._grids()
+        self.assertEqual(len(grids), 2)
+        self.assertTrue(grids[0].endswith('_20190619_012.npy'))
+        # The grids of the other time steps are left alone
+        provider = solar_angles.SolarZenithProvider(self.cache_dir,
+                                                    time_step=1800)
+        provider.get_sunzen(self.area, dt.datetime(2019, 6, 17, 12))
+        self.provider.get_sunzen(self.area, dt.datetime(2019, 6, 21, 12))
+        grids = self._grids()
+        self.assertEqual(len(grids), 3)
+        self.assertTrue(grids[0].endswith('_1800_20190617_024.npy'))
+
+    def test_bad_sunzen_range(self):
+        utc_time = dt.datetime(2019, 6, 21, 5)
+        conf = {'product_list': {'area1': {'products': {
+            'night': {'sunzen_night_minimum': 90.},
+            'day': {'sunzen_day_maximum': 90.}}}}}
+        sunzen = self.provider.get_sunzen(self.area, utc_time)
+        # The terminator crosses the area
+        self.assertTrue(np.nanmin(sunzen) < 90. < np.nanmax(sunzen))
+        with patch('trollflow_sat.utils.get_area_def') as get_area_def:
+            get_area_def.return_value = self.area
+            # Without the provider the products can't be checked
+            self.assertFalse(utils.bad_sunzen_range(conf, 'area1', 'night',
+                                                    utc_time))
+            for prod in ('night', 'day'):
+                self.assertFalse(utils.bad_sunzen_range(
+                    conf, 'area1', prod, utc_time,
+                    sunzen_provider=self.provider))
+            # All day at noon
+            utc_time = dt.datetime(2019, 6, 21, 12)
+            self.assertTrue(utils.bad_sunzen_range(
+                conf, 'area1', 'night', utc_time,
+                sunzen_provider=self.provider))
+            self.assertFalse(utils.bad_sunzen_range(
+                conf, 'area1', 'day', utc_time,
+                sunzen_provider=self.provider))
+        get_area_def.assert_called_with('area1')
+
+    def test_bad_sunzen_range_memo(self):
+        utc_time = dt.datetime(2019, 6, 21, 12)
+        conf = {'product_list': {'area1': {'products': {
+            'night': {'sunzen_night_minimum': 90.},
+            'day': {'sunzen_day_maximum': 90.}}}}}
+        memo = utils.SunZenithMemo()
+        with patch('trollflow_sat.utils.get_area_def') as get_area_def:
+            get_area_def.return_value = self.area
+            with patch.object(self.provider, 'get_sunzen',
+                              wraps=self.provider.get_sunzen) as get_sunzen:
+                self.assertTrue(utils.bad_sunzen_range(
+                    conf, 'area1', 'night', utc_time,
+                    sunzen_provider=self.provider, sunzen_memo=memo))
+                self.assertFalse(utils.bad_sunzen_range(
+                    conf, 'area1', 'day', utc_time,
+                    sunzen_provider=self.provider, sunzen_memo=memo))
+                # The angles of the area are computed once for the slot
+                self.assertEqual(get_sunzen.call_count, 1)
+                sunzen_min, sunzen_max = memo.get_range(utc_time, 'area1',
+                                                        self.provider)
+                self.assertTrue(sunzen_min < sunzen_max < 90.)
+                self.assertEqual(get_sunzen.call_count, 1)
+
+    def test_inject(self):
+        area = create_area()
+        scene = FakeScene(area)
+        start_time = dt.datetime(2019, 6, 21, 11, 45)
+        scene.load(['IR_108'])
+        scene['IR_108'].attrs.update({'start_time': start_time,
+                                      'end_time': start_time +
+                                      dt.timedelta(minutes=12)})
+        added = static_fields.inject_fields(
+            scene, static_fields.get_cache(self.cache_dir), 'IR_108',
+            fields=['solar_zenith_angle'], sunzen_provider=self.provider)
+        self.assertEqual(added, ['solar_zenith_angle'])
+        sunzen = scene['solar_zenith_angle']
+        np.testing.assert_allclose(
+            sunzen.values,
+            self.provider.get_sunzen(area, dt.datetime(2019, 6, 21, 11, 51)))
+        self.assertEqual(sunzen.attrs['units'], 'degrees')
+
+        # Without the provider there are no solar angles
+        del scene['solar_zenith_angle']
+        self.assertEqual(static_fields.inject_fields(
+            scene, static_fields.get_cache(self.cache_dir), 'IR_108',
+            fields=['solar_zenith_angle']), [])
+
+
+def suite():
+    """The suite for test_solar_angles
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSolarZenithProvider))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
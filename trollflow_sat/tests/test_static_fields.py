@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the static field cache"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+from pyresample.geometry import AreaDefinition
+
+from trollflow_sat import static_fields
+
+GEOS_PROJ = {'proj': 'geos', 'lon_0': 9.5, 'h': 35785831.0,
+             'a': 6378169.0, 'b': 6356583.8}
+GEOS_EXTENT = (-5570248.4773, -5567248.0742, 5567248.0742, 5570248.4773)
+
+
+def create_area(shape=(11, 11), proj=GEOS_PROJ, extent=GEOS_EXTENT):
+    return AreaDefinition('test', 'test', 'test', proj, shape[1], shape[0],
+                          extent)
+
+
+class FakeScene(dict):
+
+    def __init__(self, area):
+        super(FakeScene, self).__init__()
+        self.area = area
+
+    def load(self, names):
+        for name in names:
+            if name not in self:
+                self[name] = xr.DataArray(
+                    da.zeros(self.area.shape, chunks=5), dims=('y', 'x'),
+                    attrs={'name': name, 'area': self.area,
+                           'platform_name': 'Meteosat-11',
+                           'wavelength': 10.8})
+
+
+class TestStaticFields(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = static_fields.StaticFieldCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_area_hash(self):
+        area = create_area()
+        self.assertEqual(static_fields.get_area_hash(area),
+                         static_fields.get_area_hash(create_area()))
+        self.assertNotEqual(static_fields.get_area_hash(area),
+                            static_fields.get_area_hash(
+                                create_area(shape=(12, 11))))
+
+    def test_satellite_angles(self):
+        area = create_area()
+        zenith = self.cache.get(area, 'satellite_zenith_angle')
+        self.assertTrue(isinstance(zenith, np.memmap))
+        self.assertEqual(zenith.dtype, np.float32)
+        self.assertEqual(zenith.shape, (11, 11))
+        # Sub-satellite point in the middle, space outside the disk
+        self.assertTrue(zenith[5, 5] < 1.)
+        self.assertTrue(np.isnan(zenith[0, 0]))
+        self.assertTrue(70. < np.nanmax(zenith) <= 90.)
+        # Azimuth angles were computed at the same time
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(len([fname for fname in os.listdir(self.cache_dir)
+                              if fname.endswith('.npy')]), 2)
+        self.cache.get(area, 'satellite_azimuth_angle')
+        self.assertEqual(self.cache.misses, 1)
+
+        # Other processes use the saved fields
+        cache = static_fields.StaticFieldCache(self.cache_dir)
+        np.testing.assert_array_equal(
+            cache.get(area, 'satellite_zenith_angle'), zenith)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertFalse([fname for fname in os.listdir(self.cache_dir)
+                          if fname.endswith('.part')])
+
+    def test_lonlats(self):
+        area = create_area(proj={'proj': 'latlong'},
+                           extent=(0., 50., 10., 60.))
+        lons = self.cache.get(area, 'longitude')
+        lats = self.cache.get(area, 'latitude')
+        np.testing.assert_allclose(lons[0, :2], [0.4545, 1.3636], atol=1e-4)
+        self.assertTrue(lats[0, 0] > lats[-1, 0])
+        # Satellite angles are only static for geostationary grids
+        self.assertIsNone(self.cache.get(area, 'satellite_zenith_angle'))
+
+    def test_inject_fields(self):
+        area = create_area()
+        scene = FakeScene(area)
+        added = static_fields.inject_fields(
+            scene, self.cache, 'IR_108',
+            fields=['longitude', 'satellite_zenith_angle'])
+        self.assertEqual(added, ['longitude', 'satellite_zenith_angle'])
+        # The reference dataset isn't kept
+        self.assertEqual(sorted(scene), sorted(added))
+        zenith = scene['satellite_zenith_angle']
+        self.assertEqual(zenith.attrs['area'], area)
+        self.assertEqual(zenith.attrs['platform_name'], 'Meteosat-11')
+        self.assertFalse('wavelength' in zenith.attrs)
+        self.assertEqual(zenith.data.chunks, ((5, 5, 1), (5, 5, 1)))
+        self.assertTrue(zenith.values[5, 5] < 1.)
+
+        # Fields already in the scene are kept
+        self.assertEqual(static_fields.inject_fields(
+            scene, self.cache, 'IR_108', fields=['longitude']), [])
+
+    def test_enable_satpy_cache(self):
+        import satpy
+        orig = {key: satpy.config.get(key) for key in
+                ('cache_dir', 'cache_lonlats', 'cache_sensor_angles')}
+        try:
+            self.assertTrue(static_fields.enable_satpy_cache(self.cache_dir))
+            self.assertEqual(satpy.config.get('cache_dir'), self.cache_dir)
+            self.assertTrue(satpy.config.get('cache_lonlats'))
+            self.assertTrue(satpy.config.get('cache_sensor_angles'))
+        finally:
+            satpy.config.set(**orig)
+
+
+def suite():
+    """The suite for test_static_fields
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestStaticFields))
+
+    return mysuite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(suite())
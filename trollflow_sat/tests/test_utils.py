@@ -21,6 +21,7 @@ from io import StringIO
 import datetime as dt
 
 from collections import OrderedDict
+from threading import Lock
 try:
     from unittest.mock import patch, Mock, call
 except ImportError:
@@ -181,6 +182,28 @@ class TestUtils(unittest.TestCase):
         self.assertTrue('format' in res[0])
         self.assertTrue('fill_value' in res[0])
 
+    def test_get_priority(self):
+        from trollflow_sat.tests.utils import PRODUCT_LIST_PRIORITIES
+        res = utils.get_priority(PRODUCT_LIST_PRIORITIES, 'area1')
+        self.assertEqual(res, utils.DEFAULT_PRIORITY)
+        res = utils.get_priority(PRODUCT_LIST_PRIORITIES, 'area1', 'natural')
+        self.assertEqual(res, 10)
+        # Products inherit the area priority
+        res = utils.get_priority(PRODUCT_LIST_PRIORITIES, 'area2', 'overview')
+        self.assertEqual(res, 10)
+
+    def test_get_processing_plan(self):
+        from trollflow_sat.tests.utils import (PRODUCT_LIST_PRIORITIES,
+                                               PRODUCT_LIST_TWO_AREAS)
+        res = utils.get_processing_plan(PRODUCT_LIST_PRIORITIES)
+        self.assertEqual(res, [(10, 'area1', ['natural']),
+                               (10, 'area2', ['overview']),
+                               (0, 'area1', ['overview'])])
+        # Without priorities the configured order is kept
+        res = utils.get_processing_plan(PRODUCT_LIST_TWO_AREAS)
+        self.assertEqual(res, [(0, 'area1', ['overview']),
+                               (0, 'area2', ['overview'])])
+
     @patch('trollflow_sat.utils.astronomy.sun_zenith_angle')
     def test_bad_sunzen_range(self, sun_zenith_angle):
         from trollflow_sat.tests.utils import PRODUCT_LIST_TWO_AREAS
@@ -221,6 +244,46 @@ class TestUtils(unittest.TestCase):
                                      'overview', 'start_time')
         self.assertFalse(res)
 
+    def test_get_message_key(self):
+        from trollflow_sat.tests.utils import (METADATA_DATASET,
+                                               METADATA_COLLECTION_DATASET)
+        msg = Message('/topic', 'file', {'uid': 'a', 'start_time': 1})
+        self.assertEqual(utils.get_message_key(msg),
+                         (frozenset(['a']), 1, None, None))
+        msg = Message('/topic', 'dataset', METADATA_DATASET)
+        res = utils.get_message_key(msg)
+        self.assertEqual(res[0], frozenset(['/path/to/data1.file',
+                                            '/path/to/data2.file']))
+        self.assertEqual(res[1], METADATA_DATASET['start_time'])
+        msg = Message('/topic', 'collection', METADATA_COLLECTION_DATASET)
+        self.assertEqual(utils.get_message_key(msg), res)
+        # Other areas and publish stages of the same files are different
+        msg.data['collection_area_id'] = 'euron1'
+        self.assertNotEqual(utils.get_message_key(msg), res)
+        msg = Message('/topic', 'dataset',
+                      dict(METADATA_DATASET, publish_stage='final'))
+        self.assertNotEqual(utils.get_message_key(msg), res)
+
+    @patch('trollflow_sat.utils.time.time')
+    def test_message_deduplicator(self, time):
+        time.return_value = 0.
+        dedup = utils.MessageDeduplicator(max_size=2, window=10)
+        msg1 = Message('/topic', 'file', {'uid': 'a', 'start_time': 1})
+        msg2 = Message('/topic', 'file', {'uid': 'b', 'start_time': 1})
+        msg3 = Message('/topic', 'file', {'uid': 'c', 'start_time': 1})
+        self.assertFalse(dedup.is_duplicate(msg1))
+        self.assertTrue(dedup.is_duplicate(msg1))
+        self.assertFalse(dedup.is_duplicate(msg2))
+        self.assertEqual(dedup.suppressed, 1)
+        # The least recently seen message is forgotten
+        self.assertFalse(dedup.is_duplicate(msg3))
+        self.assertTrue(dedup.is_duplicate(msg3))
+        self.assertFalse(dedup.is_duplicate(msg1))
+        # Messages older than the window are forgotten
+        time.return_value = 11.
+        self.assertFalse(dedup.is_duplicate(msg1))
+        self.assertEqual(dedup.suppressed, 2)
+
     @patch('trollflow_sat.utils.Publish')
     def test_send_message(self, Publish):
         pub = Mock()
@@ -251,6 +314,15 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(res, 'foo')
         self.assertTrue(trollflow_acquire_lock.called)
 
+    @patch('trollflow_sat.utils.get_area_def')
+    def test_get_area_definition(self, get_area_def):
+        get_area_def.return_value = 'area_def'
+        self.assertEqual(utils.get_area_definition('area1'), 'area_def')
+        get_area_def.assert_called_once_with('area1')
+        area = Mock()
+        self.assertIs(utils.get_area_definition(area), area)
+        self.assertEqual(get_area_def.call_count, 1)
+
     @patch('trollflow_sat.utils.get_area_def')
     def test_covers(self, get_area_def):
         overpass = Mock()
@@ -285,12 +357,257 @@ class TestUtils(unittest.TestCase):
                           call('c', 'r+')])
 
 
+class TestSunZenithMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.product_config = {"product_list": {
+            "area1": {"products": {
+                "day": {"sunzen_day_maximum": 90.,
+                        "sunzen_lon": 25., "sunzen_lat": 60.},
+                "night": {"sunzen_night_minimum": 90.,
+                          "sunzen_lon": 25., "sunzen_lat": 60.},
+                "overview": {"sunzen_lon": 0., "sunzen_lat": 0.}}},
+            "area2": {"products": {
+                "day": {"sunzen_day_maximum": 90.,
+                        "sunzen_lon": 0., "sunzen_lat": 0.}}}}}
+        self.time = dt.datetime(2019, 6, 21, 21, 0)
+
+    def test_get_sunzen_points(self):
+        self.assertEqual(utils.get_sunzen_points(self.product_config),
+                         {(25., 60.), (0., 0.)})
+
+    def test_memo(self):
+        from pyorbital import astronomy
+        memo = utils.SunZenithMemo()
+        points = utils.get_sunzen_points(self.product_config)
+        expected = {point: astronomy.sun_zenith_angle(self.time, *point)
+                    for point in points}
+        with patch('trollflow_sat.utils.astronomy.sun_zenith_angle',
+                   wraps=astronomy.sun_zenith_angle) as sun_zenith_angle:
+            memo.update(self.time, points)
+            self.assertEqual(sun_zenith_angle.call_count, 1)
+            memo.update(self.time, points)
+            for lon, lat in points:
+                self.assertAlmostEqual(memo.get(self.time, lon, lat),
+                                       expected[(lon, lat)])
+            self.assertEqual(sun_zenith_angle.call_count, 1)
+            # Unknown locations are computed when needed
+            memo.get(self.time, 10., 10.)
+            self.assertEqual(sun_zenith_angle.call_count, 2)
+
+            # The same checks with and without the memo
+            for area_id, prods in self.product_config["product_list"].items():
+                for prod in prods["products"]:
+                    self.assertEqual(
+                        utils.bad_sunzen_range(self.product_config, area_id,
+                                               prod, self.time,
+                                               sunzen_memo=memo),
+                        utils.bad_sunzen_range(self.product_config, area_id,
+                                               prod, self.time))
+
+        memo = utils.SunZenithMemo(max_size=2)
+        memo.update(self.time, [(0., 0.), (1., 1.), (2., 2.)])
+        self.assertEqual(len(memo._angles), 2)
+
+    @patch('trollflow_sat.utils.astronomy', None)
+    def test_memo_without_pyorbital(self):
+        memo = utils.SunZenithMemo()
+        self.assertIsNone(memo.get(self.time, 25., 60.))
+        # The products can't be checked, so they aren't removed
+        self.assertFalse(utils.bad_sunzen_range(
+            self.product_config, "area1", "night", self.time,
+            sunzen_memo=memo))
+
+
+class TestDtypes(unittest.TestCase):
+
+    def setUp(self):
+        self.product_config = {
+            "common": {"dtype": "float32"},
+            "product_list": {
+                "area1": {"products": {"overview": {},
+                                       "natural": {"dtype": None}}},
+                "area2": {"dtype": "float64",
+                          "products": {"overview": {}}}}}
+
+    def test_get_dtype(self):
+        conf = self.product_config
+        self.assertEqual(utils.get_dtype(conf, "area1", "overview"),
+                         "float32")
+        self.assertIsNone(utils.get_dtype(conf, "area1", "natural"))
+        self.assertEqual(utils.get_dtype(conf, "area2", "overview"),
+                         "float64")
+
+    def test_coerce_dtypes(self):
+        import numpy as np
+        import xarray as xr
+        scene = {"overview": xr.DataArray(np.zeros((3, 3)),
+                                          attrs={"name": "overview"}),
+                 "natural": xr.DataArray(np.zeros((3, 3))),
+                 "counts": xr.DataArray(np.zeros((3, 3), dtype=np.uint16))}
+        self.product_config["product_list"]["area1"]["products"]["counts"] = \
+            {}
+        utils.coerce_dtypes(scene, self.product_config, "area1",
+                            ["overview", "natural", "counts", "missing"])
+        self.assertEqual(scene["overview"].dtype, np.float32)
+        self.assertEqual(scene["overview"].attrs["name"], "overview")
+        self.assertEqual(scene["natural"].dtype, np.float64)
+        self.assertEqual(scene["counts"].dtype, np.uint16)
+
+    def test_float32_images(self):
+        """Images from float32 data are the same as from float64 data"""
+        import numpy as np
+        import xarray as xr
+        from trollimage.xrimage import XRImage
+
+        rng = np.random.RandomState(42)
+        data = xr.DataArray(rng.normal(250., 30., (3, 100, 100)),
+                            dims=("bands", "y", "x"),
+                            coords={"bands": ["R", "G", "B"]})
+        scene = {"overview": data}
+        utils.coerce_dtypes(scene, self.product_config, "area1",
+                            ["overview"])
+        self.assertEqual(scene["overview"].dtype, np.float32)
+
+        images = []
+        for dset in (data, scene["overview"]):
+            img = XRImage(dset)
+            img.crude_stretch(200., 300.)
+            images.append(img.finalize(fill_value=0)[0].values)
+        self.assertEqual(images[0].dtype, np.uint8)
+        diff = np.abs(images[0].astype(int) - images[1].astype(int))
+        self.assertTrue(diff.max() <= 1)
+        self.assertTrue((diff > 0).mean() < 0.01)
+
+
+class TestDatasetReferences(unittest.TestCase):
+
+    def _create_scene(self):
+        from satpy.dependency_tree import Node
+        from trollflow_sat.tests.utils import MockScene
+        scene = MockScene()
+        scene.load(['overview', 'VIS006', 'IR_108'])
+        tree = {'overview': Node('overview'), 'hrv_fog': Node('hrv_fog')}
+        tree['overview'].add_child(Node('VIS006'))
+        tree['hrv_fog'].add_child(Node('HRV'))
+        tree['hrv_fog'].add_child(Node('IR_108'))
+        scene._dependency_tree = tree
+        return scene
+
+    def test_get_prerequisites(self):
+        scene = self._create_scene()
+        self.assertEqual(utils.get_prerequisites(scene, ['overview']),
+                         {'VIS006'})
+        # Only the prerequisites in the scene
+        self.assertEqual(utils.get_prerequisites(scene, ['hrv_fog']),
+                         {'IR_108'})
+        self.assertEqual(utils.get_prerequisites(scene, ['unknown']),
+                         set())
+        del scene._dependency_tree
+        self.assertEqual(utils.get_prerequisites(scene, ['overview']),
+                         set())
+
+    def test_get_resample_datasets(self):
+        scene = self._create_scene()
+        self.assertEqual(sorted(utils.get_resample_datasets(
+            scene, ['overview'])), ['VIS006', 'overview'])
+        # Composites generated only after resampling need all the data
+        self.assertIsNone(utils.get_resample_datasets(
+            scene, ['overview', 'hrv_fog']))
+
+    def test_get_dataset_name(self):
+        from satpy.dataset.dataid import DataID, default_id_keys_config
+        self.assertEqual(utils.get_dataset_name('overview'), 'overview')
+        self.assertEqual(utils.get_dataset_name(
+            DataID(default_id_keys_config, name='VIS006')), 'VIS006')
+
+    def test_references(self):
+        references = utils.DatasetReferences()
+        references.acquire('area1', ['overview', 'natural'])
+        references.acquire('area2', ['overview'])
+        self.assertTrue('overview' in references)
+        self.assertEqual(references.release('area1', ['natural']),
+                         ['natural'])
+        self.assertFalse('natural' in references)
+        self.assertEqual(references.release('area1'), [])
+        # Releasing again changes nothing
+        self.assertEqual(references.release('area1'), [])
+        self.assertEqual(references.release('area2'), ['overview'])
+        self.assertFalse('overview' in references)
+        self.assertEqual(references.needed(), set())
+
+    def test_needed(self):
+        references = utils.DatasetReferences()
+        references.acquire('area1', ['overview', 'natural'])
+        references.acquire('area2', ['overview'])
+        references.release('area1')
+        self.assertEqual(references.needed(), {'overview'})
+
+    def test_hold(self):
+        lock = Lock()
+        with utils.hold(lock):
+            self.assertTrue(lock.locked())
+        self.assertFalse(lock.locked())
+        with utils.hold(None):
+            pass
+
+    def test_unload_datasets(self):
+        from trollflow_sat.tests.utils import MockScene
+        scene = MockScene()
+        scene.load(['overview', 'natural'])
+        utils.unload_datasets(scene, ['natural', 'missing'])
+        self.assertEqual([dset.name for dset in scene.datasets],
+                         ['overview'])
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_lazy_attributes(self):
+        namespace = {'__name__': 'foo'}
+        getattr_ = utils.lazy_attributes(
+            namespace, {'path': ('os.path', None),
+                        'join': ('os.path', 'join'),
+                        'missing': ('no_such_module', None),
+                        'required': ('no_such_module', None)},
+            optional=('missing', ))
+        import os.path
+        self.assertTrue(getattr_('path') is os.path)
+        self.assertTrue(getattr_('join') is os.path.join)
+        self.assertTrue(namespace['join'] is os.path.join)
+        self.assertIsNone(getattr_('missing'))
+        with self.assertRaises(ImportError):
+            getattr_('required')
+        with self.assertRaises(AttributeError):
+            getattr_('unknown')
+        # Patched values are used
+        namespace['join'] = 'spam'
+        self.assertEqual(getattr_('join'), 'spam')
+
+    def test_import_without_satpy(self):
+        import subprocess
+        import sys
+        heavy = ['satpy', 'pyorbital', 'dpath', 'trollsched', 'rasterio',
+                 'posttroll.publisher']
+        code = ("import sys\n"
+                "import trollflow_sat.segment_gatherer\n"
+                "import trollflow_sat.fetch\n"
+                "import trollflow_sat.utils\n"
+                "print(' '.join(mod for mod in %r if mod in sys.modules))"
+                % heavy)
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.decode().strip(), '')
+
+
 def suite():
     """The suite for test_utils
     """
     loader = unittest.TestLoader()
     mysuite = unittest.TestSuite()
     mysuite.addTest(loader.loadTestsFromTestCase(TestUtils))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSunZenithMemo))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDtypes))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDatasetReferences))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestLazyImports))
 
     return mysuite
 
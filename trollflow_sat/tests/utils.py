@@ -127,6 +127,46 @@ PRODUCT_LIST_TWO_AREAS_TOGETHER = OrderedDict({
     })
 })
 
+PRODUCT_LIST_PRIORITIES = OrderedDict({
+    "common": {"process_by_area": False},
+    "product_list": OrderedDict({
+        "area1":
+        OrderedDict({
+            "areaname": "areaname1",
+            "products":
+            OrderedDict({
+                "overview":
+                OrderedDict({
+                    "productname": "overview",
+                    "fname_pattern": "pattern",
+                    "formats": [{"format": "tif", "writer": None}]
+                }),
+                "natural":
+                OrderedDict({
+                    "productname": "natural",
+                    "priority": 10,
+                    "fname_pattern": "pattern",
+                    "formats": [{"format": "tif", "writer": None}]
+                })
+            })
+        }),
+        "area2":
+        OrderedDict({
+            "areaname": "areaname2",
+            "priority": 10,
+            "products":
+            OrderedDict({
+                "overview":
+                OrderedDict({
+                    "productname": "overview",
+                    "fname_pattern": "pattern",
+                    "formats": [{"format": "tif", "writer": None}]
+                })
+            })
+        })
+    })
+})
+
 FILE1 = "/path/to/data1.file"
 FILE2 = "/path/to/data2.file"
 METADATA_FILE = {"start_time": dt.datetime(2018, 8, 31, 12, 0),
@@ -181,7 +221,10 @@ class MockScene(OrderedDict):
         self.attrs = attrs or {}
 
     def load(self, names):
+        tree = getattr(self, '_dependency_tree', {})
         for name in names:
+            if name in tree:
+                self.load([child.name for child in tree[name].children])
             dset = MockDset(name, attrs=self.attrs)
             self.datasets[dset] = dset
 
@@ -210,5 +253,15 @@ class MockScene(OrderedDict):
                 return itm
         raise IndexError
 
+    def __contains__(self, idx):
+        return any(itm.name == idx for itm in self.datasets)
+
+    def __delitem__(self, idx):
+        for itm in list(self.datasets):
+            if itm.name == idx:
+                del self.datasets[itm]
+                return
+        raise KeyError(idx)
+
     def save_datasets(self, datasets=None, **kwargs):
         return MockDset(datasets[0], self.attrs)
@@ -1,35 +1,86 @@
+import importlib
 import logging
 import os.path
+import sys
+import time
+from threading import Lock
+from collections import OrderedDict
+from contextlib import contextmanager
 
+import six
 from posttroll.message import Message
-from posttroll.publisher import Publish
 from trollflow.utils import acquire_lock as trollflow_acquire_lock
 from trollflow.utils import release_lock
 from trollsift import compose
 from trollsift.parser import get_convert_dict
 
-from satpy.resample import get_area_def
-
-try:
-    from pyorbital import astronomy
-except ImportError:
-    astronomy = None
-
-try:
-    import dpath.util
-    DPATH_AVAILABLE = True
-except ImportError:
-    DPATH_AVAILABLE = False
-
 PATTERN = "{time:%Y%m%d_%H%M}_{platform_name}_{areaname}_{productname}.png"
 
 FORMAT_DEFAULTS = {'writer': None,
                    'format': None,
                    'fill_value': None}
 
+DEFAULT_PRIORITY = 0
+
 LOGGER = logging.getLogger(__name__)
 
 
+def lazy_attributes(namespace, attributes, optional=()):
+    """Create a module level ``__getattr__`` function for importing
+    heavy dependencies at their first use.  *namespace* is the
+    ``globals()`` of the module, and *attributes* maps the attribute
+    names to (module name, attribute name) pairs, where the attribute
+    name is None for the module itself.  Attributes listed in
+    *optional* are None if the import fails.  The imported values are
+    stored in the namespace, so they can also be patched.
+
+    Python versions older than 3.7 don't support module level
+    ``__getattr__``, so there the attributes are imported right away.
+    """
+    def _getattr(name):
+        if name in namespace:
+            return namespace[name]
+        try:
+            module_name, attr = attributes[name]
+        except KeyError:
+            raise AttributeError("module %r has no attribute %r" %
+                                 (namespace["__name__"], name))
+        try:
+            val = importlib.import_module(module_name)
+            if attr is not None:
+                val = getattr(val, attr)
+        except ImportError:
+            if name not in optional:
+                raise
+            val = None
+        namespace[name] = val
+        return val
+
+    if sys.version_info < (3, 7):
+        for name in attributes:
+            _getattr(name)
+
+    return _getattr
+
+
+# Heavy dependencies, imported at first use
+_lazy = lazy_attributes(globals(),
+                        {"Publish": ("posttroll.publisher", "Publish"),
+                         "get_area_def": ("satpy.resample", "get_area_def"),
+                         "astronomy": ("pyorbital.astronomy", None),
+                         "dpath_util": ("dpath.util", None)},
+                        optional=("astronomy", "dpath_util"))
+__getattr__ = _lazy
+
+
+def get_area_definition(area):
+    """Get the area definition of *area* given by name.  Area
+    definitions are returned as they are."""
+    if not isinstance(area, six.string_types):
+        return area
+    return _lazy("get_area_def")(area)
+
+
 def create_fnames(info, product_config, prod_id):
     """Create filename for product *prod*"""
     area_id = info["area_id"]
@@ -123,9 +174,169 @@ def get_format_settings(product_config, prod_id, area_id):
     return settings
 
 
-def bad_sunzen_range(product_config, area_id, composite, start_time):
+def get_priority(product_config, area_id, prod_id=None):
+    """Get the processing priority of an area, or of a product within
+    the area.  Products without a priority inherit the priority of
+    their area.  Larger values are processed first.
+    """
+    area_config = product_config["product_list"][area_id]
+    priority = area_config.get("priority", DEFAULT_PRIORITY)
+    if prod_id is not None:
+        priority = area_config["products"][prod_id].get("priority",
+                                                        priority)
+    return priority
+
+
+def get_dtype(product_config, area_id, prod_id):
+    """Get the data type the product is processed as.  The "dtype" of
+    the product overrides that of the area, which overrides the common
+    setting.  None keeps the data type given by SatPy.
+    """
+    area_config = product_config["product_list"][area_id]
+    dtype = product_config["common"].get("dtype", None)
+    dtype = area_config.get("dtype", dtype)
+    return area_config["products"].get(prod_id, {}).get("dtype", dtype)
+
+
+def coerce_dtypes(scene, product_config, area_id, products, logger=LOGGER):
+    """Convert the floating point *products* of *scene* to their
+    configured data types.  Integer data, eg. counts, is kept as it
+    is."""
+    import numpy as np
+
+    for prod_id in products:
+        dtype = get_dtype(product_config, area_id, prod_id)
+        if dtype is None:
+            continue
+        try:
+            dset = scene[prod_id]
+        except KeyError:
+            continue
+        dtype = np.dtype(dtype)
+        if dset.dtype == dtype or \
+                not np.issubdtype(dset.dtype, np.floating):
+            continue
+        logger.debug("Converting %s from %s to %s", prod_id,
+                     str(dset.dtype), str(dtype))
+        attrs = dset.attrs
+        dset = dset.astype(dtype)
+        dset.attrs = attrs
+        scene[prod_id] = dset
+
+
+def get_processing_plan(product_config):
+    """Group the products of each area by their priority.
+
+    Returns a list of (priority, area_id, products) tuples sorted so
+    that the highest priority comes first.  Within the same priority
+    the order of the product list is retained.
+    """
+    plan = []
+    for area_id in product_config["product_list"]:
+        groups = OrderedDict()
+        products = product_config["product_list"][area_id]["products"]
+        for prod_id in products:
+            priority = get_priority(product_config, area_id, prod_id)
+            groups.setdefault(priority, []).append(prod_id)
+        for priority, prod_ids in groups.items():
+            plan.append((priority, area_id, prod_ids))
+
+    # sorted() is stable, so the configured order is kept within the
+    # priority classes
+    return sorted(plan, key=lambda itm: itm[0], reverse=True)
+
+
+def get_sunzen_points(product_config):
+    """Get the (lon, lat) locations where the Sun zenith angle limits
+    of the products are checked."""
+    points = set()
+    for area_config in product_config["product_list"].values():
+        for prod_conf in area_config["products"].values():
+            if ("sunzen_night_minimum" not in prod_conf and
+                    "sunzen_day_maximum" not in prod_conf):
+                continue
+            if "sunzen_lon" in prod_conf and "sunzen_lat" in prod_conf:
+                points.add((prod_conf["sunzen_lon"],
+                            prod_conf["sunzen_lat"]))
+    return points
+
+
+class SunZenithMemo(object):
+
+    """Remember the Sun zenith angles of (time, lon, lat) locations,
+    and the ranges of the angles over (time, area) pairs.  The angles
+    of all the locations of a time are computed in one vectorised call.
+    At most *max_size* most recent angles and ranges are remembered."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._angles = OrderedDict()
+        self._ranges = OrderedDict()
+        self._lock = Lock()
+
+    def update(self, utc_time, points):
+        """Compute the angles of the (lon, lat) *points* at *utc_time*
+        that aren't known yet."""
+        import numpy as np
+
+        with self._lock:
+            missing = sorted(point for point in set(points) if
+                             (utc_time, ) + tuple(point) not in self._angles)
+        astronomy = _lazy("astronomy")
+        if not missing or astronomy is None:
+            return
+        lons, lats = np.array(missing, dtype=np.float64).T
+        angles = astronomy.sun_zenith_angle(utc_time, lons, lats)
+        with self._lock:
+            for point, angle in zip(missing, np.atleast_1d(angles)):
+                self._angles[(utc_time, ) + tuple(point)] = float(angle)
+            while len(self._angles) > self.max_size:
+                self._angles.popitem(last=False)
+
+    def get(self, utc_time, lon, lat):
+        """Get the Sun zenith angle at *lon*, *lat* at *utc_time*, or
+        None if it can't be computed."""
+        key = (utc_time, lon, lat)
+        with self._lock:
+            if key in self._angles:
+                return self._angles[key]
+        self.update(utc_time, [(lon, lat)])
+        with self._lock:
+            return self._angles.get(key)
+
+    def get_range(self, utc_time, area_id, sunzen_provider):
+        """Get the (minimum, maximum) Sun zenith angles over *area_id* at
+        *utc_time*, computed with *sunzen_provider*."""
+        key = (utc_time, area_id)
+        with self._lock:
+            if key in self._ranges:
+                return self._ranges[key]
+        sunzen_range = get_sunzen_range(utc_time, area_id, sunzen_provider)
+        with self._lock:
+            self._ranges[key] = sunzen_range
+            while len(self._ranges) > self.max_size:
+                self._ranges.popitem(last=False)
+        return sunzen_range
+
+
+def get_sunzen_range(utc_time, area_id, sunzen_provider):
+    """Get the (minimum, maximum) Sun zenith angles over *area_id* at
+    *utc_time*, computed with *sunzen_provider*."""
+    import numpy as np
+
+    sunzen = sunzen_provider.get_sunzen(get_area_definition(area_id),
+                                        utc_time)
+    return float(np.nanmin(sunzen)), float(np.nanmax(sunzen))
+
+
+def bad_sunzen_range(product_config, area_id, composite, start_time,
+                     sunzen_provider=None, sunzen_memo=None):
     """Check if Sun zenith angle is valid at the configured location.
-    SatPy version.
+    SatPy version.  Without a configured location, the angles over the
+    whole area are checked using *sunzen_provider*, if given, and the
+    composite is valid if any part of the area is within the range.
+    The angles at the configured locations, and the ranges of the
+    angles over the areas, are taken from *sunzen_memo*, if given.
     """
     product_conf = \
         product_config["product_list"][area_id]["products"][composite]
@@ -134,24 +345,42 @@ def bad_sunzen_range(product_config, area_id, composite, start_time):
             "sunzen_day_maximum" not in product_conf):
         return False
 
+    astronomy = _lazy("astronomy")
     if astronomy is None:
         LOGGER.warning("Pyorbital not installed, unable to calculate "
                        "Sun zenith angles!")
         return False
 
     if "sunzen_lon" not in product_conf and "sunzen_lat" not in product_conf:
-        LOGGER.warning("No 'sunzen_lon' or 'sunzen_lat' configured, "
-                       "can\'t check Sun elevation.")
-        return False
-
-    lon = product_conf["sunzen_lon"]
-    lat = product_conf["sunzen_lat"]
-    sunzen = astronomy.sun_zenith_angle(start_time, lon, lat)
-    LOGGER.debug("Sun zenith angle is %.2f degrees", sunzen)
+        if sunzen_provider is None:
+            LOGGER.warning("No 'sunzen_lon' or 'sunzen_lat' configured, "
+                           "can\'t check Sun elevation.")
+            return False
+        if sunzen_memo is not None:
+            sunzen_min, sunzen_max = sunzen_memo.get_range(
+                start_time, area_id, sunzen_provider)
+        else:
+            sunzen_min, sunzen_max = get_sunzen_range(start_time, area_id,
+                                                      sunzen_provider)
+        LOGGER.debug("Sun zenith angles are %.2f - %.2f degrees",
+                     sunzen_min, sunzen_max)
+    else:
+        lon = product_conf["sunzen_lon"]
+        lat = product_conf["sunzen_lat"]
+        if sunzen_memo is not None:
+            sunzen = sunzen_memo.get(start_time, lon, lat)
+        else:
+            sunzen = astronomy.sun_zenith_angle(start_time, lon, lat)
+        if sunzen is None:
+            LOGGER.warning("Unable to calculate the Sun zenith angle, "
+                           "can\'t check Sun elevation.")
+            return False
+        LOGGER.debug("Sun zenith angle is %.2f degrees", sunzen)
+        sunzen_min = sunzen_max = sunzen
 
     try:
         limit = product_conf["sunzen_night_minimum"]
-        if sunzen < limit:
+        if sunzen_max < limit:
             return True
         else:
             return False
@@ -159,7 +388,7 @@ def bad_sunzen_range(product_config, area_id, composite, start_time):
         pass
 
     limit = product_conf["sunzen_day_maximum"]
-    if sunzen > limit:
+    if sunzen_min > limit:
         return True
     else:
         return False
@@ -172,8 +401,8 @@ def send_message(topic, msg_type, msg_data, nameservers=None, port=0):
     if not isinstance(nameservers, list):
         nameservers = [nameservers]
 
-    with Publish("trollflow-sat", port=port,
-                 nameservers=nameservers) as pub:
+    with _lazy("Publish")("trollflow-sat", port=port,
+                          nameservers=nameservers) as pub:
         msg = Message(topic, msg_type, msg_data)
         pub.send(str(msg))
 
@@ -200,6 +429,175 @@ def _get_orbit_number_from_message_data(msg_data):
         return None
 
 
+def get_message_key(msg):
+    """Get a key identifying the data of *msg*: the set of file
+    uids (or uris), the data time, the area of an area collection and
+    the publish stage of the gatherer.  The same files can be sent for
+    several areas, and again after an earlier publish stage."""
+    files = []
+    if msg.type == "dataset":
+        files = msg.data["dataset"]
+    elif msg.type == "collection":
+        for col in msg.data["collection"]:
+            files += col.get("dataset", [col])
+    else:
+        files = [msg.data]
+    uids = frozenset(itm.get("uid", itm.get("uri")) for itm in files)
+
+    return (uids, _get_data_time_from_message_data(msg.data),
+            msg.data.get("collection_area_id"),
+            msg.data.get("publish_stage"))
+
+
+class DatasetReferences(object):
+
+    """Track which areas still need each dataset of a scene.  Thread
+    safe, as the areas are released by the next worker.  The scene
+    isn't thread safe, so the workers hold *lock* while loading,
+    resampling or unloading its datasets."""
+
+    def __init__(self):
+        # Dataset name -> areas still needing it
+        self._users = {}
+        self._lock = Lock()
+        self.lock = Lock()
+
+    def acquire(self, area_id, names):
+        """Mark datasets *names* needed by *area_id*."""
+        with self._lock:
+            for name in names:
+                self._users.setdefault(name, set()).add(area_id)
+
+    def release(self, area_id, names=None):
+        """Mark datasets *names*, by default all, no longer needed by
+        *area_id*.  Returns the names of the datasets not needed by any
+        area anymore."""
+        unused = []
+        with self._lock:
+            for name in list(self._users):
+                if names is not None and name not in names:
+                    continue
+                users = self._users[name]
+                if area_id not in users:
+                    continue
+                users.discard(area_id)
+                if not users:
+                    del self._users[name]
+                    unused.append(name)
+        return sorted(unused)
+
+    def needed(self):
+        """Get the names of the datasets still needed by some area."""
+        with self._lock:
+            return set(self._users)
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._users
+
+
+@contextmanager
+def hold(lock):
+    """Hold *lock* in a with statement, if given."""
+    if lock is None:
+        yield
+        return
+    with lock:
+        yield
+
+
+def get_dataset_name(key):
+    """Get the name of the dataset *key*, a name or a dataset ID."""
+    if isinstance(key, six.string_types):
+        return key
+    try:
+        return key["name"]
+    except (TypeError, KeyError, IndexError):
+        return getattr(key, "name", key)
+
+
+def get_prerequisites(scene, names):
+    """Get the IDs of the datasets in *scene* the composites *names*
+    are generated from, according to the dependency tree of the
+    scene."""
+    tree = getattr(scene, "_dependency_tree", None)
+    prerequisites = set()
+    if tree is None:
+        return prerequisites
+    for name in names:
+        try:
+            node = tree[name]
+        except KeyError:
+            continue
+        for ds_id in node.flatten():
+            if ds_id != node.name and ds_id in scene:
+                prerequisites.add(ds_id)
+    return prerequisites
+
+
+def get_resample_datasets(scene, names):
+    """Get the IDs of the datasets of *scene* to resample for the
+    composites *names*: the composites and the datasets they are
+    generated from.  Returns None, meaning all the datasets, if some of
+    the composites are generated only after resampling."""
+    datasets = set()
+    for name in names:
+        if name not in scene:
+            return None
+        datasets.add(scene[name].attrs.get("_satpy_id", name))
+    datasets.update(get_prerequisites(scene, names))
+    return list(datasets)
+
+
+def unload_datasets(scene, names, logger=LOGGER):
+    """Remove datasets *names* from *scene*."""
+    if not names:
+        return
+    logger.debug("Unloading datasets no longer needed: %s",
+                 ', '.join(sorted(names)))
+    for name in names:
+        try:
+            del scene[name]
+        except KeyError:
+            pass
+
+
+class MessageDeduplicator(object):
+
+    """Recognize messages of already seen data.  At most *max_size*
+    most recently seen messages are remembered, and messages older
+    than *window* seconds are forgotten.
+    """
+
+    def __init__(self, max_size=1000, window=None):
+        self.max_size = max_size
+        self.window = window
+        # Message key -> time when last seen
+        self._seen = OrderedDict()
+        self.suppressed = 0
+
+    def is_duplicate(self, msg):
+        """Check if the data in *msg* has already been seen, and mark
+        it seen."""
+        now = time.time()
+        if self.window is not None:
+            while self._seen and \
+                    next(iter(self._seen.values())) < now - self.window:
+                self._seen.popitem(last=False)
+
+        key = get_message_key(msg)
+        duplicate = key in self._seen
+        # Move the key to the most recent end
+        self._seen.pop(key, None)
+        self._seen[key] = now
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+        if duplicate:
+            self.suppressed += 1
+        return duplicate
+
+
 def get_monitor_metadata(msg, status=None, service=None):
     """Collect metadata for monitoring message"""
     data = {"message_time": msg.time,
@@ -233,7 +631,7 @@ def acquire_lock(lock):
 
 def covers(overpass, area_name, min_coverage, logger):
     try:
-        area_def = get_area_def(area_name)
+        area_def = _lazy("get_area_def")(area_name)
         if min_coverage == 0 or overpass is None:
             return True
         min_coverage /= 100.0
@@ -263,7 +661,8 @@ def select_dict_items(src_dict, selection):
             if isinstance(selection, dict):
                 val = selection[dest_key]
                 if '/' in val:
-                    if not DPATH_AVAILABLE:
+                    dpath_util = _lazy("dpath_util")
+                    if dpath_util is None:
                         LOGGER.error("path expressions in publish_var but no dpath available")
                     else:
                         # use dpath for path expressions
@@ -272,11 +671,11 @@ def select_dict_items(src_dict, selection):
                         if '*' in val:
                             # returns list
                             to_send[dest_key] = \
-                                dpath.util.values(info_without_empty_keys, val)
+                                dpath_util.values(info_without_empty_keys, val)
                         else:
                             # returns single value
                             to_send[dest_key] = \
-                                dpath.util.get(info_without_empty_keys, val)
+                                dpath_util.get(info_without_empty_keys, val)
                 else:
                     to_send[dest_key] = src_dict.get(val)
             else: